@@ -11,29 +11,142 @@ import re
 import time
 import argparse
 import keyring
+import threading
+import multiprocessing
 
 from sys import exit as exit
-from collections import OrderedDict
+from Queue import Empty
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, Counter, deque
 from shutil import copy2, move
 
-# we import PollingObserver instead of Observer because the deleted event
-# is not capturing https://github.com/gorakhargosh/watchdog/issues/46
-from watchdog.observers.polling import PollingObserver as Observer
-from watchdog.events import FileSystemEventHandler
+# The watchdog inotify observer misses the deleted events (https://github.com/gorakhargosh/watchdog/issues/46):
+# the sharing folder is watched with our inotify emitter, or polled where inotify isn't available.
+from watchdog.observers.api import BaseObserver, DEFAULT_OBSERVER_TIMEOUT
+from watchdog.observers.polling import PollingEmitter
+from watchdog.events import FileSystemEventHandler, FileDeletedEvent, FileMovedEvent, DirDeletedEvent, DirMovedEvent, \
+    EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED
 from connection_manager import ConnectionManager
+from file_index import FileIndex
+from merkle_tree import MerkleSnapshot, DIR_ENTRY
+try:
+    from inotify_observer import InotifyEmitter, EventsLostEvent
+except Exception:
+    # inotify is available only on Linux (watchdog raises UnsupportedLibc elsewhere)
+    InotifyEmitter = EventsLostEvent = None
 
 
-class SkipObserver(Observer):
-    def __init__(self, *args):
-        Observer.__init__(self, *args)
+class SkipObserver(BaseObserver):
+    # Max number of queued events handled together
+    MAX_COALESCED_EVENTS = 1000
+
+    def __init__(self, emitter_class=PollingEmitter, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        BaseObserver.__init__(self, emitter_class=emitter_class, timeout=timeout)
         self._skip_list = []
+        # Events taken from the queue to be handled together, to be dispatched next
+        self._pending_events = deque()
+        # Number of events taken from the queue (coalesced ones included) not marked as done yet
+        self._taken_events = 0
 
     def skip(self, path):
         self._skip_list.append(path)
         print 'Path "{}" added to skip list!!!'.format(path)
 
     def dispatch_events(self, event_queue, timeout):
-        event, watch = event_queue.get(block=True, timeout=timeout)
+        if not self._pending_events:
+            # Take also the events already queued (e.g. of a removed or moved folder)
+            events = [event_queue.get(block=True, timeout=timeout)]
+            while len(events) < SkipObserver.MAX_COALESCED_EVENTS:
+                try:
+                    events.append(event_queue.get_nowait())
+                except Empty:
+                    break
+            self._taken_events = len(events)
+            self._pending_events.extend(self._coalesce(events))
+            with self._lock:
+                for watch in set(watch for _, watch in self._pending_events):
+                    for handler in list(self._handlers.get(watch, [])):
+                        if hasattr(handler, 'on_events_queued'):
+                            handler.on_events_queued([e for e, w in self._pending_events if w == watch])
+
+        try:
+            self._dispatch_next_event()
+        finally:
+            if not self._pending_events:
+                # All the events taken from the queue have been handled
+                for _ in xrange(self._taken_events):
+                    event_queue.task_done()
+                self._taken_events = 0
+
+    def _dispatch_next_event(self):
+        event, watch = self._pending_events.popleft()
+        if EventsLostEvent is not None and isinstance(event, EventsLostEvent):
+            with self._lock:
+                for handler in list(self._handlers.get(watch, [])):
+                    handler.on_events_lost(event)
+            return
+        if self._skip(event):
+            return
+
+        if isinstance(event, FileDeletedEvent):
+            # Coalesce the consecutive deletes (e.g. of the files of a removed folder)
+            events = [event]
+            while self._pending_events and isinstance(self._pending_events[0][0], FileDeletedEvent) \
+                    and self._pending_events[0][1] == watch:
+                next_event, _ = self._pending_events.popleft()
+                if not self._skip(next_event):
+                    events.append(next_event)
+            if len(events) > 1:
+                with self._lock:
+                    for handler in list(self._handlers.get(watch, [])):
+                        handler.on_files_deleted(events)
+                return
+
+        with self._lock:
+            for handler in list(self._handlers.get(watch, [])):
+                handler.dispatch(event)
+
+    @staticmethod
+    def _coalesce(events):
+        """
+        Replace the events of the files and directories inside a moved or deleted directory with the directory
+        event (put in the place of the first of them), so that the directory is handled with a single operation.
+        :param events: list of (event, watch) tuples
+        :return: list of (event, watch) tuples
+        """
+        def container(event, dir_events):
+            for dir_event in dir_events:
+                if isinstance(dir_event, DirMovedEvent):
+                    if isinstance(event, (FileMovedEvent, DirMovedEvent)) and \
+                            event.src_path.startswith(dir_event.src_path + os.sep) and \
+                            event.dest_path.startswith(dir_event.dest_path + os.sep):
+                        return dir_event
+                elif isinstance(event, (FileDeletedEvent, DirDeletedEvent)) and \
+                        event.src_path.startswith(dir_event.src_path + os.sep):
+                    return dir_event
+            return None
+
+        dir_events = [event for event, _ in events if isinstance(event, (DirMovedEvent, DirDeletedEvent))]
+        if not dir_events:
+            return events
+        # the outermost directories
+        dir_events = [event for event in dir_events if container(event, dir_events) is None]
+
+        coalesced = []
+        dispatched = set()
+        for event, watch in events:
+            dir_event = container(event, dir_events) or event
+            if dir_event in dir_events:
+                if dir_event.key in dispatched:
+                    continue
+                dispatched.add(dir_event.key)
+            coalesced.append((dir_event, watch))
+        return coalesced
+
+    def _skip(self, event):
+        """
+        Return True if the event is on a path of the skip list (removing the path from the list).
+        """
         skip = False
         try:
             event.dest_path
@@ -51,16 +164,226 @@ class SkipObserver(Observer):
             if event.src_path in self._skip_list:
                 self._skip_list.remove(event.src_path)
                 skip = True
+        return skip
+
+
+class ChangesListener(threading.Thread):
+    """
+    Thread that keeps a change notification request (long polling) pending on the server, and wakes up
+    the daemon, writing on a pipe watched by its select loop, as soon as the server snapshot changes.
+    """
+    # Seconds to wait before asking again after a failed request
+    RETRY_DELAY = 3
+
+    def __init__(self, conn_mng, wait):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn_mng = conn_mng
+        self.wait = wait
+        self.running = True
+        # False if the server doesn't support change notifications
+        self.supported = True
+        self.read_fd, self.write_fd = os.pipe()
+
+    def run(self):
+        since = self.conn_mng.changelog_timestamp or 0
+        while self.running:
+            response = self.conn_mng.dispatch_request('wait_changes', {'since': since, 'wait': self.wait})
+            if response['successful']:
+                since = response['content']['changelog_timestamp']
+                if response['content']['changed']:
+                    os.write(self.write_fd, '!')
+            elif response.get('unsupported'):
+                self.supported = False
+                return
+            else:
+                time.sleep(ChangesListener.RETRY_DELAY)
+
+    def fileno(self):
+        """
+        The file descriptor that becomes readable when there are server changes (to be used with select).
+        """
+        return self.read_fd
+
+    def pop_notifications(self):
+        """
+        Consume the pending notifications (to be called when the pipe is readable).
+        """
+        os.read(self.read_fd, 4096)
 
-        if not skip:
-            self._dispatch_event(event, watch)
+    def stop(self):
+        # The pending request can't be interrupted: the thread is a daemon one.
+        self.running = False
 
-        event_queue.task_done()
+
+class ServerDirHashes(object):
+    """
+    Directory hashes of the server files, with the dir_hash() and dir_entries() methods of a MerkleSnapshot:
+    each directory is asked to the server when first needed, so comparing them with
+    MerkleSnapshot.differing_files() only asks the directories whose hashes differ.
+    If a request fails <failed> is set, and the directories not got look empty.
+    """
+
+    def __init__(self, conn_mng):
+        self.conn_mng = conn_mng
+        self.failed = False
+        # {'<dirpath>': ('<hash>', {'<name>': ('<kind>', '<md5 or hash>')})}
+        self._dirs = {}
+        # The directories known to be on the server (from the entries of their parent)
+        self._server_dirs = set([''])
+
+    def _get(self, dirpath):
+        if dirpath not in self._server_dirs or self.failed:
+            return None
+        if dirpath not in self._dirs:
+            response = self.conn_mng.dispatch_request('get_dir_hashes', {'dirpath': dirpath})
+            if not response['successful']:
+                self.failed = True
+                return None
+            entries = dict((name, tuple(entry)) for name, entry in response['content']['entries'].iteritems())
+            for name, (kind, _) in entries.iteritems():
+                if kind == DIR_ENTRY:
+                    self._server_dirs.add('/'.join((dirpath, name)) if dirpath else name)
+            self._dirs[dirpath] = (response['content']['hash'], entries)
+        return self._dirs[dirpath]
+
+    def dir_hash(self, dirpath):
+        server_dir = self._get(dirpath)
+        return server_dir[0] if server_dir else None
+
+    def dir_entries(self, dirpath):
+        server_dir = self._get(dirpath)
+        return dict(server_dir[1]) if server_dir else {}
+
+
+class Hasher(object):
+    """
+    Compute the md5 of files, READ_SIZE bytes at a time, on a pool of worker threads: the file reads and
+    hashlib release the GIL, so the workers hash in parallel on more cores.
+    """
+    READ_SIZE = 2 ** 20
+
+    def __init__(self, workers, max_pending=None):
+        """
+        :param workers: int number of worker threads
+        :param max_pending: int max number of files submitted and not yet returned (default 4 for each worker)
+        """
+        self.workers = workers
+        self.max_pending = max_pending or workers * 4
+        self._pool = None
+
+    @staticmethod
+    def md5(file_path, read_size=READ_SIZE):
+        """
+        Return the md5 of the file (raising IOError if it can't be read).
+        """
+        md5hash = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            while True:
+                buf = f.read(read_size)
+                if not buf:
+                    break
+                md5hash.update(buf)
+        return md5hash.hexdigest()
+
+    def imap(self, func, items):
+        """
+        Call func on the items on the worker threads, yielding the (item, result) pairs in the items order.
+        items can be a generator (e.g. of a directory walk): at most max_pending items are taken in advance.
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        pending = deque()
+        for item in items:
+            pending.append((item, self._pool.apply_async(func, (item,))))
+            if len(pending) >= self.max_pending:
+                item, result = pending.popleft()
+                yield item, result.get()
+        while pending:
+            item, result = pending.popleft()
+            yield item, result.get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+class SyncScheduler(object):
+    """
+    Execute the synchronization commands on a pool of worker threads.
+    The commands on the same path are kept in order, deletes are scheduled before transfers and
+    smaller files before bigger ones, so that many small files aren't stuck behind a big one.
+    """
+    # Scheduling order of the command kinds (lower first)
+    PRIORITIES = {'delete': 0, 'modify': 1, 'upload': 1, 'download': 1}
+
+    def __init__(self, run_command, workers):
+        """
+        :param run_command: function(command, path) that executes a command and returns its response
+        :param workers: int max number of commands executed at the same time
+        """
+        self.run_command = run_command
+        self.workers = workers
+        self.cancelled = threading.Event()
+
+    def _chains(self, commands, size_of):
+        """
+        Group the commands by path (in their order) and sort the groups by priority.
+        """
+        chains = OrderedDict()
+        for command, path in commands:
+            chains.setdefault(path, []).append((command, path))
+        return sorted(chains.values(),
+                      key=lambda chain: (SyncScheduler.PRIORITIES.get(chain[0][0], 1), size_of(*chain[0])))
+
+    def _run_chain(self, chain):
+        results = []
+        for command, path in chain:
+            if self.cancelled.is_set():
+                break
+            response = self.run_command(command, path)
+            results.append((command, path, response))
+            if not response['successful']:
+                # the next commands on this path depend on the failed one
+                break
+        return results
+
+    def run(self, commands, size_of=lambda command, path: 0):
+        """
+        Execute the commands and yield (command, path, response) as soon as they are done.
+        :param commands: list of (command, path) tuples
+        :param size_of: function(command, path) that returns the size used to prioritize the command
+        """
+        chains = self._chains(commands, size_of)
+        if not chains:
+            return
+        pool = ThreadPool(max(1, min(self.workers, len(chains))))
+        try:
+            for results in pool.imap_unordered(self._run_chain, chains):
+                for result in results:
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def cancel(self):
+        """
+        Don't start the commands not yet scheduled (the running ones are completed).
+        """
+        self.cancelled.set()
 
 
 def is_directory(method):
+    """
+    Decorator of the event handlers: the directory events are handled by the directory handler of the same event
+    (e.g. on_dir_moved for on_moved) if any, otherwise they are discarded.
+    """
     def wrapper(self, e):
         if e.is_directory:
+            dir_method = getattr(self, method.__name__.replace('on_', 'on_dir_', 1), None)
+            if dir_method:
+                return dir_method(e)
             return
         return method(self, e)
     return wrapper
@@ -86,6 +409,23 @@ class Daemon(FileSystemEventHandler):
     # Allowed operation before user is activated
     ALLOWED_OPERATION = {'register', 'activate', 'login'}
 
+    # Synchronization modes (cfg 'sync_mode'): wait for server change notifications or poll every 3 seconds
+    SYNC_MODE_LONGPOLL = 'longpoll'
+    SYNC_MODE_POLL = 'poll'
+    DEF_SYNC_MODE = SYNC_MODE_LONGPOLL
+    # Max seconds of a single change notification request
+    LONG_POLL_WAIT = 60
+    # Synchronization commands executed at the same time (cfg 'sync_workers')
+    DEF_SYNC_WORKERS = 4
+    # Observers of the sharing folder (cfg 'observer'): inotify events, or polling where inotify isn't available
+    OBSERVER_INOTIFY = 'inotify'
+    OBSERVER_POLLING = 'polling'
+    DEF_OBSERVER = OBSERVER_INOTIFY
+    # Database of the file index (in the configuration directory)
+    FILE_INDEX_FILENAME = 'file_index.db'
+    # Threads hashing the files at the same time (cfg 'hash_workers')
+    DEF_HASH_WORKERS = multiprocessing.cpu_count()
+
     def __init__(self, cfg_path=None, sharing_path=None):
         FileSystemEventHandler.__init__(self)
         # Just Initialize variable the Daemon.start() do the other things
@@ -93,14 +433,23 @@ class Daemon(FileSystemEventHandler):
         self.running = 0
         self.client_snapshot = {}  # EXAMPLE {'<filepath1>: ['<timestamp>', '<md5>', '<filepath2>: ...}
         self.shared_snapshot = {}
-        self.local_dir_state = {}  # EXAMPLE {'last_timestamp': '<timestamp>', 'global_md5': '<md5>'}
+        self.local_dir_state = {}  # EXAMPLE {'last_timestamp': '<timestamp>', 'root_hash': '<md5>'}
         self.listener_socket = None
         self.observer = None
+        self.changes_listener = None
         self.cfg = self._load_cfg(cfg_path, sharing_path)
         self.password = self._load_pass()
         self._init_sharing_path(sharing_path)
 
         self.conn_mng = ConnectionManager(self.cfg)
+        # md5 of the files of the sharing folder, kept beside the local dir state
+        self.file_index = FileIndex(os.path.join(os.path.dirname(self.cfg['local_dir_state_path']),
+                                                 Daemon.FILE_INDEX_FILENAME))
+        self.hasher = Hasher(self.cfg.get('hash_workers', Daemon.DEF_HASH_WORKERS))
+        # Files of the queued events hashed in advance: {<abs_path>: (<stat signature>, <md5>)}
+        self._prehashed = {}
+        # Written by the observer thread when the events are lost, to wake up the main loop that scans again
+        self.events_lost_read_fd, self.events_lost_write_fd = os.pipe()
 
         self.INTERNAL_COMMANDS = {
             'addshare': self._add_share,
@@ -108,6 +457,17 @@ class Daemon(FileSystemEventHandler):
             'removeshareduser': self._remove_shared_user,
         }
 
+    @property
+    def client_snapshot(self):
+        return self._client_snapshot
+
+    @client_snapshot.setter
+    def client_snapshot(self, snapshot):
+        # Keep the directory hashes of the snapshot up to date on each change
+        if not isinstance(snapshot, MerkleSnapshot):
+            snapshot = MerkleSnapshot(snapshot)
+        self._client_snapshot = snapshot
+
     def _build_directory(self, path):
         """
         Create a given directory if not existent
@@ -222,14 +582,26 @@ class Daemon(FileSystemEventHandler):
             "<file_path>":('<timestamp>', '<md5>')
         }
         """
-        self.client_snapshot = {}
-        for dirpath, dirs, files in os.walk(self.cfg['sharing_path']):
-            for filename in files:
-                filepath = os.path.join(dirpath, filename)
-                rel_filepath = self.relativize_path(filepath)
+        # Built aside and replaced at once: the current snapshot is used until the scan is over
+        client_snapshot = MerkleSnapshot()
+        found_paths = []
+
+        def files_to_hash():
+            for dirpath, dirs, files in os.walk(self.cfg['sharing_path']):
+                for filename in files:
+                    filepath = os.path.join(dirpath, filename)
+                    rel_filepath = self.relativize_path(filepath)
+                    found_paths.append(rel_filepath)
 
-                if not self._is_shared_file(rel_filepath):
-                    self.client_snapshot[rel_filepath] = ['', self.hash_file(filepath)]
+                    if not self._is_shared_file(rel_filepath):
+                        yield filepath
+
+        # Only the files changed since they were indexed are hashed, more of them at the same time.
+        with self.file_index.batch():
+            for filepath, md5 in self.hash_files(files_to_hash()):
+                client_snapshot[self.relativize_path(filepath)] = ['', md5]
+            self.file_index.prune(found_paths)
+        self.client_snapshot = client_snapshot
 
     def build_shared_snapshot(self):
         """
@@ -248,12 +620,12 @@ class Daemon(FileSystemEventHandler):
             self.stop(1, '\nReceived None snapshot. Server down?\n')
 
         # check the consistency of client snapshot retrieved by the server with the real files on clients
-        file_md5 = None
-        for filepath in self.shared_snapshot.keys():
-            file_md5 = self.hash_file(self.absolutize_path(filepath))
-            if not file_md5 or file_md5 != self.shared_snapshot[filepath][1]:
-                # force the re-download at next synchronization
-                self.shared_snapshot.pop(filepath)
+        with self.file_index.batch():
+            for filepath, file_md5 in self.hasher.imap(lambda path: self.hash_file(self.absolutize_path(path)),
+                                                       self.shared_snapshot.keys()):
+                if not file_md5 or file_md5 != self.shared_snapshot[filepath][1]:
+                    # force the re-download at next synchronization
+                    self.shared_snapshot.pop(filepath)
 
         # NOTE: for future implementation:
         #
@@ -266,11 +638,11 @@ class Daemon(FileSystemEventHandler):
     def _is_directory_modified(self):
         """
         The function check if the shared folder has been modified.
-        It recalculate the md5 from client_snapshot and compares it with the global md5 stored in local_dir_state
+        It compares the root hash of client_snapshot with the one stored in local_dir_state
         :return: True or False
         """
 
-        if self.md5_of_client_snapshot() != self.local_dir_state['global_md5']:
+        if self.md5_of_client_snapshot() != self.local_dir_state['root_hash']:
             return True
         else:
             return False
@@ -357,9 +729,23 @@ class Daemon(FileSystemEventHandler):
             print 'WARNING inconsistency error during delete operation!' \
                   'Impossible to find the following file in stored data (client_snapshot):\n', abs_path
 
-    def _sync_process(self, server_timestamp, server_dir_tree, shared_dir_tree={}):
+    def _server_differing_files(self):
+        """
+        Return the paths of the files that are only in client_snapshot or only on the server, or that have
+        a different md5, comparing the directory hashes of the server only where they differ from the client ones.
+        Return None if the server doesn't give them.
+        """
+        server_hashes = ServerDirHashes(self.conn_mng)
+        differing_files = self.client_snapshot.differing_files(server_hashes)
+        if server_hashes.failed:
+            return None
+        return differing_files
+
+    def _sync_process(self, server_timestamp, server_dir_tree, shared_dir_tree={}, differing_files=None):
         # Makes the synchronization logic and return a list of commands to launch
-        # for server synchronization
+        # for server synchronization.
+        # differing_files are the paths that can differ between client_snapshot and server_dir_tree
+        # (see _server_differing_files()): if given only they are compared
 
         def _filter_tree_difference(client_dir_tree, server_dir_tree):
             # process local dir_tree and server dir_tree
@@ -392,7 +778,12 @@ class Daemon(FileSystemEventHandler):
             return result
 
         local_timestamp = self.local_dir_state['last_timestamp']
-        tree_diff = _filter_tree_difference(self.client_snapshot, server_dir_tree)
+        if differing_files is None:
+            tree_diff = _filter_tree_difference(self.client_snapshot, server_dir_tree)
+        else:
+            tree_diff = _filter_tree_difference(
+                dict((path, self.client_snapshot[path]) for path in differing_files if path in self.client_snapshot),
+                dict((path, server_dir_tree[path]) for path in differing_files if path in server_dir_tree))
         shared_tree_diff = _filter_tree_difference(self.shared_snapshot, shared_dir_tree)
         sync_commands = []
 
@@ -557,52 +948,162 @@ class Daemon(FileSystemEventHandler):
         except KeyError:
             shared_files = {}
 
-        sync_commands = self._sync_process(server_timestamp, server_snapshot, shared_files)
+        sync_commands = self._bundle_downloads(self._bundle_small_uploads(
+            self._sync_process(server_timestamp, server_snapshot, shared_files, self._server_differing_files())))
 
         # Initialize the variable where we put the timestamp of the last operation we did
         last_operation_timestamp = server_timestamp
 
-        # makes all synchronization commands
         for command, path in sync_commands:
-            if command == 'delete':
-                abs_path = self.absolutize_path(path)
-                response = self.conn_mng.dispatch_request(command, {'filepath': path})
-                if response['successful']:
-                    last_operation_timestamp = response['content']['server_timestamp']
-                    if self.client_snapshot.pop(path, 'ERROR') != 'ERROR':
-                        print 'Deleted file on server during SYNC.\nDeleted filepath: ', abs_path
+            if command == 'download':
+                # Skip next operation to prevent watchdog to see this download
+                self.observer.skip(self.absolutize_path(path))
+            elif command == 'download_bundle':
+                for bundled_path in path:
+                    self.observer.skip(self.absolutize_path(bundled_path))
+
+        # makes all synchronization commands, the transfers run concurrently
+        scheduler = SyncScheduler(self._run_sync_command, self.cfg.get('sync_workers', Daemon.DEF_SYNC_WORKERS))
+        failure = None
+        while sync_commands and failure is None:
+            sync_commands, last_operation_timestamp, failure = self._run_sync_commands(
+                scheduler, sync_commands, last_operation_timestamp, server_snapshot, shared_files)
+
+        if failure is not None:
+            self.stop(1, failure)
+
+        self.update_local_dir_state(last_operation_timestamp)
+
+    def _run_sync_commands(self, scheduler, sync_commands, last_operation_timestamp, server_snapshot, shared_files):
+        """
+        Execute the synchronization commands with the scheduler and track their results.
+        Return the commands to execute next (the downloads of the files left out of the bundles),
+        the timestamp of the last operation and the first failure (None if all the commands succeeded).
+        """
+        next_commands = []
+        failure = None
+        for command, path, response in scheduler.run(sync_commands, self._sync_command_size):
+            if not response['successful']:
+                if failure is None:
+                    failure = response['content']
+                    scheduler.cancel()
+                continue
+
+            if command == 'upload_bundle':
+                last_operation_timestamp = max(last_operation_timestamp, response['content']['server_timestamp'])
+                for bundled_command, bundled_path in path:
+                    print '{} file on server during SYNC.\n{} filepath: {}'\
+                        .format(('Modified', 'Updated')[bundled_command == 'modify'],
+                                self.absolutize_path(bundled_path))
+                continue
+
+            if command == 'download_bundle':
+                # The files left out of the bundle (the big ones) are downloaded by themselves, concurrently
+                left_out = set(response['content']['left_out'])
+                for bundled_path in path:
+                    if bundled_path in left_out:
+                        next_commands.append(('download', bundled_path))
                     else:
-                        print 'WARNING inconsistency error during delete operation!' \
-                              'Impossible to find the following file in stored data (client_snapshot):\n', abs_path
+                        self._track_sync_download(bundled_path, server_snapshot, shared_files)
+                continue
+
+            abs_path = self.absolutize_path(path)
+            if command == 'delete':
+                last_operation_timestamp = max(last_operation_timestamp, response['content']['server_timestamp'])
+                if self.client_snapshot.pop(path, 'ERROR') != 'ERROR':
+                    print 'Deleted file on server during SYNC.\nDeleted filepath: ', abs_path
                 else:
-                    self.stop(1, response['content'])
+                    print 'WARNING inconsistency error during delete operation!' \
+                          'Impossible to find the following file in stored data (client_snapshot):\n', abs_path
 
             elif command == 'modify' or command == 'upload':
-                abs_path = self.absolutize_path(path)
-                new_md5 = self.hash_file(abs_path)
-                response = self.conn_mng.dispatch_request(command, {'filepath': path, 'md5': new_md5})
-                if response['successful']:
-                    last_operation_timestamp = response['content']['server_timestamp']
-                    print '{} file on server during SYNC.\n{} filepath: {}'\
-                        .format(('Modified', 'Updated')[command == 'modify'], abs_path)
-                else:
-                    self.stop(1, response['content'])
+                last_operation_timestamp = max(last_operation_timestamp, response['content']['server_timestamp'])
+                print '{} file on server during SYNC.\n{} filepath: {}'\
+                    .format(('Modified', 'Updated')[command == 'modify'], abs_path)
 
             else:  # command == 'download'
-                abs_path = self.absolutize_path(path)
-                # Skip next operation to prevent watchdog to see this download
-                self.observer.skip(abs_path)
-                response = self.conn_mng.dispatch_request(command, {'filepath': path})
-                if response['successful']:
-                    if self._is_shared_file(path):
-                        self.shared_snapshot[path] = shared_files[path]
-                    else:
-                        print 'Downloaded file from server during SYNC.\nDownloaded filepath: {}'.format(abs_path)
-                        self.client_snapshot[path] = server_snapshot[path]
-                else:
-                    self.stop(1, response['content'])
+                self._track_sync_download(path, server_snapshot, shared_files)
 
-        self.update_local_dir_state(last_operation_timestamp)
+        return next_commands, last_operation_timestamp, failure
+
+    def _track_sync_download(self, path, server_snapshot, shared_files):
+        """
+        Update the client (or shared) snapshot after the file has been downloaded during the synchronization.
+        """
+        if self._is_shared_file(path):
+            self.shared_snapshot[path] = shared_files[path]
+        else:
+            print 'Downloaded file from server during SYNC.\nDownloaded filepath: {}'.format(self.absolutize_path(path))
+            self.client_snapshot[path] = server_snapshot[path]
+
+    def _bundle_small_uploads(self, sync_commands):
+        """
+        Replace the upload and modify commands of the small files (up to ConnectionManager.BUNDLE_FILE_MAX_SIZE)
+        with 'upload_bundle' commands, whose path is the tuple of the bundled (command, path) pairs.
+        """
+        commands_per_path = Counter(path for _, path in sync_commands)
+        commands, bundled = [], []
+        for command, path in sync_commands:
+            if (command == 'upload' or command == 'modify') and commands_per_path[path] == 1 and \
+                    self._sync_command_size(command, path) <= ConnectionManager.BUNDLE_FILE_MAX_SIZE:
+                bundled.append((command, path))
+            else:
+                commands.append((command, path))
+        if len(bundled) < 2:
+            return commands + bundled
+        for i in xrange(0, len(bundled), ConnectionManager.BUNDLE_MAX_FILES):
+            commands.append(('upload_bundle', tuple(bundled[i:i + ConnectionManager.BUNDLE_MAX_FILES])))
+        return commands
+
+    def _bundle_downloads(self, sync_commands):
+        """
+        Replace the download commands with 'download_bundle' commands, whose path is the tuple of the bundled paths.
+        The file sizes aren't known here: the server leaves the big files out of the bundles,
+        and they are downloaded by themselves after the bundle (see _run_sync_commands()).
+        """
+        commands_per_path = Counter(path for _, path in sync_commands)
+        commands, bundled = [], []
+        for command, path in sync_commands:
+            if command == 'download' and commands_per_path[path] == 1:
+                bundled.append(path)
+            else:
+                commands.append((command, path))
+        if len(bundled) < 2:
+            return commands + [('download', path) for path in bundled]
+        for i in xrange(0, len(bundled), ConnectionManager.BUNDLE_MAX_FILES):
+            commands.append(('download_bundle', tuple(bundled[i:i + ConnectionManager.BUNDLE_MAX_FILES])))
+        return commands
+
+    def _run_sync_command(self, command, path):
+        """
+        Execute a synchronization command (called by the SyncScheduler worker threads).
+        :param command: str 'delete', 'modify', 'upload', 'download', 'upload_bundle' or 'download_bundle'
+        :param path: str relative path of the file (tuple of (command, path) pairs for 'upload_bundle',
+            tuple of paths for 'download_bundle')
+        :return: the response of the request
+        """
+        if command == 'download_bundle':
+            return self.conn_mng.dispatch_request(command, {'filepaths': list(path)})
+        if command == 'upload_bundle':
+            files = [{'cmd': bundled_command, 'filepath': bundled_path,
+                      'md5': self.hash_file(self.absolutize_path(bundled_path))}
+                     for bundled_command, bundled_path in path]
+            return self.conn_mng.dispatch_request(command, {'files': files})
+        data = {'filepath': path}
+        if command == 'modify' or command == 'upload':
+            data['md5'] = self.hash_file(self.absolutize_path(path))
+        return self.conn_mng.dispatch_request(command, data)
+
+    def _sync_command_size(self, command, path):
+        """
+        Return the bytes to send for a synchronization command (0 when unknown), used to schedule small files first.
+        """
+        if command == 'modify' or command == 'upload':
+            try:
+                return os.path.getsize(self.absolutize_path(path))
+            except OSError:
+                return 0
+        return 0
 
     def _is_shared_file(self, path):
         """
@@ -717,6 +1218,7 @@ class Daemon(FileSystemEventHandler):
         # For example Gedit generate a move event instead copy event when a file is saved.
         if not os.path.exists(e.src_path):
             cmd = 'move'
+            self.file_index.move(rel_src_path, rel_dest_path)
         else:
             print 'WARNING this is COPY event from MOVE EVENT!'
             cmd = 'copy'
@@ -844,6 +1346,7 @@ class Daemon(FileSystemEventHandler):
         """
         print 'start delete of file:', e.src_path
         rel_path = self.relativize_path(e.src_path)
+        self.file_index.remove(rel_path)
 
         if self._is_shared_file(rel_path):
             # if it has modified a file tracked by shared snapshot, then force the re-download of it
@@ -865,6 +1368,142 @@ class Daemon(FileSystemEventHandler):
             else:
                 self.stop(1, response['content'])
 
+    def on_dir_moved(self, e):
+        """
+        Manage the move event of a directory, moving it on the server with a single request.
+        The files are handled one at a time if the directory is copied, if it is (or is moved) inside
+        the shared folder or if the server can't move it.
+        :param e: event object with information about what has happened
+        """
+        print 'Start move of directory from path : {}\n to path: {}'.format(e.src_path, e.dest_path)
+        rel_src_path = self.relativize_path(e.src_path)
+        rel_dest_path = self.relativize_path(e.dest_path)
+
+        if not (os.path.exists(e.src_path) or self._is_shared_file(rel_src_path) or
+                self._is_shared_file(rel_dest_path)):
+            src_paths = self._dir_paths(self.client_snapshot, rel_src_path)
+            if not src_paths:
+                return
+            response = self.conn_mng.dispatch_request('move', {'src': rel_src_path, 'dst': rel_dest_path})
+            if response['successful']:
+                event_timestamp = response['content']['server_timestamp']
+                self.file_index.move(rel_src_path, rel_dest_path)
+                for src_path in src_paths:
+                    dest_path = rel_dest_path + src_path[len(rel_src_path):]
+                    self.client_snapshot[dest_path] = [event_timestamp, self.client_snapshot.pop(src_path)[1]]
+                self.update_local_dir_state(event_timestamp)
+                print 'move of directory completed.'
+                return
+
+        for root, dirs, files in os.walk(e.dest_path):
+            for filename in files:
+                dest_path = os.path.join(root, filename)
+                self.on_moved(FileMovedEvent(e.src_path + dest_path[len(e.dest_path):], dest_path))
+
+    def on_dir_deleted(self, e):
+        """
+        Manage the delete event of a directory, deleting it on the server with a single request.
+        The files are handled one at a time if the directory is inside the shared folder or if the server
+        can't delete it.
+        :param e: event object with information about what has happened
+        """
+        print 'start delete of directory:', e.src_path
+        rel_path = self.relativize_path(e.src_path)
+        self.file_index.remove(rel_path)
+        paths = self._dir_paths(self.client_snapshot, rel_path)
+
+        if paths and not self._is_shared_file(rel_path):
+            response = self.conn_mng.dispatch_request('delete', {'filepath': rel_path})
+            if response['successful']:
+                for path in paths:
+                    self.client_snapshot.pop(path)
+                self.update_local_dir_state(response['content']['server_timestamp'])
+                print 'Delete of directory completed.'
+                return
+
+        paths.extend(self._dir_paths(self.shared_snapshot, rel_path))
+        if paths:
+            self.on_files_deleted([FileDeletedEvent(self.absolutize_path(path)) for path in paths])
+
+    def _dir_paths(self, snapshot, rel_path):
+        """
+        Return the paths of the snapshot inside the directory <rel_path>.
+        """
+        prefix = rel_path + '/'
+        return [path for path in snapshot if path.startswith(prefix)]
+
+    def on_files_deleted(self, events):
+        """
+        Manage a group of delete events (e.g. of the files of a removed folder) sending the deletes to the server
+        with a single batch request, or one at a time if the server doesn't support batches.
+        :param events: list of file deleted event objects
+        """
+        print 'start delete of {} files'.format(len(events))
+        rel_paths = [self.relativize_path(e.src_path) for e in events]
+        with self.file_index.batch():
+            for rel_path in rel_paths:
+                self.file_index.remove(rel_path)
+        to_delete = [rel_path for rel_path in rel_paths if not self._is_shared_file(rel_path)]
+
+        if len(to_delete) > 1:
+            operations = [{'action': 'delete', 'filepath': rel_path} for rel_path in to_delete]
+            response = self.conn_mng.dispatch_request('batch', {'operations': operations})
+            if response['successful']:
+                event_timestamp = response['content']['server_timestamp']
+                for rel_path in to_delete:
+                    if self.client_snapshot.pop(rel_path, 'ERROR') == 'ERROR':
+                        print 'WARNING inconsistency error during delete operation!' \
+                              'Impossible to find the following file in stored data (client_snapshot):\n', rel_path
+                self.update_local_dir_state(event_timestamp)
+                print 'Delete of {} files completed.'.format(len(to_delete))
+                # only the shared files are left
+                deleted = set(to_delete)
+                events = [e for e, rel_path in zip(events, rel_paths) if rel_path not in deleted]
+            elif not response.get('unsupported'):
+                self.stop(1, response['content'])
+
+        for e in events:
+            self.on_deleted(e)
+
+    def on_events_queued(self, events):
+        """
+        Hash in advance, at the same time, the files created or modified by a burst of queued events
+        (e.g. a folder copied in the sharing folder), before the events are handled one at a time.
+        :param events: list of event objects
+        """
+        def prehash(file_path):
+            try:
+                file_stat = os.stat(file_path)
+                return FileIndex.signature(file_stat), Hasher.md5(file_path)
+            except (OSError, IOError):
+                return None
+
+        file_paths = [e.src_path for e in events
+                      if not e.is_directory and e.event_type in (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED)]
+        self._prehashed = {}
+        if len(file_paths) > 1:
+            for file_path, prehashed in self.hasher.imap(prehash, file_paths):
+                if prehashed is not None:
+                    self._prehashed[file_path] = prehashed
+
+    def on_events_lost(self, event):
+        """
+        Manage the loss of the events of the sharing folder (i.e. the inotify event queue overflowed):
+        the main loop is woken up to scan it again, so that the scan never overlaps a synchronization.
+        :param event: EventsLostEvent object
+        """
+        print 'Events of "{}" lost, scanning it again.'.format(event.src_path)
+        os.write(self.events_lost_write_fd, '!')
+
+    def rescan(self):
+        """
+        Scan again the sharing folder after its events have been lost (to be called by the main loop when
+        events_lost_read_fd is readable), and synchronize it with the server, as done at startup.
+        """
+        os.read(self.events_lost_read_fd, 4096)
+        self.build_client_snapshot()
+        self.sync_with_server()
+
     def _get_cmdmanager_request(self, socket):
         """
         Communicate with cmd_manager and get the request
@@ -911,8 +1550,17 @@ class Daemon(FileSystemEventHandler):
 
     def create_observer(self):
         """
-        Create an instance of the watchdog Observer thread class.
+        Create an instance of the watchdog Observer thread class, watching the sharing folder
+        with inotify if configured and available, otherwise polling it.
         """
+        if self.cfg.get('observer', Daemon.DEF_OBSERVER) == Daemon.OBSERVER_INOTIFY and InotifyEmitter is not None:
+            self.observer = SkipObserver(InotifyEmitter)
+            try:
+                self.observer.schedule(self, path=self.cfg['sharing_path'], recursive=True)
+                return
+            except OSError as e:
+                # i.e. the max number of inotify watches (fs.inotify.max_user_watches) is reached
+                print 'Impossible to watch the sharing folder with inotify ({}), polling it.'.format(e)
         self.observer = SkipObserver()
         self.observer.schedule(self, path=self.cfg['sharing_path'], recursive=True)
 
@@ -975,17 +1623,30 @@ class Daemon(FileSystemEventHandler):
         self.listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.listener_socket.bind((self.cfg['cmd_address'], self.cfg['cmd_port']))
         self.listener_socket.listen(BACKLOG_LISTENER_SOCK)
-        r_list = [self.listener_socket]
+        r_list = [self.listener_socket, self.events_lost_read_fd]
         self.daemon_state = 'started'
         self.running = 1
         polling_counter = 0
         try:
             while self.running:
+                if self.cfg.get('activate') and self.changes_listener is None and \
+                        self.cfg.get('sync_mode', Daemon.DEF_SYNC_MODE) == Daemon.SYNC_MODE_LONGPOLL:
+                    self.changes_listener = ChangesListener(self.conn_mng, Daemon.LONG_POLL_WAIT)
+                    self.changes_listener.start()
+                    r_list.append(self.changes_listener)
+
                 r_ready, w_ready, e_ready = select.select(r_list, [], [], TIMEOUT_LISTENER_SOCK)
 
                 for s in r_ready:
 
-                    if s == self.listener_socket:
+                    if s == self.changes_listener:
+                        # the server snapshot changed
+                        self.changes_listener.pop_notifications()
+                        self.sync_with_server()
+                    elif s == self.events_lost_read_fd:
+                        # the events of the sharing folder have been lost
+                        self.rescan()
+                    elif s == self.listener_socket:
                         # handle the server socket
                         client_socket, client_address = self.listener_socket.accept()
                         r_list.append(client_socket)
@@ -1026,8 +1687,8 @@ class Daemon(FileSystemEventHandler):
                             s.close()
                             r_list.remove(s)
 
-                if self.cfg.get('activate'):
-                    # synchronization polling
+                if self.cfg.get('activate') and not (self.changes_listener and self.changes_listener.supported):
+                    # synchronization polling (if the server can't notify the changes)
                     # makes the polling every 3 seconds, so it waits six cycle (0.5 * 6 = 3 seconds)
                     # maybe optimizable but now functional
                     polling_counter += 1
@@ -1037,6 +1698,8 @@ class Daemon(FileSystemEventHandler):
 
         except KeyboardInterrupt:
             self.stop(0)
+        if self.changes_listener:
+            self.changes_listener.stop()
         if self.cfg.get('activate'):
             self.observer.stop()
             self.observer.join()
@@ -1097,7 +1760,7 @@ class Daemon(FileSystemEventHandler):
         """
 
         self.local_dir_state['last_timestamp'] = last_timestamp
-        self.local_dir_state['global_md5'] = self.md5_of_client_snapshot()
+        self.local_dir_state['root_hash'] = self.md5_of_client_snapshot()
         self.save_local_dir_state()
 
     def save_local_dir_state(self):
@@ -1110,64 +1773,87 @@ class Daemon(FileSystemEventHandler):
     def load_local_dir_state(self):
         """
         Load local dir state on self.local_dir_state variable
-        if file doesn't exists it will be created without timestamp
+        if file doesn't exists it will be created without timestamp.
+        A local_dir_state saved in the old format (with the 'global_md5' of the sorted snapshot instead of
+        the 'root_hash') is rewritten in the new one.
         """
 
         def _rebuild_local_dir_state():
-            self.local_dir_state = {'last_timestamp': 0, 'global_md5': self.md5_of_client_snapshot()}
+            self.local_dir_state = {'last_timestamp': 0, 'root_hash': self.md5_of_client_snapshot()}
             json.dump(self.local_dir_state, open(self.cfg['local_dir_state_path'], 'w'), indent=4)
 
         if os.path.isfile(self.cfg['local_dir_state_path']):
             self.local_dir_state = json.load(open(self.cfg['local_dir_state_path'], 'r'))
             print 'Loaded local_dir_state'
+            if 'root_hash' not in self.local_dir_state:
+                self._migrate_local_dir_state()
         else:
             print 'local_dir_state not found. Initialize new local_dir_state'
             _rebuild_local_dir_state()
 
-    def md5_of_client_snapshot(self, verbose=0):
+    def _migrate_local_dir_state(self):
         """
-        Calculate the md5 of the entire directory snapshot,
-        with the md5 in client_snapshot and the md5 of full filepath string.
-        :return is the md5 hash of the directory
+        Rewrite the old format local_dir_state in the new one: if the snapshot doesn't match the old global md5,
+        the directory has been modified, so no root hash is stored (it's stored with the next update).
         """
+        global_md5 = self.local_dir_state.pop('global_md5', None)
+        if global_md5 == self._legacy_md5_of_client_snapshot():
+            self.local_dir_state['root_hash'] = self.md5_of_client_snapshot()
+        else:
+            self.local_dir_state['root_hash'] = None
+        self.save_local_dir_state()
 
-        if verbose:
-            start = time.time()
+    def _legacy_md5_of_client_snapshot(self):
+        """
+        Return the global md5 of the old format local_dir_state: the md5 of the md5s and the paths
+        of client_snapshot, sorted by path.
+        """
         md5hash = hashlib.md5()
-
         for path, time_md5 in sorted(self.client_snapshot.iteritems()):
-            # extract md5 from tuple. we don't need hexdigest it's already md5
-            if verbose:
-                print path
             md5hash.update(time_md5[1])
             md5hash.update(path)
-
-        if verbose:
-            stop = time.time()
-            print stop - start
         return md5hash.hexdigest()
 
-    def hash_file(self, file_path, chunk_size=1024):
+    def md5_of_client_snapshot(self):
         """
-        :accept an absolute file path
-        :return the md5 hash of received file
+        Return the hash of the entire directory snapshot: the root hash of the Merkle tree of client_snapshot,
+        kept up to date on each change of the snapshot.
+        :return is the md5 hash of the directory
         """
+        return self.client_snapshot.root_hash()
 
-        md5hash = hashlib.md5()
+    def hash_file(self, file_path, chunk_size=Hasher.READ_SIZE):
+        """
+        :accept an absolute file path
+        :return the md5 hash of received file (the indexed one if the file, inside the sharing folder,
+            is unchanged since it was hashed)
+        """
         try:
-            f1 = open(file_path, 'rb')
-            while 1:
-                # Read file in as little chunks
-                buf = f1.read(chunk_size)
-                if not buf:
-                    break
-                md5hash.update(buf)
-            f1.close()
-            return md5hash.hexdigest()
+            file_stat = os.stat(file_path)
+            prehashed = self._prehashed.pop(file_path, None)
+            if prehashed is not None and prehashed[0] == FileIndex.signature(file_stat):
+                return prehashed[1]
+            rel_path = None
+            if file_path.startswith(self.cfg['sharing_path'] + os.sep):
+                rel_path = self.relativize_path(file_path)
+                md5 = self.file_index.get(rel_path, file_stat)
+                if md5 is not None:
+                    return md5
+            md5 = Hasher.md5(file_path, chunk_size)
+            if rel_path is not None:
+                self.file_index.set(rel_path, file_stat, md5)
+            return md5
         except (OSError, IOError) as e:
             print e
             return None
 
+    def hash_files(self, file_paths):
+        """
+        Hash the files (absolute paths, also given by a generator) on the hashing threads.
+        :return: generator of the (file_path, md5) pairs, in the file_paths order
+        """
+        return self.hasher.imap(self.hash_file, file_paths)
+
 
 def is_valid_file(string):
     if os.path.isfile(string) or string == DEF_CFG_FILEPATH:
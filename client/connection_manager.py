@@ -6,24 +6,93 @@
 # files:
 # - GET /files/ - ottiene la lista dei file sul server con relativi metadati necessari e/o md5
 # - GET /files/<path> - scarica un file
-# - POST /files/<path> - crea un file
+# - POST /files/<path> - crea un file (o, con i parametri md5 e size senza il file, ne reclama il contenuto
+#   se già presente sul server)
 # - PUT /files/<path> - modifica un file
 # actions:
 # - POST /actions/copy - parametri src, dest
 # - POST /actions/delete - parametro path
 # - POST /actions/move - parametri src, dest
+#   (copy, delete e move accettano anche cartelle, che vengono gestite per intero)
+# - POST /actions/batch - parametro operations (lista json di delete, copy e move applicate insieme)
 # ---------
 # shares:
 # - POST /shares/<root_path>/<user> - crea (se necessario) lo share, e l’utente che “vede” la condivisione
 # - DELETE /shares/<root_path> - elimina del tutto lo share
 # - DELETE /shares/<root_path>/<user> - elimina l’utente dallo share
+# changes:
+# - GET /changes - attende (long polling) le modifiche successive al parametro since, per al massimo wait secondi
+# uploads:
+# - POST /uploads/ - inizia un upload a blocchi, parametro size
+# - GET /uploads/<upload_id> - stato dell'upload (blocchi ricevuti)
+# - PUT /uploads/<upload_id> - invia un blocco, parametri offset, md5
+# - DELETE /uploads/<upload_id> - annulla l'upload
+#   l'upload completo viene salvato con POST o PUT /files/<path>, parametri upload_id, md5
+# bundles:
+# - POST /bundles/upload - crea o modifica i file contenuti nell'archivio tar inviato (con l'md5 di ogni file)
+# - POST /bundles/download - parametro paths (lista json), scarica i file richiesti in un unico archivio tar
+#   (con l'md5 di ogni file); i file troppo grandi sono esclusi e vanno scaricati con GET /files/<path>
+# signatures:
+# - GET /signatures/<path> - md5 dei blocchi del file, per inviare con PUT /files/<path> solo i blocchi modificati
+# hashes:
+# - GET /hashes/ e GET /hashes/<path> - hash della cartella (albero di Merkle) e hash/md5 delle sue voci, per
+#   confrontare con il client solo le cartelle diverse
 
 import requests
+from requests.auth import AuthBase, _basic_auth_str
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import urllib
 import json
 import os
+import shutil
+import hashlib
+import threading
+import tempfile
+import tarfile
+import io
 import logging
 import keyring
+from multiprocessing.pool import ThreadPool
+
+
+class SessionAuth(AuthBase):
+    """
+    Requests authentication handler that sends the server session token as basic auth password,
+    instead of the real password, as soon as the server gives one (in the SESSION_TOKEN_HEADER response header).
+    If the token is refused (i.e. expired or server restarted) the request is sent again with the real password.
+    """
+    SESSION_TOKEN_HEADER = 'X-Session-Token'
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.token = None
+
+    def __call__(self, r):
+        r.headers['Authorization'] = _basic_auth_str(self.username, self.token or self.password)
+        r.register_hook('response', self.handle_response)
+        return r
+
+    def handle_response(self, r, **kwargs):
+        """
+        Store the new session token, if any, and retry with the password if the token has been refused.
+        """
+        if r.status_code == 401 and self.token and self.password is not None:
+            self.token = None
+            # Consume content and release the original connection to allow our new request to reuse the same one.
+            r.content
+            r.close()
+            prep = r.request.copy()
+            prep.headers['Authorization'] = _basic_auth_str(self.username, self.password)
+            _r = r.connection.send(prep, **kwargs)
+            _r.history.append(r)
+            _r.request = prep
+            r = _r
+        token = r.headers.get(self.SESSION_TOKEN_HEADER)
+        if token:
+            self.token = token
+        return r
 
 
 class ConnectionManager(object):
@@ -35,6 +104,38 @@ class ConnectionManager(object):
                           requests.exceptions.MissingSchema,
                         )
 
+    # Default max number of kept-alive connections to the server (cfg 'http_pool_size')
+    DEF_HTTP_POOL_SIZE = 10
+    # Default number of retries of the requests failed to connect or answered with RETRY_STATUSES (cfg 'http_retries')
+    DEF_HTTP_RETRIES = 3
+    RETRY_STATUSES = (502, 503, 504)
+    # Retries wait RETRY_BACKOFF_FACTOR * 2 ** (retry number - 1) seconds
+    RETRY_BACKOFF_FACTOR = 0.5
+
+    # Seconds to wait for a change notification response, beyond the requested waiting time
+    LONG_POLL_TIMEOUT_MARGIN = 10
+    # Bytes written at a time by the downloads
+    DOWNLOAD_CHUNK_SIZE = 2 ** 16
+    # Size of the byte ranges in which the downloads are split (and resumed)
+    DOWNLOAD_RANGE_SIZE = 2 ** 23
+    # Max number of byte ranges of a file downloaded at the same time
+    DOWNLOAD_THREADS = 4
+    # Files bigger than this are uploaded in chunks of this size (resumed if the upload fails)
+    UPLOAD_CHUNK_SIZE = 2 ** 23
+    # Max number of chunks of a file uploaded at the same time
+    UPLOAD_THREADS = 4
+    # Modified files smaller than this are uploaded whole, without checking which blocks changed
+    DELTA_MIN_SIZE = 2 ** 20
+    # Files smaller than this are uploaded without first trying to claim their content already in the server
+    CLAIM_MIN_SIZE = 2 ** 16
+    # Files up to this size are uploaded in bundles (tar archives of many files sent with a single request)
+    BUNDLE_FILE_MAX_SIZE = 2 ** 16
+    # Max size and number of files of an upload bundle
+    BUNDLE_MAX_SIZE = 2 ** 23
+    BUNDLE_MAX_FILES = 1000
+    # Pax header of the bundle entries with the md5 of the entry content
+    BUNDLE_MD5_HEADER = 'PYBOX.md5'
+
     def __init__(self, cfg, logging_level=logging.ERROR):
         self.load_cfg(cfg)
 
@@ -67,7 +168,12 @@ class ConnectionManager(object):
         :param cfg: Dictionary where is contained the configuration
         """
         self.cfg = cfg
-        self.auth = (self.cfg.get('user'), keyring.get_password('PyBox', self.cfg.get('user', '')))
+        user, password = self.cfg.get('user'), keyring.get_password('PyBox', self.cfg.get('user', ''))
+        auth = getattr(self, 'auth', None)
+        # Keep the current session token if the credentials are the same.
+        if not (auth and auth.username == user and auth.password == password):
+            self.auth = SessionAuth(user, password)
+            self.reset_server_snapshot()
 
         # example of self.base_url = 'http://localhost:5000/API/V1/'
         self.base_url = ''.join([self.cfg['server_address'], self.cfg['api_suffix']])
@@ -75,6 +181,37 @@ class ConnectionManager(object):
         self.actions_url = ''.join([self.base_url, 'actions/'])
         self.shares_url = ''.join([self.base_url, 'shares/'])
         self.users_url = ''.join([self.base_url, 'users/'])
+        self.changes_url = ''.join([self.base_url, 'changes'])
+        self.uploads_url = ''.join([self.base_url, 'uploads/'])
+        self.bundles_url = ''.join([self.base_url, 'bundles/'])
+        self.signatures_url = ''.join([self.base_url, 'signatures/'])
+        self.hashes_url = ''.join([self.base_url, 'hashes/'])
+
+        # All the requests share a pool of kept-alive connections to the server, replaced if the server changes.
+        session_cfg = (self.cfg['server_address'],
+                       self.cfg.get('http_pool_size', ConnectionManager.DEF_HTTP_POOL_SIZE),
+                       self.cfg.get('http_retries', ConnectionManager.DEF_HTTP_RETRIES))
+        if getattr(self, 'session_cfg', None) != session_cfg:
+            if getattr(self, 'session', None):
+                self.session.close()
+            self.session = self._make_session(*session_cfg[1:])
+            self.session_cfg = session_cfg
+
+    def _make_session(self, pool_size, retries):
+        """
+        Return a requests session with a pool of <pool_size> connections, that retries the requests
+        failed to connect (and the idempotent ones answered with RETRY_STATUSES) up to <retries> times.
+        The other failures, i.e. the read timeouts of the change notifications, are not retried.
+        :param pool_size: int
+        :param retries: int
+        """
+        session = requests.Session()
+        retry = Retry(total=retries, read=0, backoff_factor=ConnectionManager.RETRY_BACKOFF_FACTOR,
+                      status_forcelist=ConnectionManager.RETRY_STATUSES, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def dispatch_request(self, command, args=None):
         method_name = ''.join(['do_', command])
@@ -89,9 +226,13 @@ class ConnectionManager(object):
         user = data[0]
         password = data[1]
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_login', url, data))
+        auth = SessionAuth(user, password)
         try:
-            r = requests.get(encoded_url, auth=(user, password))
+            r = self.session.get(encoded_url, auth=auth)
             r.raise_for_status()
+            # From now on use the logged user credentials, and its session token given by the server
+            self.auth = auth
+            self.reset_server_snapshot()
             return {'content': 'User authenticated', 'successful': True}
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_login', url, e))
@@ -107,7 +248,7 @@ class ConnectionManager(object):
         self.logger.info('do_register: URL: {} - DATA: {} '.format(url, data))
 
         try:
-            r = requests.post(encoded_url, data=req)
+            r = self.session.post(encoded_url, data=req)
             # i must check before raise_for_status to not destroy response
             if r.status_code == 403:
                 return {'improvements': json.loads(r.text), 'successful': False}
@@ -129,7 +270,7 @@ class ConnectionManager(object):
         self.logger.info('do_activate: URL: {} - DATA: {} '.format(url, data))
 
         try:
-            r = requests.put(encoded_url, data=req)
+            r = self.session.put(encoded_url, data=req)
             if r.status_code == 404:
                 return {'content': 'Error! Impossible to activate user! Unexistent user!', 'successful': False}
             elif r.status_code == 409:
@@ -148,7 +289,7 @@ class ConnectionManager(object):
         url = '{}{}/reset'.format(self.users_url, mail)
         encoded_url = urllib.quote(url, ConnectionManager.ENCODER_FILTER)
         try:
-            r = requests.post(encoded_url)
+            r = self.session.post(encoded_url)
             r.raise_for_status()
             return r.text
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
@@ -162,9 +303,9 @@ class ConnectionManager(object):
         url = '{}{}'.format(self.users_url, mail)
         encoded_url = urllib.quote(url, ConnectionManager.ENCODER_FILTER)
         try:
-            r = requests.put(encoded_url,
-                             data={'password': new_password,
-                                   'recoverpass_code': recoverpass_code})
+            r = self.session.put(encoded_url,
+                                 data={'password': new_password,
+                                       'recoverpass_code': recoverpass_code})
             r.raise_for_status()
             return r.text
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
@@ -181,7 +322,7 @@ class ConnectionManager(object):
         self.logger.info('do_addshare: URL: {}'.format(url))
 
         try:
-            r = requests.post(url, auth=self.auth)
+            r = self.session.post(url, auth=self.auth)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('do_addshare: URL: {} - EXCEPTION_CATCHED: {} '.format(url, e))
@@ -198,7 +339,7 @@ class ConnectionManager(object):
         self.logger.info('do_removeshare: URL: {}'.format(url))
 
         try:
-            r = requests.delete(url, auth=self.auth)
+            r = self.session.delete(url, auth=self.auth)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('do_removeshare: URL: {} - EXCEPTION_CATCHED: {} '.format(url, e))
@@ -215,7 +356,7 @@ class ConnectionManager(object):
         self.logger.info('do_removeshareduser: URL: {}'.format(url))
 
         try:
-            r = requests.delete(url, auth=self.auth)
+            r = self.session.delete(url, auth=self.auth)
             r.raise_for_status()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('do_removedshareduser: URL: {} - EXCEPTION_CATCHED: {} '.format(url, e))
@@ -225,38 +366,286 @@ class ConnectionManager(object):
 
     # files
 
+    def _transfer_path(self, dirname, filepath):
+        """
+        Return the path, in the <dirname> directory beside the local dir state (outside the sharing folder),
+        where the transfer of filepath is kept until it's completed.
+        :param dirname: str
+        :param filepath: str (path relative to the sharing folder)
+        :return: str
+        """
+        transfers_dir = os.path.join(os.path.dirname(self.cfg['local_dir_state_path']), dirname)
+        if not os.path.isdir(transfers_dir):
+            os.makedirs(transfers_dir)
+        if isinstance(filepath, unicode):
+            filepath = filepath.encode('utf-8')
+        return os.path.join(transfers_dir, hashlib.md5(filepath).hexdigest())
+
+    def _partial_download_paths(self, filepath):
+        """
+        Return the paths of the partially downloaded file and of its download state.
+        :param filepath: str (path relative to the sharing folder)
+        :return: tuple
+        """
+        part_path = self._transfer_path('downloads', filepath) + '.part'
+        return part_path, part_path + '.json'
+
+    def _write_response(self, r, part_path, offset=None):
+        """
+        Write the streamed content of the response r in the file part_path, at the given offset
+        or overwriting it if offset is None.
+        """
+        with open(part_path, 'wb' if offset is None else 'r+b') as f:
+            if offset is not None:
+                f.seek(offset)
+            written = 0
+            for chunk in r.iter_content(ConnectionManager.DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+        expected = r.headers.get('Content-Length')
+        if expected is not None and written != int(expected):
+            raise IOError('Incomplete download: {} of {} bytes received'.format(written, expected))
+
+    def _download_to_part(self, url, part_path, state_path):
+        """
+        Download the file at url to part_path, resuming the download described in state_path, if any.
+        If the server supports range requests the file is downloaded in DOWNLOAD_RANGE_SIZE byte ranges,
+        more of them at the same time, and the downloaded ranges are recorded in state_path.
+        Return False if the file has been changed on the server while it was downloaded.
+        :return: bool
+        """
+        state = None
+        if os.path.isfile(part_path) and os.path.isfile(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+            except ValueError:
+                state = None
+
+        if state is None:
+            r = self.session.get(url, auth=self.auth, stream=True,
+                                 headers={'Range': 'bytes=0-{}'.format(self.DOWNLOAD_RANGE_SIZE - 1)})
+            try:
+                r.raise_for_status()
+                if r.status_code != 206 or not r.headers.get('ETag'):
+                    # Range requests are not supported: the whole file is sent.
+                    self._write_response(r, part_path)
+                    return True
+                length = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+                state = {'etag': r.headers['ETag'], 'length': length, 'done': []}
+                with open(part_path, 'wb') as f:
+                    f.truncate(length)
+                self._write_response(r, part_path, 0)
+            finally:
+                r.close()
+            state['done'].append(0)
+            with open(state_path, 'w') as f:
+                json.dump(state, f)
+
+        state_lock = threading.Lock()
+
+        def download_range(start):
+            end = min(start + self.DOWNLOAD_RANGE_SIZE, state['length']) - 1
+            r = self.session.get(url, auth=self.auth, stream=True,
+                                 headers={'Range': 'bytes={}-{}'.format(start, end), 'If-Range': state['etag']})
+            try:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    return False
+                self._write_response(r, part_path, start)
+            finally:
+                r.close()
+            with state_lock:
+                state['done'].append(start)
+                with open(state_path, 'w') as f:
+                    json.dump(state, f)
+            return True
+
+        missing = [start for start in xrange(0, state['length'], self.DOWNLOAD_RANGE_SIZE)
+                   if start not in state['done']]
+        if not missing:
+            return True
+        pool = ThreadPool(min(len(missing), self.DOWNLOAD_THREADS))
+        try:
+            return all(pool.map(download_range, missing))
+        finally:
+            pool.close()
+            pool.join()
+
     def do_download(self, data):
         url = ''.join([self.files_url, data['filepath']])
         encoded_url = urllib.quote(url, ConnectionManager.ENCODER_FILTER)
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_download', url, data))
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        if os.path.exists(filepath):
+            return {'content': 'Warning! Download of file already existent! Operation Aborted.', 'successful': False}
+
+        # The file content is streamed to a partial file, never loaded in memory,
+        # and a failed download is resumed by the next one.
+        part_path, state_path = self._partial_download_paths(data['filepath'])
         try:
-            r = requests.get(encoded_url, auth=self.auth)
-            r.raise_for_status()
-        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+            completed = self._download_to_part(encoded_url, part_path, state_path)
+            if not completed:
+                # The file has been changed on the server since the partial download: start again.
+                os.remove(state_path)
+                completed = self._download_to_part(encoded_url, part_path, state_path)
+        except (requests.exceptions.RequestException, IOError) as e:
             self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_download', url, e))
             return {'content': 'Failed to download file from server.\n'
                                'Path: {}\nError: {}'.format(data['filepath'], e),
                     'successful': False}
-        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        if not completed:
+            return {'content': 'Failed to download file from server.\n'
+                               'Path: {}\nError: file changed during the download'.format(data['filepath']),
+                    'successful': False}
+
         dirpath, filename = os.path.split(filepath)
         # Create all missing directories
         if not os.path.isdir(dirpath):
             os.makedirs(dirpath)
-        if not os.path.exists(filepath):
-            with open(filepath, 'wb') as f:
-                f.write(r.content)
-                return {'successful': True}
-        else:
-            return {'content': 'Warning! Download of file already existent! Operation Aborted.', 'successful': False}
+        shutil.move(part_path, filepath)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return {'successful': True}
 
-    def do_upload(self, data):
+    def _upload_chunks(self, data):
+        """
+        Upload the file in UPLOAD_CHUNK_SIZE chunks, more of them at the same time, resuming
+        the previous upload of the same file content if any.
+        Return the upload state {'upload_id': str, 'md5': str, 'size': int} and the path where it's kept
+        until the upload is committed, or None if the server doesn't support chunked uploads.
+        :return: tuple
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        size = os.path.getsize(filepath)
+        state_path = self._transfer_path('uploads', data['filepath']) + '.json'
+        received = None
+        if os.path.isfile(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+            except ValueError:
+                state = {}
+            if state.get('md5') == data['md5'] and state.get('size') == size:
+                r = self.session.get(''.join([self.uploads_url, state['upload_id']]), auth=self.auth)
+                if r.status_code == 200:
+                    received = r.json()['received']
+        if received is None:
+            r = self.session.post(self.uploads_url, auth=self.auth, data={'size': size})
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            state = {'upload_id': r.json()['upload_id'], 'md5': data['md5'], 'size': size}
+            received = []
+            with open(state_path, 'w') as f:
+                json.dump(state, f)
+
+        url = ''.join([self.uploads_url, state['upload_id']])
+
+        def upload_chunk(offset):
+            with open(filepath, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read(self.UPLOAD_CHUNK_SIZE)
+            r = self.session.put(url, auth=self.auth, data=chunk,
+                                 params={'offset': offset, 'md5': hashlib.md5(chunk).hexdigest()},
+                                 headers={'Content-Type': 'application/octet-stream'})
+            r.raise_for_status()
+
+        received_offsets = set(offset for offset, length in received)
+        missing = [offset for offset in xrange(0, size, self.UPLOAD_CHUNK_SIZE) if offset not in received_offsets]
+        if missing:
+            pool = ThreadPool(min(len(missing), self.UPLOAD_THREADS))
+            try:
+                pool.map(upload_chunk, missing)
+            finally:
+                pool.close()
+                pool.join()
+        return state, state_path
+
+    def _send_file(self, method, url, data):
+        """
+        Send the file with the given method (self.session.post or self.session.put) and return the response.
+        Files bigger than UPLOAD_CHUNK_SIZE are uploaded in chunks, then committed sending the upload_id.
+        """
+        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        chunked_upload = None
+        if os.path.getsize(filepath) > self.UPLOAD_CHUNK_SIZE:
+            chunked_upload = self._upload_chunks(data)
+        if chunked_upload is None:
+            with open(filepath, 'rb') as f:
+                return method(url, auth=self.auth, files={'file': f}, data={'md5': data['md5']})
+        state, state_path = chunked_upload
+        r = method(url, auth=self.auth, data={'md5': data['md5'], 'upload_id': state['upload_id']})
+        # Forget the upload if it has been committed or refused (i.e. the file changed while it was uploaded).
+        if r.status_code != 404 and not 500 <= r.status_code < 600:
+            os.remove(state_path)
+        return r
+
+    def _claim_file(self, method, url, data):
+        """
+        Claim the file content, if the server already has it, sending only its md5 and size
+        with the given method (self.session.post or self.session.put).
+        Return the response, or None if the file has to be sent.
+        """
+        size = os.path.getsize(os.path.join(self.cfg['sharing_path'], data['filepath']))
+        if size < self.CLAIM_MIN_SIZE:
+            return None
+        r = method(url, auth=self.auth, data={'md5': data['md5'], 'size': size})
+        # 400 is returned by the servers that don't support claims.
+        if r.status_code in (400, 404):
+            return None
+        return r
+
+    def _send_delta(self, url, data):
+        """
+        Send only the blocks of the modified file that aren't in the server file, getting the server file
+        signature (the md5 of its blocks). Return the response, or None if the whole file has to be sent.
+        """
         filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
+        if os.path.getsize(filepath) < self.DELTA_MIN_SIZE:
+            return None
+        signature_url = urllib.quote(''.join([self.signatures_url, data['filepath']]), ConnectionManager.ENCODER_FILTER)
+        r = self.session.get(signature_url, auth=self.auth)
+        if r.status_code != 200:
+            return None
+        signature = r.json()
+        server_blocks = {}
+        for index, block_md5 in enumerate(signature['blocks']):
+            server_blocks.setdefault(block_md5, index)
+
+        # Each block of the file is the index of the same server block, or None if it's sent.
+        delta = []
+        new_blocks = tempfile.TemporaryFile()
+        try:
+            with open(filepath, 'rb') as f:
+                while True:
+                    block = f.read(signature['block_size'])
+                    if not block:
+                        break
+                    index = server_blocks.get(hashlib.md5(block).hexdigest())
+                    if index is None:
+                        new_blocks.write(block)
+                    delta.append(index)
+            if all(index is None for index in delta):
+                return None
+            new_blocks.seek(0)
+            r = self.session.put(url, auth=self.auth, files={'file': ('blocks', new_blocks)},
+                                 data={'md5': data['md5'], 'base_md5': signature['md5'], 'delta': json.dumps(delta)})
+        finally:
+            new_blocks.close()
+        if r.status_code == 409:
+            # The server file has been changed meanwhile.
+            return None
+        return r
+
+    def do_upload(self, data):
         url = ''.join([self.files_url, data['filepath']])
         encoded_url = urllib.quote(url, ConnectionManager.ENCODER_FILTER)
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_upload', url, data))
-        _file = {'file': (open(filepath, 'rb'))}
         try:
-            r = requests.post(encoded_url, auth=self.auth, files=_file, data={'md5': data['md5']})
+            r = self._claim_file(self.session.post, encoded_url, data)
+            if r is None:
+                r = self._send_file(self.session.post, encoded_url, data)
             r.raise_for_status()
             return {'content': r.json(), 'successful': True}
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
@@ -266,13 +655,15 @@ class ConnectionManager(object):
                     'successful': False}
 
     def do_modify(self, data):
-        filepath = os.path.join(self.cfg['sharing_path'], data['filepath'])
         url = ''.join([self.files_url, data['filepath']])
         encoded_url = urllib.quote(url, ConnectionManager.ENCODER_FILTER)
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_modify', url, data))
-        _file = {'file': (open(filepath, 'rb'))}
         try:
-            r = requests.put(encoded_url, auth=self.auth, files=_file, data={'md5': data['md5']})
+            r = self._claim_file(self.session.put, encoded_url, data)
+            if r is None:
+                r = self._send_delta(encoded_url, data)
+            if r is None:
+                r = self._send_file(self.session.put, encoded_url, data)
             r.raise_for_status()
             return {'content': r.json(), 'successful': True}
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
@@ -281,6 +672,141 @@ class ConnectionManager(object):
                                'Path: {}\nError: {}'.format(data['filepath'], e),
                     'successful': False}
 
+    def do_upload_bundle(self, data):
+        """
+        Upload (create or modify) the small files data['files'] ([{'cmd': 'upload' or 'modify', 'filepath': <path>,
+        'md5': <md5>}, ...]) grouping them in bundles of at most BUNDLE_MAX_FILES files and BUNDLE_MAX_SIZE bytes.
+        If the server doesn't support bundles the files are uploaded one at a time.
+        """
+        url = ''.join([self.bundles_url, 'upload'])
+        self.logger.info('{}: URL: {} - FILES: {} '.format('do_upload_bundle', url, len(data['files'])))
+        server_timestamp = 0
+        for files in self._group_bundle_files(data['files']):
+            try:
+                r = self.session.post(url, auth=self.auth, data=self._make_bundle(files),
+                                      headers={'Content-Type': 'application/x-tar'})
+                if r.status_code == 404:
+                    response = self._upload_one_at_a_time(files)
+                    if not response['successful']:
+                        return response
+                    server_timestamp = max(server_timestamp, response['content']['server_timestamp'])
+                    continue
+                r.raise_for_status()
+                server_timestamp = max(server_timestamp, r.json()['server_timestamp'])
+            except ConnectionManager.EXCEPTIONS_CATCHED + (IOError, OSError) as e:
+                self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_upload_bundle', url, e))
+                return {'content': 'Failed to upload {} files to the server.\n'
+                                   'Error: {}'.format(len(files), e),
+                        'successful': False}
+        return {'content': {'server_timestamp': server_timestamp}, 'successful': True}
+
+    def _group_bundle_files(self, files):
+        """
+        Split the files in groups of at most BUNDLE_MAX_FILES files and BUNDLE_MAX_SIZE bytes.
+        """
+        group, group_size = [], 0
+        for f in files:
+            size = os.path.getsize(os.path.join(self.cfg['sharing_path'], f['filepath']))
+            if group and (len(group) == self.BUNDLE_MAX_FILES or group_size + size > self.BUNDLE_MAX_SIZE):
+                yield group
+                group, group_size = [], 0
+            group.append(f)
+            group_size += size
+        if group:
+            yield group
+
+    def _make_bundle(self, files):
+        """
+        Return the tar archive of the files, with their md5 as the BUNDLE_MD5_HEADER pax header of the entries.
+        """
+        bundle = io.BytesIO()
+        tar = tarfile.open(fileobj=bundle, mode='w', format=tarfile.PAX_FORMAT, encoding='utf-8')
+        for f in files:
+            filepath = f['filepath']
+            if isinstance(filepath, unicode):
+                filepath = filepath.encode('utf-8')
+            with open(os.path.join(self.cfg['sharing_path'], f['filepath']), 'rb') as fp:
+                entry = tar.gettarinfo(arcname=filepath, fileobj=fp)
+                entry.pax_headers = {ConnectionManager.BUNDLE_MD5_HEADER: unicode(f['md5'])}
+                tar.addfile(entry, fp)
+        tar.close()
+        return bundle.getvalue()
+
+    def do_download_bundle(self, data):
+        """
+        Download the files data['filepaths'] with a single request, unpacking the tar archive sent by the server
+        while it's received. Each file is written beside the local dir state and checked against the md5
+        of its entry before being moved in the sharing folder.
+        The files left out of the archive (the big ones) or that fail the md5 check, and all of them if
+        the server doesn't support bundles, aren't downloaded: they are returned in content['left_out'],
+        to be downloaded one at a time.
+        """
+        url = ''.join([self.bundles_url, 'download'])
+        self.logger.info('{}: URL: {} - FILES: {} '.format('do_download_bundle', url, len(data['filepaths'])))
+        missing = set(data['filepaths'])
+        try:
+            r = self.session.post(url, auth=self.auth, data={'paths': json.dumps(data['filepaths'])}, stream=True)
+            try:
+                if r.status_code != 404:
+                    r.raise_for_status()
+                    r.raw.decode_content = True
+                    for filepath in self._unpack_bundle(r.raw, missing):
+                        missing.discard(filepath)
+            finally:
+                r.close()
+        except ConnectionManager.EXCEPTIONS_CATCHED + (IOError, OSError, tarfile.TarError) as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_download_bundle', url, e))
+            return {'content': 'Failed to download {} files from server.\n'
+                               'Error: {}'.format(len(data['filepaths']), e),
+                    'successful': False}
+
+        return {'content': {'left_out': [filepath for filepath in data['filepaths'] if filepath in missing]},
+                'successful': True}
+
+    def _unpack_bundle(self, stream, filepaths):
+        """
+        Read the tar archive from stream, moving the entries in the sharing folder, and yield their paths.
+        The entries whose content doesn't match their md5 are skipped.
+        :param filepaths: set of the requested paths (the only entries accepted)
+        """
+        bundle = tarfile.open(fileobj=stream, mode='r|', encoding='utf-8')
+        for entry in bundle:
+            filepath = entry.name.decode('utf-8')
+            if not entry.isfile() or filepath not in filepaths:
+                raise tarfile.TarError('Unexpected bundle entry: {}'.format(filepath))
+            part_path = self._transfer_path('downloads', filepath) + '.bundle'
+            md5 = hashlib.md5()
+            content = bundle.extractfile(entry)
+            with open(part_path, 'wb') as f:
+                while True:
+                    chunk = content.read(ConnectionManager.DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    f.write(chunk)
+            dest_path = os.path.join(self.cfg['sharing_path'], filepath)
+            if md5.hexdigest() != entry.pax_headers.get(ConnectionManager.BUNDLE_MD5_HEADER) \
+                    or os.path.exists(dest_path):
+                os.remove(part_path)
+                continue
+            if not os.path.isdir(os.path.dirname(dest_path)):
+                os.makedirs(os.path.dirname(dest_path))
+            shutil.move(part_path, dest_path)
+            yield filepath
+
+    def _upload_one_at_a_time(self, files):
+        """
+        Upload the files of a bundle with a request for each file (for the servers without bundles).
+        """
+        server_timestamp = 0
+        for f in files:
+            data = {'filepath': f['filepath'], 'md5': f['md5']}
+            response = self.do_modify(data) if f['cmd'] == 'modify' else self.do_upload(data)
+            if not response['successful']:
+                return response
+            server_timestamp = max(server_timestamp, response['content']['server_timestamp'])
+        return {'content': {'server_timestamp': server_timestamp}, 'successful': True}
+
     # actions:
 
     def do_move(self, data):
@@ -288,7 +814,7 @@ class ConnectionManager(object):
         d = {'src': data['src'], 'dst': data['dst']}
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_move', url, data))
         try:
-            r = requests.post(url, auth=self.auth, data=d)
+            r = self.session.post(url, auth=self.auth, data=d)
             r.raise_for_status()
             return {'content': r.json(), 'successful': True}
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
@@ -302,7 +828,7 @@ class ConnectionManager(object):
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_delete', url, data))
         d = {'filepath': data['filepath']}
         try:
-            r = requests.post(url, auth=self.auth, data=d)
+            r = self.session.post(url, auth=self.auth, data=d)
             r.raise_for_status()
             return {'content': r.json(), 'successful': True}
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
@@ -316,7 +842,7 @@ class ConnectionManager(object):
         d = {'src': data['src'], 'dst': data['dst']}
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_copy', url, data))
         try:
-            r = requests.post(url, auth=self.auth, data=d)
+            r = self.session.post(url, auth=self.auth, data=d)
             r.raise_for_status()
             return {'content': r.json(), 'successful': True}
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
@@ -325,17 +851,126 @@ class ConnectionManager(object):
                                'Src path: {}\nDest Path: {}\nError: {}'.format(data['src'], data['dst'], e),
                     'successful': False}
 
+    def do_batch(self, data):
+        """
+        Apply the list of delete/copy/move operations data['operations'] with a single request, e.g.
+        [{'action': 'delete', 'filepath': <path>}, {'action': 'move', 'src': <path>, 'dst': <path>}].
+        If the server doesn't support batches the response contains 'unsupported': True.
+        """
+        url = ''.join([self.actions_url, 'batch'])
+        self.logger.info('{}: URL: {} - OPERATIONS: {} '.format('do_batch', url, len(data['operations'])))
+        try:
+            r = self.session.post(url, auth=self.auth, data={'operations': json.dumps(data['operations'])})
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_batch', url, e))
+            unsupported = isinstance(e, requests.HTTPError) and e.response.status_code == 404
+            return {'content': 'Failed to apply {} operations on server.\n'
+                               'Error: {}'.format(len(data['operations']), e),
+                    'successful': False,
+                    'unsupported': unsupported}
+
+    def reset_server_snapshot(self):
+        """
+        Forget the cached server snapshot: the next do_get_server_snapshot will get the whole one.
+        """
+        # Last server snapshot, updated with the deltas given by the server
+        self.server_snapshot = None
+        # Server change timestamp of the cached snapshot (None if the server doesn't support deltas)
+        self.changelog_timestamp = None
+        # Server entity tag of the cached snapshot
+        self.snapshot_etag = None
+
     def do_get_server_snapshot(self, data):
+        """
+        Get the server snapshot. After the first request only the changes made in the meantime are asked
+        to the server, and applied to the cached snapshot. If nothing changed the server just answers
+        304 Not Modified, according to the snapshot entity tag.
+        """
         url = self.files_url
         self.logger.info('{}: URL: {} - DATA: {} '.format('do_get_server_snapshot', url, data))
 
+        headers = {}
+        if self.server_snapshot is not None and self.snapshot_etag:
+            headers['If-None-Match'] = self.snapshot_etag
         try:
-            r = requests.get(url, auth=self.auth)
+            r = self.session.get(url, auth=self.auth, params={'since': self.changelog_timestamp or 0}, headers=headers)
             r.raise_for_status()
-            return {'content': r.json(), 'successful': True}
+            if r.status_code != 304:
+                snapshot = r.json()
         except ConnectionManager.EXCEPTIONS_CATCHED as e:
             self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_get_server_snapshot', url, e))
             return {'content': 'Failed to get server snapshot, maybe server down?\nError: {}'.format(e), 'successful': False}
 
+        if r.status_code == 304:
+            self.logger.debug('do_get_server_snapshot: snapshot not modified')
+            return {'content': self._copy_server_snapshot(), 'successful': True}
+
+        self.snapshot_etag = r.headers.get('ETag')
+        self.changelog_timestamp = snapshot.pop('changelog_timestamp', None)
+        delta = snapshot.pop('delta', None)
+        if self.changelog_timestamp is None:
+            # The server doesn't give deltas
+            self.server_snapshot = snapshot
+        elif delta is not None and self.server_snapshot is not None:
+            for key, changes in delta.iteritems():
+                paths = self.server_snapshot.setdefault(key, {})
+                for path, value in changes.iteritems():
+                    if value is None:
+                        paths.pop(path, None)
+                    else:
+                        paths[path] = value
+            self.server_snapshot['server_timestamp'] = snapshot['server_timestamp']
+        else:
+            self.server_snapshot = snapshot
+        return {'content': self._copy_server_snapshot(), 'successful': True}
+
+    def _copy_server_snapshot(self):
+        """
+        Return a copy of the cached server snapshot: it must not be changed by the caller.
+        """
+        return dict((key, dict(value) if isinstance(value, dict) else value)
+                    for key, value in self.server_snapshot.iteritems())
+
+    def do_get_dir_hashes(self, data):
+        """
+        Get the hash of the server directory data['dirpath'] ('' for the root) and of its entries:
+        {'hash': '<hash>', 'entries': {'<name>': ['<f (file) or d (directory)>', '<md5 or hash>'], ...}}
+        """
+        dirpath = data['dirpath']
+        if isinstance(dirpath, unicode):
+            dirpath = dirpath.encode('utf-8')
+        url = ''.join([self.hashes_url, dirpath])
+        encoded_url = urllib.quote(url, ConnectionManager.ENCODER_FILTER)
+        self.logger.info('{}: URL: {} - DATA: {} '.format('do_get_dir_hashes', url, data))
+        try:
+            r = self.session.get(encoded_url, auth=self.auth)
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED + (ValueError,) as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_get_dir_hashes', url, e))
+            return {'content': 'Failed to get directory hashes.\nError: {}'.format(e), 'successful': False}
+
+    def do_wait_changes(self, data):
+        """
+        Wait for the server notification of changes made after the data['since'] change timestamp,
+        for at most data['wait'] seconds (long polling).
+        If the server doesn't support change notifications the response contains 'unsupported': True.
+        """
+        url = self.changes_url
+        self.logger.info('{}: URL: {} - DATA: {} '.format('do_wait_changes', url, data))
+        try:
+            r = self.session.get(url, auth=self.auth, params={'since': data['since'], 'wait': data['wait']},
+                                 timeout=data['wait'] + ConnectionManager.LONG_POLL_TIMEOUT_MARGIN)
+            r.raise_for_status()
+            return {'content': r.json(), 'successful': True}
+        except ConnectionManager.EXCEPTIONS_CATCHED + (requests.exceptions.Timeout,) as e:
+            self.logger.error('{}: URL: {} - EXCEPTION_CATCHED: {} '.format('do_wait_changes', url, e))
+            unsupported = isinstance(e, requests.HTTPError) and e.response.status_code == 404
+            return {'content': 'Failed to wait for server changes.\nError: {}'.format(e),
+                    'successful': False,
+                    'unsupported': unsupported}
+
     def _default(self, method):
         print 'Received Unknown Command:', method
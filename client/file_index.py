@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class FileIndex(object):
+    """
+    Persistent index of the md5 of the files of the sharing folder, stored in a sqlite database
+    with the stat signature (size, mtime in nanoseconds and inode) of each file when it was hashed:
+    a file is hashed again only if its signature changed.
+    Paths are relative to the sharing folder. The index can be used by more threads.
+    """
+    # Files modified less than this seconds before being hashed aren't indexed, since a following change
+    # in the same mtime tick could leave the signature unchanged.
+    RACY_INTERVAL = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.RLock()
+        # Nesting level of the batch() blocks: changes are committed when leaving the outermost one
+        self._batch_level = 0
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                              'path TEXT PRIMARY KEY, '
+                              'size INTEGER NOT NULL, '
+                              'mtime_ns INTEGER NOT NULL, '
+                              'inode INTEGER NOT NULL, '
+                              'md5 TEXT NOT NULL)')
+
+    @staticmethod
+    def signature(file_stat):
+        """
+        Return the stat signature (size, mtime_ns, inode) of a file.
+        """
+        return file_stat.st_size, int(file_stat.st_mtime * 10 ** 9), file_stat.st_ino
+
+    @staticmethod
+    def _text(path):
+        if isinstance(path, bytes):
+            return path.decode('utf-8')
+        return path
+
+    @contextmanager
+    def batch(self):
+        """
+        Write all the changes made in the block (also by other threads) with a single transaction.
+        """
+        with self._lock:
+            self._batch_level += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batch_level -= 1
+                if not self._batch_level:
+                    self.conn.commit()
+
+    def _commit(self):
+        if not self._batch_level:
+            self.conn.commit()
+
+    def get(self, path, file_stat):
+        """
+        Return the indexed md5 of the file, or None if it isn't indexed or its stat signature changed.
+        :param path: str
+        :param file_stat: os.stat() result of the file
+        :return: str
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT size, mtime_ns, inode, md5 FROM files WHERE path = ?',
+                                    (self._text(path),)).fetchone()
+        if row is None or tuple(row[:3]) != self.signature(file_stat):
+            return None
+        return row[3]
+
+    def set(self, path, file_stat, md5):
+        """
+        Index the md5 of the file, hashed after getting its file_stat.
+        """
+        with self._lock:
+            if time.time() - file_stat.st_mtime < FileIndex.RACY_INTERVAL:
+                self.conn.execute('DELETE FROM files WHERE path = ?', (self._text(path),))
+            else:
+                self.conn.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, md5) '
+                                  'VALUES (?, ?, ?, ?, ?)', (self._text(path),) + self.signature(file_stat) + (md5,))
+            self._commit()
+
+    def remove(self, path):
+        """
+        Remove the file, or all the files of the directory, at path from the index.
+        """
+        path = self._text(path)
+        with self._lock:
+            self.conn.execute('DELETE FROM files WHERE path = ? OR substr(path, 1, ?) = ?',
+                              (path, len(path) + 1, path + '/'))
+            self._commit()
+
+    def move(self, src_path, dest_path):
+        """
+        Move the index entries of the file, or of all the files of the directory, at src_path to dest_path.
+        """
+        src_path, dest_path = self._text(src_path), self._text(dest_path)
+        with self._lock:
+            self.conn.execute('DELETE FROM files WHERE path = ? OR substr(path, 1, ?) = ?',
+                              (dest_path, len(dest_path) + 1, dest_path + '/'))
+            self.conn.execute('UPDATE files SET path = ? || substr(path, ?) '
+                              'WHERE path = ? OR substr(path, 1, ?) = ?',
+                              (dest_path, len(src_path) + 1, src_path, len(src_path) + 1, src_path + '/'))
+            self._commit()
+
+    def prune(self, paths):
+        """
+        Remove from the index the files that aren't in paths (i.e. deleted while the daemon wasn't running).
+        """
+        paths = set(self._text(path) for path in paths)
+        with self._lock:
+            stale = [(path,) for path, in self.conn.execute('SELECT path FROM files') if path not in paths]
+            self.conn.executemany('DELETE FROM files WHERE path = ?', stale)
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import time
+import errno
+import select
+import ctypes
+from collections import OrderedDict
+
+from watchdog.events import FileSystemEvent, FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, \
+    FileMovedEvent, DirCreatedEvent, DirDeletedEvent, DirMovedEvent
+from watchdog.observers.api import EventEmitter, DEFAULT_EMITTER_TIMEOUT
+from watchdog.observers.inotify_c import inotify_init, inotify_add_watch, inotify_rm_watch, \
+    InotifyConstants, Inotify, DEFAULT_EVENT_BUFFER_SIZE
+from watchdog.utils import unicode_paths
+
+
+class EventsLostEvent(FileSystemEvent):
+    """
+    Some events of the src_path directory tree have been lost: the tree has to be scanned again.
+    """
+    event_type = 'events_lost'
+    is_directory = True
+
+
+class InotifyEmitter(EventEmitter):
+    """
+    inotify(7) based event emitter, with a watch on each directory of the watched tree.
+    Differently from the watchdog one:
+    - the created and modified files are reported once, when they are closed after writing
+      (the links, that aren't written, when they are created);
+    - the IN_MOVED_FROM and IN_MOVED_TO events are paired by cookie, and a move from (to) outside
+      the tree is reported as a delete (create) once MOVE_PAIRING_DELAY seconds are passed;
+    - the watches of the subdirectories of a moved directory follow it;
+    - if the kernel event queue overflows an EventsLostEvent of the whole tree is queued.
+    The inotify instance and the watches are created by the constructor, so an OSError
+    (e.g. watch limit reached) is raised when the directory is scheduled.
+    """
+    # Seconds an IN_MOVED_FROM event waits for the matching IN_MOVED_TO event
+    MOVE_PAIRING_DELAY = 0.5
+    EVENT_MASK = (InotifyConstants.IN_CREATE |
+                  InotifyConstants.IN_CLOSE_WRITE |
+                  InotifyConstants.IN_DELETE |
+                  InotifyConstants.IN_MOVED_FROM |
+                  InotifyConstants.IN_MOVED_TO |
+                  InotifyConstants.IN_ONLYDIR |
+                  InotifyConstants.IN_DONT_FOLLOW)
+
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT):
+        EventEmitter.__init__(self, event_queue, watch, timeout)
+        self._path_for_wd = {}
+        # IN_MOVED_FROM events waiting for their IN_MOVED_TO: {cookie: (path, is_directory, time)}
+        self._moved_from = OrderedDict()
+        # Files created and not closed yet
+        self._created = set()
+        self._root = unicode_paths.encode(watch.path)
+        self._fd = inotify_init()
+        if self._fd == -1:
+            self._raise_error()
+        try:
+            self._add_watches(self._root)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def run(self):
+        try:
+            EventEmitter.run(self)
+        finally:
+            os.close(self._fd)
+
+    def queue_events(self, timeout):
+        if self._moved_from:
+            timeout = min(timeout, self.MOVE_PAIRING_DELAY)
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            try:
+                event_buffer = os.read(self._fd, DEFAULT_EVENT_BUFFER_SIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    return
+                raise
+            for wd, mask, cookie, name in Inotify._parse_event_buffer(event_buffer):
+                self._handle_event(wd, mask, cookie, name)
+        self._flush_moved_from(time.time() - self.MOVE_PAIRING_DELAY)
+
+    def _handle_event(self, wd, mask, cookie, name):
+        if mask & InotifyConstants.IN_Q_OVERFLOW:
+            # The lost events may include the creation of directories, that aren't watched yet.
+            self._add_watches(self._root, ignore_errors=True)
+            self.queue_event(EventsLostEvent(self.watch.path))
+            return
+        dirpath = self._path_for_wd.get(wd)
+        if dirpath is None:
+            # Event of a removed watch
+            return
+        if mask & InotifyConstants.IN_IGNORED:
+            del self._path_for_wd[wd]
+            return
+
+        path = os.path.join(dirpath, name) if name else dirpath
+        is_directory = bool(mask & InotifyConstants.IN_ISDIR)
+        if mask & InotifyConstants.IN_CREATE:
+            if is_directory:
+                self._queue_created_dir(path)
+            elif self._is_written_file(path):
+                self._created.add(path)
+            else:
+                self.queue_event(FileCreatedEvent(self._decode(path)))
+        elif mask & InotifyConstants.IN_CLOSE_WRITE:
+            if path in self._created:
+                self._created.remove(path)
+                self.queue_event(FileCreatedEvent(self._decode(path)))
+            else:
+                self.queue_event(FileModifiedEvent(self._decode(path)))
+        elif mask & InotifyConstants.IN_DELETE:
+            self._queue_deleted(path, is_directory)
+        elif mask & InotifyConstants.IN_MOVED_FROM:
+            self._moved_from[cookie] = (path, is_directory, time.time())
+        elif mask & InotifyConstants.IN_MOVED_TO:
+            moved_from = self._moved_from.pop(cookie, None)
+            if moved_from is None:
+                # Moved in from outside the tree
+                if is_directory:
+                    self._queue_created_dir(path)
+                else:
+                    self.queue_event(FileCreatedEvent(self._decode(path)))
+                return
+            src_path = moved_from[0]
+            if is_directory:
+                self._rename_watches(src_path, path)
+                self.queue_event(DirMovedEvent(self._decode(src_path), self._decode(path)))
+            elif src_path in self._created:
+                # Not reported yet: it will be reported as created, with the new path, when closed.
+                self._created.remove(src_path)
+                self._created.add(path)
+            else:
+                self.queue_event(FileMovedEvent(self._decode(src_path), self._decode(path)))
+
+    @staticmethod
+    def _is_written_file(path):
+        """
+        Return True if the created file is a new regular file, whose IN_CLOSE_WRITE event will follow,
+        False for the files created without writing them (symbolic links, hard links, special files).
+        """
+        try:
+            file_stat = os.lstat(path)
+        except OSError:
+            # Already removed: the IN_DELETE event follows, and nothing is reported.
+            return True
+        return stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink == 1
+
+    def _flush_moved_from(self, before):
+        """
+        Report as deleted the paths moved (outside the tree) before the given time without an IN_MOVED_TO event.
+        """
+        for cookie, (path, is_directory, moved_time) in self._moved_from.items():
+            if moved_time > before:
+                break
+            del self._moved_from[cookie]
+            if is_directory:
+                self._remove_watches(path)
+            self._queue_deleted(path, is_directory)
+
+    def _queue_deleted(self, path, is_directory):
+        if is_directory:
+            self.queue_event(DirDeletedEvent(self._decode(path)))
+        elif path in self._created:
+            # Never reported as created
+            self._created.remove(path)
+        else:
+            self.queue_event(FileDeletedEvent(self._decode(path)))
+
+    def _queue_created_dir(self, path):
+        """
+        Watch the new directory and report it with its content, that may have been created
+        before the watch.
+        """
+        self.queue_event(DirCreatedEvent(self._decode(path)))
+        if not self.watch.is_recursive:
+            return
+        self._add_watch(path, ignore_errors=True)
+        for dirpath, dirnames, filenames in os.walk(path):
+            for dirname in dirnames:
+                subdir_path = os.path.join(dirpath, dirname)
+                if not os.path.islink(subdir_path):
+                    self._add_watch(subdir_path, ignore_errors=True)
+                self.queue_event(DirCreatedEvent(self._decode(subdir_path)))
+            for filename in filenames:
+                self.queue_event(FileCreatedEvent(self._decode(os.path.join(dirpath, filename))))
+
+    def _add_watches(self, path, ignore_errors=False):
+        self._add_watch(path, ignore_errors)
+        if self.watch.is_recursive:
+            for dirpath, dirnames, _ in os.walk(path):
+                for dirname in dirnames:
+                    subdir_path = os.path.join(dirpath, dirname)
+                    if not os.path.islink(subdir_path):
+                        self._add_watch(subdir_path, ignore_errors)
+
+    def _add_watch(self, path, ignore_errors=False):
+        """
+        :param ignore_errors: bool if False an OSError is raised when the directory can't be watched,
+            unless it doesn't exist anymore
+        """
+        wd = inotify_add_watch(self._fd, path, InotifyEmitter.EVENT_MASK)
+        if wd == -1:
+            if ignore_errors or ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                return
+            self._raise_error()
+        self._path_for_wd[wd] = path
+
+    def _rename_watches(self, src_path, dest_path):
+        for wd, path in self._path_for_wd.items():
+            if path == src_path or path.startswith(src_path + os.sep):
+                self._path_for_wd[wd] = dest_path + path[len(src_path):]
+        for path in [path for path in self._created if path.startswith(src_path + os.sep)]:
+            self._created.remove(path)
+            self._created.add(dest_path + path[len(src_path):])
+
+    def _remove_watches(self, dirpath):
+        for wd, path in self._path_for_wd.items():
+            if path == dirpath or path.startswith(dirpath + os.sep):
+                inotify_rm_watch(self._fd, wd)
+                del self._path_for_wd[wd]
+
+    def _decode(self, path):
+        """
+        Return the path as the watch one: unicode if the watched path is unicode.
+        """
+        if isinstance(self.watch.path, bytes):
+            return path
+        return unicode_paths.decode(path)
+
+    @staticmethod
+    def _raise_error():
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
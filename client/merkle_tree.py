@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+
+FILE_ENTRY = 'f'
+DIR_ENTRY = 'd'
+EMPTY_HASH = '0' * 32
+
+
+def entry_hash(kind, name, digest):
+    """
+    Return (as an integer) the hash of a directory entry: a file with the given md5 (kind FILE_ENTRY)
+    or a directory with the given hash (kind DIR_ENTRY).
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return int(hashlib.md5(kind + name + '\0' + digest).hexdigest(), 16)
+
+
+def dir_hash(entry_hashes):
+    """
+    Return the hash of a directory from the hashes of its entries: their xor, so adding, removing or changing
+    an entry only needs the old and the new hash of that entry.
+    """
+    result = 0
+    for value in entry_hashes:
+        result ^= value
+    return '%032x' % result
+
+
+class MerkleSnapshot(dict):
+    """
+    Snapshot of files {'<filepath>': ['<timestamp>', '<md5>']} that keeps the hash of each directory of the
+    path hierarchy (a Merkle tree), updated on each change of the snapshot in O(depth of the path).
+    Two snapshots have the same root_hash() (and directories the same dir_hash()) if they have the same
+    paths with the same md5s: the timestamps aren't considered.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self._lock = threading.RLock()
+        # {'<dirpath>': [<xor of the entry hashes>, {'<name>': (<kind>, '<digest>')}]}, the root dirpath is ''
+        self._dirs = {}
+        self.update(*args, **kwargs)
+
+    @staticmethod
+    def _text(path):
+        if isinstance(path, bytes):
+            return path.decode('utf-8')
+        return path
+
+    def _update_tree(self, path, old_md5, new_md5):
+        """
+        Replace the md5 of the file at path (None if it isn't/wasn't there) in the hashes of its directories.
+        """
+        parts = self._text(path).split('/')
+        kind, old_digest, new_digest = FILE_ENTRY, old_md5, new_md5
+        while parts and old_digest != new_digest:
+            name = parts.pop()
+            dirpath = '/'.join(parts)
+            node = self._dirs.setdefault(dirpath, [0, {}])
+            old_dir_digest = '%032x' % node[0] if node[1] else None
+            if old_digest is not None:
+                node[0] ^= entry_hash(kind, name, old_digest)
+                del node[1][name]
+            if new_digest is not None:
+                node[0] ^= entry_hash(kind, name, new_digest)
+                node[1][name] = (kind, new_digest)
+            if node[1]:
+                new_dir_digest = '%032x' % node[0]
+            else:
+                del self._dirs[dirpath]
+                new_dir_digest = None
+            kind, old_digest, new_digest = DIR_ENTRY, old_dir_digest, new_dir_digest
+
+    def __setitem__(self, path, value):
+        with self._lock:
+            old_value = dict.get(self, path)
+            dict.__setitem__(self, path, value)
+            self._update_tree(path, old_value[1] if old_value is not None else None, value[1])
+
+    def __delitem__(self, path):
+        with self._lock:
+            old_value = dict.pop(self, path)
+            self._update_tree(path, old_value[1], None)
+
+    def pop(self, path, *default):
+        with self._lock:
+            if path not in self:
+                return dict.pop(self, path, *default)
+            old_value = dict.pop(self, path)
+            self._update_tree(path, old_value[1], None)
+            return old_value
+
+    def popitem(self):
+        with self._lock:
+            path, old_value = dict.popitem(self)
+            self._update_tree(path, old_value[1], None)
+            return path, old_value
+
+    def setdefault(self, path, default=None):
+        with self._lock:
+            if path not in self:
+                self[path] = default
+            return self[path]
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            for path, value in dict(*args, **kwargs).iteritems():
+                self[path] = value
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._dirs.clear()
+
+    def copy(self):
+        return MerkleSnapshot(self)
+
+    def root_hash(self):
+        """
+        Return the hash of the whole snapshot.
+        """
+        return self.dir_hash('')
+
+    def dir_hash(self, dirpath):
+        """
+        Return the hash of the directory at dirpath ('' for the root), or None if there isn't any file in it.
+        """
+        with self._lock:
+            node = self._dirs.get(self._text(dirpath))
+            if node is None:
+                return EMPTY_HASH if dirpath == '' else None
+            return '%032x' % node[0]
+
+    def dir_entries(self, dirpath):
+        """
+        Return the entries of the directory at dirpath: {'<name>': ('<kind>', '<md5 or directory hash>')}
+        where kind is FILE_ENTRY or DIR_ENTRY.
+        """
+        with self._lock:
+            node = self._dirs.get(self._text(dirpath))
+            return dict(node[1]) if node is not None else {}
+
+    def differing_files(self, other):
+        """
+        Return the paths of the files that are only in one of the snapshots, or that have a different md5,
+        descending only into the directories whose hashes differ.
+        :param other: MerkleSnapshot
+        :return: list
+        """
+        result = []
+        pending = ['']
+        while pending:
+            dirpath = pending.pop()
+            if self.dir_hash(dirpath) == other.dir_hash(dirpath):
+                continue
+            entries, other_entries = self.dir_entries(dirpath), other.dir_entries(dirpath)
+            for name in set(entries).union(other_entries):
+                entry, other_entry = entries.get(name), other_entries.get(name)
+                if entry == other_entry:
+                    continue
+                path = '/'.join((dirpath, name)) if dirpath else name
+                # The same name can be a file in a snapshot and a directory in the other one
+                kinds = set(e[0] for e in (entry, other_entry) if e is not None)
+                if DIR_ENTRY in kinds:
+                    pending.append(path)
+                if FILE_ENTRY in kinds:
+                    result.append(path)
+        return result
@@ -7,11 +7,14 @@ import os
 import shutil
 import json
 import time
+import select
 
 import client_daemon
 import tstutils
 
 from contextlib import contextmanager
+from watchdog.events import FileModifiedEvent
+from merkle_tree import MerkleSnapshot
 
 
 TEST_DIR = os.path.join(os.environ['HOME'], 'daemon_test')
@@ -396,23 +399,22 @@ class TestClientDaemonDirState(unittest.TestCase):
         :return:
         """
         self.daemon.client_snapshot = base_dir_tree.copy()
+        self.assertIsInstance(self.daemon.client_snapshot, MerkleSnapshot)
+        self.assertEqual(MerkleSnapshot(base_dir_tree).root_hash(), self.daemon.md5_of_client_snapshot())
 
-        md5hash = hashlib.md5()
-
-        for path, time_md5 in sorted(self.daemon.client_snapshot.iteritems()):
-            # extract md5 from tuple. we don't need hexdigest it's already md5
-            md5hash.update(time_md5[1])
-            md5hash.update(path)
-
-        self.daemon.md5_of_client_snapshot()
-        self.assertEqual(md5hash.hexdigest(), self.daemon.md5_of_client_snapshot())
+        # The hash is updated on each change of the snapshot, and doesn't depend on the timestamps
+        path, (timestamp, md5) = sorted(base_dir_tree.items())[0]
+        self.daemon.client_snapshot[path] = [timestamp, '0' * 32]
+        self.assertNotEqual(MerkleSnapshot(base_dir_tree).root_hash(), self.daemon.md5_of_client_snapshot())
+        self.daemon.client_snapshot[path] = [timestamp + 1, md5]
+        self.assertEqual(MerkleSnapshot(base_dir_tree).root_hash(), self.daemon.md5_of_client_snapshot())
 
     def test_is_directory_not_modified(self):
         self.daemon.client_snapshot = base_dir_tree.copy()
         self.daemon.update_local_dir_state(timestamp_generator())
-        old_global_md5 = self.daemon.local_dir_state['global_md5']
+        old_global_md5 = self.daemon.local_dir_state['root_hash']
         is_dir_modified_result = self.daemon._is_directory_modified()
-        test_md5 = self.daemon.local_dir_state['global_md5']
+        test_md5 = self.daemon.local_dir_state['root_hash']
 
         self.assertFalse(is_dir_modified_result)
         self.assertEqual(old_global_md5, test_md5)
@@ -440,11 +442,41 @@ class TestClientDaemonDirState(unittest.TestCase):
         self.daemon.update_local_dir_state(time_stamp)
         self.daemon.load_local_dir_state()
 
-        self.assertEqual(self.daemon.local_dir_state['global_md5'], self.daemon.md5_of_client_snapshot(),
+        self.assertEqual(self.daemon.local_dir_state['root_hash'], self.daemon.md5_of_client_snapshot(),
                          msg="The global_md5 i save is the save i load")
         self.assertEqual(self.daemon.local_dir_state['last_timestamp'], time_stamp,
                          msg="The timestamp i save is the save i load")
 
+    def _save_legacy_local_dir_state(self, global_md5):
+        with open(self.daemon.cfg['local_dir_state_path'], 'w') as f:
+            json.dump({'last_timestamp': 10, 'global_md5': global_md5}, f)
+
+    def test_load_legacy_local_dir_state(self):
+        """
+        Test LOCAL_DIR_STATE: the old format state of an unmodified directory is rewritten with its root hash
+        """
+        self.daemon.client_snapshot = MerkleSnapshot(base_dir_tree)
+        self._save_legacy_local_dir_state(self.daemon._legacy_md5_of_client_snapshot())
+        self.daemon.load_local_dir_state()
+
+        self.assertFalse(self.daemon._is_directory_modified())
+        expected = {'last_timestamp': 10, 'root_hash': self.daemon.md5_of_client_snapshot()}
+        self.assertEqual(self.daemon.local_dir_state, expected)
+        self.assertEqual(json.load(open(self.daemon.cfg['local_dir_state_path'])), expected)
+
+    def test_load_legacy_local_dir_state_of_modified_directory(self):
+        """
+        Test LOCAL_DIR_STATE: the old format state of a modified directory is rewritten as modified
+        """
+        self.daemon.client_snapshot = MerkleSnapshot(base_dir_tree)
+        self._save_legacy_local_dir_state(self.daemon._legacy_md5_of_client_snapshot())
+        self.daemon.client_snapshot['new_file.txt'] = [1, '0' * 32]
+        self.daemon.load_local_dir_state()
+
+        self.assertTrue(self.daemon._is_directory_modified())
+        self.assertEqual(json.load(open(self.daemon.cfg['local_dir_state_path'])),
+                         {'last_timestamp': 10, 'root_hash': None})
+
 
 class TestClientDaemonActions(unittest.TestCase):
     def setUp(self):
@@ -452,14 +484,12 @@ class TestClientDaemonActions(unittest.TestCase):
         create_base_dir_tree()
         self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
         self.daemon.operation_happened = 'initial'
-        self.daemon.create_observer()
-        self.daemon.observer.start()
+        # Not started: the tests call the event handlers themselves, a live observer would call them concurrently
+        self.daemon.observer = client_daemon.SkipObserver()
 
     def tearDown(self):
         global base_dir_tree
         base_dir_tree = {}
-        self.daemon.observer.stop()
-        self.daemon.observer.join()
         destroy_folder()
 
     ####################### TEST MOVE and COPY ON CLIENT ##############################
@@ -498,7 +528,7 @@ class TestClientDaemonActions(unittest.TestCase):
 
         # Initialize local_dir_state
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp - 5
-        self.daemon.local_dir_state['global_md5'] = md5_before_copy
+        self.daemon.local_dir_state['root_hash'] = md5_before_copy
 
         file_to_be_move_not_exists = 'i_do_not_exist.txt'
         dst_file_that_not_exists = 'fake2/move_file1.txt'
@@ -509,7 +539,7 @@ class TestClientDaemonActions(unittest.TestCase):
 
         # if copy fail local dir state must be unchanged
         self.assertEqual(self.daemon.local_dir_state['last_timestamp'], server_timestamp - 5)
-        self.assertEqual(self.daemon.local_dir_state['global_md5'], md5_before_copy)
+        self.assertEqual(self.daemon.local_dir_state['root_hash'], md5_before_copy)
 
     def test_make_move_function(self):
         """
@@ -546,7 +576,7 @@ class TestClientDaemonActions(unittest.TestCase):
 
         # Initialize local_dir_state
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp - 5
-        self.daemon.local_dir_state['global_md5'] = self.daemon.md5_of_client_snapshot()
+        self.daemon.local_dir_state['root_hash'] = self.daemon.md5_of_client_snapshot()
 
         file_to_be_move_not_exists = 'i_do_not_exist.txt'
         dst_file_that_not_exists = 'fake2/move_file1.txt'
@@ -556,7 +586,7 @@ class TestClientDaemonActions(unittest.TestCase):
 
         # test local dir state after movement
         self.assertEqual(self.daemon.local_dir_state['last_timestamp'], server_timestamp - 5)
-        self.assertEqual(self.daemon.local_dir_state['global_md5'], self.daemon.md5_of_client_snapshot())
+        self.assertEqual(self.daemon.local_dir_state['root_hash'], self.daemon.md5_of_client_snapshot())
 
     def test_make_move_function_not_dst(self):
         """
@@ -581,14 +611,12 @@ class TestClientDaemonSync(unittest.TestCase):
         create_shared_files_dir_tree()
         self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
         self.daemon.operation_happened = 'initial'
-        self.daemon.create_observer()
-        self.daemon.observer.start()
+        # Not started: the tests call the event handlers themselves, a live observer would call them concurrently
+        self.daemon.observer = client_daemon.SkipObserver()
 
     def tearDown(self):
         global base_dir_tree
         base_dir_tree = {}
-        self.daemon.observer.stop()
-        self.daemon.observer.join()
         destroy_folder()
 
     ####################### DIRECTORY NOT MODIFIED #####################################
@@ -609,7 +637,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp < server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 4, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 4, 'root_hash': old_global_md5_client}
 
         # Added to copy of file1.txt
         timestamp_and_md5_of_copied_file = server_dir_tree.pop('file1.txt')
@@ -639,7 +667,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp < server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 4, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 4, 'root_hash': old_global_md5_client}
 
         # Added to copy of file1.txt
         timestamp_and_md5_of_copied_file = server_dir_tree['file1.txt']
@@ -666,7 +694,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client_timestamp < server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 1, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 1, 'root_hash': old_global_md5_client}
 
         # After that new file on server
         server_dir_tree.update({'new_file_on_server.txt': (server_timestamp, '98746548972341')})
@@ -694,7 +722,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # Daemon timestamp < server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 1, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 1, 'root_hash': old_global_md5_client}
 
         # After that new file on server and new on client
         self.daemon.client_snapshot.update({'new_file_on_client.txt': (server_timestamp, '321456879')})
@@ -722,7 +750,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # Daemon timestamp < server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 1, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp - 1, 'root_hash': old_global_md5_client}
 
         # After that there will be modified file on server and modified same file on client.
         # Client file have to win for time_stamp
@@ -756,7 +784,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp = server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'root_hash': old_global_md5_client}
 
         new_file_path = os.path.join(TEST_SHARING_FOLDER, 'shared/test/new_file.txt')
         event = FileFakeEvent(new_file_path)
@@ -789,7 +817,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp = server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'root_hash': old_global_md5_client}
 
         source_file_path = os.path.join(TEST_SHARING_FOLDER, 'shared/user1/file1.txt')
         dest_file_path = os.path.join(TEST_SHARING_FOLDER, 'new_file.txt')
@@ -825,7 +853,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp = server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'root_hash': old_global_md5_client}
 
         source_file_path = os.path.join(TEST_SHARING_FOLDER, 'shared/user1/file1.txt')
         dest_file_path = os.path.join(TEST_SHARING_FOLDER, 'shared/test/new_file.txt')
@@ -879,7 +907,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp = server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'root_hash': old_global_md5_client}
 
         source_file_path = os.path.join(TEST_SHARING_FOLDER, 'file1.txt')
         dest_file_path = os.path.join(TEST_SHARING_FOLDER, 'shared/test/new_file.txt')
@@ -934,7 +962,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp = server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'root_hash': old_global_md5_client}
 
         source_file_path = os.path.join(TEST_SHARING_FOLDER, 'shared/user1/file1.txt')
         event = FileFakeEvent(source_file_path)
@@ -969,7 +997,7 @@ class TestClientDaemonSync(unittest.TestCase):
         old_global_md5_client = self.daemon.md5_of_client_snapshot()
 
         # client timestamp = server_timestamp
-        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'global_md5': old_global_md5_client}
+        self.daemon.local_dir_state = {'last_timestamp': server_timestamp, 'root_hash': old_global_md5_client}
 
         source_file_path = os.path.join(TEST_SHARING_FOLDER, 'shared/user1/file1.txt')
         event = FileFakeEvent(source_file_path)
@@ -1005,7 +1033,7 @@ class TestClientDaemonSync(unittest.TestCase):
         # client timestamp < server timestamp
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp - 1
         # directory modified
-        self.daemon.local_dir_state['global_md5'] = 'md5diversodaquelloeffettivo'
+        self.daemon.local_dir_state['root_hash'] = 'md5diversodaquelloeffettivo'
 
         # file_timestamp < client_timestamp
         server_dir_tree.update({'new_file': (server_timestamp - 2, 'md5md6jkshkfv')})
@@ -1030,7 +1058,7 @@ class TestClientDaemonSync(unittest.TestCase):
         # server ts and client ts are the same
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp
         # directory not modified
-        self.daemon.local_dir_state['global_md5'] = self.daemon.md5_of_client_snapshot()
+        self.daemon.local_dir_state['root_hash'] = self.daemon.md5_of_client_snapshot()
 
         # dir is now modified with this two operations
         self.daemon.client_snapshot['file.txt'] = (server_timestamp - 1, '321456879')
@@ -1073,7 +1101,7 @@ class TestClientDaemonSync(unittest.TestCase):
 
         # server_ts > client_ts
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp - 5
-        self.daemon.local_dir_state['global_md5'] = self.daemon.md5_of_client_snapshot()
+        self.daemon.local_dir_state['root_hash'] = self.daemon.md5_of_client_snapshot()
 
         # function _make_move_on_client
         self.daemon._make_move_on_client = self.mock_move_on_client
@@ -1114,7 +1142,7 @@ class TestClientDaemonSync(unittest.TestCase):
 
         # server_ts > client_ts
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp - 5
-        self.daemon.local_dir_state['global_md5'] = self.daemon.md5_of_client_snapshot()
+        self.daemon.local_dir_state['root_hash'] = self.daemon.md5_of_client_snapshot()
 
         # adding file to client_snapshot so dir will be  modified
         new_file_md5 = '645987123'
@@ -1147,7 +1175,7 @@ class TestClientDaemonSync(unittest.TestCase):
 
         # server_ts > client_ts
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp - 5
-        self.daemon.local_dir_state['global_md5'] = self.daemon.md5_of_client_snapshot()
+        self.daemon.local_dir_state['root_hash'] = self.daemon.md5_of_client_snapshot()
 
         # mod same file (server has the most recent file)
         self.daemon.client_snapshot['file_test_conflicted.txt'] = (server_timestamp - 5, '321456879')
@@ -1173,7 +1201,7 @@ class TestClientDaemonSync(unittest.TestCase):
 
         # server_ts == client_ts
         self.daemon.local_dir_state['last_timestamp'] = server_timestamp
-        self.daemon.local_dir_state['global_md5'] = self.daemon.md5_of_client_snapshot()
+        self.daemon.local_dir_state['root_hash'] = self.daemon.md5_of_client_snapshot()
 
         self.assertEqual(self.daemon._sync_process(server_timestamp, server_dir_tree),
                          [])
@@ -1391,8 +1419,8 @@ def replace_conn_mng(daemon, fake):
 class TestDaemonCmdManagerConnection(unittest.TestCase):
     def setUp(self):
         self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
-        self.daemon.create_observer()
-        self.daemon.observer.start()
+        # Not started: the tests call the event handlers themselves, a live observer would call them concurrently
+        self.daemon.observer = client_daemon.SkipObserver()
         self.daemon.cfg['user'] = ''
         self.daemon.password = ''
         self.daemon.cfg['activate'] = False
@@ -1402,10 +1430,6 @@ class TestDaemonCmdManagerConnection(unittest.TestCase):
         self.daemon._initialize_observing = self.fake_initialize_observing
         self.init_observing_called = False
 
-    def tearDown(self):
-        self.daemon.observer.stop()
-        self.daemon.observer.join()
-
     def fake_initialize_observing(self):
         """
         Mocking _initialize_observing,
@@ -1619,5 +1643,555 @@ class TestDaemonCmdManagerConnection(unittest.TestCase):
         self.assertFalse(self.init_observing_called)
 
 
+class TestCoalescedDeletes(unittest.TestCase):
+    """
+    Test that the queued delete events are sent to the server with a single batch request.
+    """
+    class RecordingConnMng(object):
+        def __init__(self, responses=()):
+            self.requests = []
+            # responses of the first requests
+            self.responses = list(responses)
+
+        def dispatch_request(self, cmd, data):
+            self.requests.append((cmd, data))
+            if self.responses:
+                return self.responses.pop(0)
+            return {'content': {'server_timestamp': 10}, 'successful': True}
+
+    class RecordingHandler(object):
+        def __init__(self):
+            self.deleted = []
+            self.dispatched = []
+
+        def on_files_deleted(self, events):
+            self.deleted.append([e.src_path for e in events])
+
+        def dispatch(self, event):
+            self.dispatched.append(event)
+
+    def setUp(self):
+        create_environment()
+        create_base_dir_tree(['a.txt', 'dir/b.txt', 'dir/c.txt'])
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        self.daemon.client_snapshot = base_dir_tree.copy()
+        self.paths = [os.path.join(TEST_SHARING_FOLDER, path) for path in ('a.txt', 'dir/b.txt', 'dir/c.txt')]
+
+    def tearDown(self):
+        destroy_folder()
+
+    def test_on_files_deleted(self):
+        conn_mng = self.RecordingConnMng()
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.daemon.on_files_deleted([client_daemon.FileDeletedEvent(path) for path in self.paths])
+        self.assertEqual(conn_mng.requests, [('batch', {'operations': [
+            {'action': 'delete', 'filepath': 'a.txt'},
+            {'action': 'delete', 'filepath': 'dir/b.txt'},
+            {'action': 'delete', 'filepath': 'dir/c.txt'}]})])
+        self.assertEqual(self.daemon.client_snapshot, {})
+        self.assertEqual(self.daemon.local_dir_state['last_timestamp'], 10)
+
+    def test_on_files_deleted_unsupported(self):
+        conn_mng = self.RecordingConnMng([{'content': 'not found', 'successful': False, 'unsupported': True}])
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.daemon.on_files_deleted([client_daemon.FileDeletedEvent(path) for path in self.paths])
+        self.assertEqual([cmd for cmd, _ in conn_mng.requests], ['batch', 'delete', 'delete', 'delete'])
+        self.assertEqual(self.daemon.client_snapshot, {})
+
+    def test_observer_coalesces_deletes(self):
+        observer = client_daemon.SkipObserver()
+        handler = self.RecordingHandler()
+        watch = observer.schedule(handler, TEST_SHARING_FOLDER, recursive=True)
+        for path in self.paths:
+            observer.event_queue.put((client_daemon.FileDeletedEvent(path), watch))
+        observer.skip(self.paths[1])
+        other_event = (FileModifiedEvent(self.paths[0]), watch)
+        observer.event_queue.put(other_event)
+
+        observer.dispatch_events(observer.event_queue, 0)
+        self.assertEqual(handler.deleted, [[self.paths[0], self.paths[2]]])
+        # the next event is kept to be dispatched next
+        self.assertEqual(list(observer._pending_events), [other_event])
+        self.assertEqual(observer.event_queue.unfinished_tasks, len(self.paths) + 1)
+
+        observer.dispatch_events(observer.event_queue, 0)
+        self.assertEqual(handler.dispatched, [other_event[0]])
+        # All the events taken from the queue, coalesced ones included, are done
+        self.assertEqual(observer.event_queue.unfinished_tasks, 0)
+
+
+class TestDirectoryEvents(unittest.TestCase):
+    """
+    Test that the moved and deleted directories are handled with a single request.
+    """
+    RecordingConnMng = TestCoalescedDeletes.RecordingConnMng
+
+    def setUp(self):
+        create_environment()
+        create_base_dir_tree(['dir/a.txt', 'dir/sub/b.txt', 'dirty.txt'])
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        self.daemon.client_snapshot = base_dir_tree.copy()
+        self.src_path = os.path.join(TEST_SHARING_FOLDER, 'dir')
+        self.dest_path = os.path.join(TEST_SHARING_FOLDER, 'new')
+
+    def tearDown(self):
+        destroy_folder()
+
+    def test_dir_moved(self):
+        conn_mng = self.RecordingConnMng()
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.daemon.on_moved(client_daemon.DirMovedEvent(self.src_path, self.dest_path))
+        self.assertEqual(conn_mng.requests, [('move', {'src': 'dir', 'dst': 'new'})])
+        self.assertEqual(sorted(self.daemon.client_snapshot), ['dirty.txt', 'new/a.txt', 'new/sub/b.txt'])
+        self.assertEqual(self.daemon.client_snapshot['new/a.txt'], [10, base_dir_tree['dir/a.txt'][1]])
+
+    def test_dir_moved_file_by_file(self):
+        create_files(['new/a.txt', 'new/sub/b.txt'])
+        conn_mng = self.RecordingConnMng([{'content': 'not found', 'successful': False}])
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.daemon.on_moved(client_daemon.DirMovedEvent(self.src_path, self.dest_path))
+        self.assertEqual(sorted((cmd, data['src'], data['dst']) for cmd, data in conn_mng.requests),
+                         [('move', 'dir', 'new'), ('move', 'dir/a.txt', 'new/a.txt'),
+                          ('move', 'dir/sub/b.txt', 'new/sub/b.txt')])
+        self.assertEqual(sorted(self.daemon.client_snapshot), ['dirty.txt', 'new/a.txt', 'new/sub/b.txt'])
+
+    def test_dir_deleted(self):
+        conn_mng = self.RecordingConnMng()
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.daemon.on_deleted(client_daemon.DirDeletedEvent(self.src_path))
+        self.assertEqual(conn_mng.requests, [('delete', {'filepath': 'dir'})])
+        self.assertEqual(self.daemon.client_snapshot.keys(), ['dirty.txt'])
+
+    def test_coalesce_dir_events(self):
+        watch = object()
+        events = [(client_daemon.FileMovedEvent(os.path.join(self.src_path, 'a.txt'),
+                                                os.path.join(self.dest_path, 'a.txt')), watch),
+                  (client_daemon.FileDeletedEvent(os.path.join(TEST_SHARING_FOLDER, 'dirty.txt')), watch),
+                  (client_daemon.FileMovedEvent(os.path.join(self.src_path, 'sub/b.txt'),
+                                                os.path.join(self.dest_path, 'sub/b.txt')), watch),
+                  (client_daemon.DirMovedEvent(os.path.join(self.src_path, 'sub'),
+                                               os.path.join(self.dest_path, 'sub')), watch),
+                  (client_daemon.DirMovedEvent(self.src_path, self.dest_path), watch)]
+        coalesced = client_daemon.SkipObserver._coalesce(events)
+        self.assertEqual(coalesced, [events[4], events[1]])
+
+
+class TestBundledUploads(unittest.TestCase):
+    """
+    Test the grouping of the small files uploads, and of the downloads, during the synchronization.
+    """
+    def setUp(self):
+        create_environment()
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        create_files(['a.txt', 'b.txt', 'c.txt', 'd.txt'])
+        with open(os.path.join(TEST_SHARING_FOLDER, 'big.txt'), 'w') as f:
+            f.write('x' * (client_daemon.ConnectionManager.BUNDLE_FILE_MAX_SIZE + 1))
+
+    def tearDown(self):
+        destroy_folder()
+
+    def test_bundle_small_uploads(self):
+        commands = [('upload', 'a.txt'), ('modify', 'b.txt'), ('upload', 'big.txt'), ('delete', 'old.txt'),
+                    ('delete', 'c.txt'), ('upload', 'c.txt'), ('upload', 'd.txt')]
+        self.assertEqual(self.daemon._bundle_small_uploads(commands),
+                         [('upload', 'big.txt'), ('delete', 'old.txt'), ('delete', 'c.txt'), ('upload', 'c.txt'),
+                          ('upload_bundle', (('upload', 'a.txt'), ('modify', 'b.txt'), ('upload', 'd.txt')))])
+
+    def test_single_small_upload_not_bundled(self):
+        commands = [('upload', 'a.txt'), ('upload', 'big.txt')]
+        self.assertEqual(self.daemon._bundle_small_uploads(commands), [('upload', 'big.txt'), ('upload', 'a.txt')])
+
+    def test_run_bundle(self):
+        conn_mng = TestCoalescedDeletes.RecordingConnMng()
+        with replace_conn_mng(self.daemon, conn_mng):
+            response = self.daemon._run_sync_command('upload_bundle', (('upload', 'a.txt'), ('modify', 'b.txt')))
+        self.assertTrue(response['successful'])
+        self.assertEqual(conn_mng.requests, [('upload_bundle', {'files': [
+            {'cmd': 'upload', 'filepath': 'a.txt',
+             'md5': self.daemon.hash_file(os.path.join(TEST_SHARING_FOLDER, 'a.txt'))},
+            {'cmd': 'modify', 'filepath': 'b.txt',
+             'md5': self.daemon.hash_file(os.path.join(TEST_SHARING_FOLDER, 'b.txt'))}]})])
+
+    def test_bundle_downloads(self):
+        commands = [('download', 'x.txt'), ('upload', 'big.txt'), ('download', 'shared/pippo/y.txt'),
+                    ('delete', 'z.txt'), ('download', 'z.txt')]
+        self.assertEqual(self.daemon._bundle_downloads(commands),
+                         [('upload', 'big.txt'), ('delete', 'z.txt'), ('download', 'z.txt'),
+                          ('download_bundle', ('x.txt', 'shared/pippo/y.txt'))])
+
+    def test_single_download_not_bundled(self):
+        commands = [('download', 'x.txt'), ('upload', 'big.txt')]
+        self.assertEqual(self.daemon._bundle_downloads(commands), [('upload', 'big.txt'), ('download', 'x.txt')])
+
+    def test_sync_download_bundle(self):
+        server_snapshot = {'x.txt': ['10', 'md5x'], 'y.txt': ['10', 'md5y']}
+        shared_files = {'shared/pippo/s.txt': ['10', 'md5s']}
+        server_hashes = MerkleSnapshot(server_snapshot)
+        conn_mng = TestCoalescedDeletes.RecordingConnMng(responses=[
+            {'content': {'server_timestamp': 10, 'files': server_snapshot, 'shared_files': shared_files},
+             'successful': True},
+            {'content': {'hash': server_hashes.root_hash(), 'entries': server_hashes.dir_entries('')},
+             'successful': True},
+            # y.txt is left out of the bundle (as a big file)
+            {'content': {'left_out': ['y.txt']}, 'successful': True}])
+        self.daemon.observer = client_daemon.SkipObserver()
+        self.daemon.client_snapshot = {}
+        self.daemon.local_dir_state = {'root_hash': self.daemon.md5_of_client_snapshot(), 'last_timestamp': 0}
+        self.daemon._sync_process = lambda *args: [('download', 'x.txt'), ('download', 'y.txt'),
+                                                   ('download', 'shared/pippo/s.txt')]
+        with replace_conn_mng(self.daemon, conn_mng):
+            self.daemon.sync_with_server()
+        self.assertEqual(conn_mng.requests[2],
+                         ('download_bundle', {'filepaths': ['x.txt', 'y.txt', 'shared/pippo/s.txt']}))
+        # and then scheduled as a download by itself
+        self.assertEqual(conn_mng.requests[3:], [('download', {'filepath': 'y.txt'})])
+        self.assertEqual(self.daemon.client_snapshot, server_snapshot)
+        self.assertEqual(self.daemon.shared_snapshot, shared_files)
+
+
+class TestDirHashesSync(unittest.TestCase):
+    """
+    Test the comparison of the client snapshot with the server directory hashes during the synchronization.
+    """
+    class DirHashesConnMng(object):
+        def __init__(self, server_snapshot, successful=True):
+            self.server_hashes = MerkleSnapshot(server_snapshot)
+            self.successful = successful
+            self.requested_dirs = []
+
+        def dispatch_request(self, cmd, data):
+            assert cmd == 'get_dir_hashes'
+            self.requested_dirs.append(data['dirpath'])
+            if not self.successful:
+                return {'content': 'not found', 'successful': False}
+            return {'content': {'hash': self.server_hashes.dir_hash(data['dirpath']),
+                                'entries': dict((name, list(entry)) for name, entry
+                                                in self.server_hashes.dir_entries(data['dirpath']).iteritems())},
+                    'successful': True}
+
+    def setUp(self):
+        create_environment()
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        self.server_snapshot = {
+            'a.txt': [10, 'md5a'],
+            'dir/b.txt': [10, 'md5b'],
+            'dir/sub/c.txt': [10, 'md5c'],
+            'other/d.txt': [10, 'md5d'],
+        }
+        self.daemon.client_snapshot = dict((path, [5, md5]) for path, (_, md5) in self.server_snapshot.iteritems())
+
+    def tearDown(self):
+        destroy_folder()
+
+    def differing_files(self, conn_mng):
+        with replace_conn_mng(self.daemon, conn_mng):
+            return self.daemon._server_differing_files()
+
+    def test_same_files(self):
+        conn_mng = self.DirHashesConnMng(self.server_snapshot)
+        self.assertEqual(self.differing_files(conn_mng), [])
+        self.assertEqual(conn_mng.requested_dirs, [''])
+
+    def test_only_differing_directories_compared(self):
+        self.server_snapshot['dir/sub/c.txt'] = [11, 'new md5c']
+        self.server_snapshot['dir/server/e.txt'] = [11, 'md5e']
+        self.daemon.client_snapshot['dir/client/f.txt'] = [6, 'md5f']
+        conn_mng = self.DirHashesConnMng(self.server_snapshot)
+        self.assertEqual(sorted(self.differing_files(conn_mng)),
+                         ['dir/client/f.txt', 'dir/server/e.txt', 'dir/sub/c.txt'])
+        self.assertEqual(sorted(conn_mng.requested_dirs), ['', 'dir', 'dir/server', 'dir/sub'])
+
+        self.daemon.local_dir_state = {'last_timestamp': 10, 'root_hash': 'modified'}
+        self.assertEqual(
+            sorted(self.daemon._sync_process(10, self.server_snapshot, {}, self.differing_files(conn_mng))),
+            sorted(self.daemon._sync_process(10, self.server_snapshot, {})))
+
+    def test_hashes_not_available(self):
+        self.assertIsNone(self.differing_files(self.DirHashesConnMng(self.server_snapshot, successful=False)))
+
+
+class TestSyncScheduler(unittest.TestCase):
+    """
+    Test the concurrent execution of the synchronization commands.
+    """
+    def setUp(self):
+        self.executed = []
+        self.failing = set()
+
+    def run_command(self, command, path):
+        self.executed.append((command, path))
+        if (command, path) in self.failing:
+            return {'content': 'error', 'successful': False}
+        return {'content': {'server_timestamp': len(self.executed)}, 'successful': True}
+
+    def test_deletes_and_small_files_first(self):
+        sizes = {'big.txt': 100, 'small.txt': 1, 'medium.txt': 10}
+        commands = [('upload', 'big.txt'), ('delete', 'old.txt'), ('upload', 'small.txt'), ('modify', 'medium.txt')]
+        scheduler = client_daemon.SyncScheduler(self.run_command, 1)
+        results = list(scheduler.run(commands, lambda command, path: sizes.get(path, 0)))
+        self.assertEqual(self.executed, [('delete', 'old.txt'), ('upload', 'small.txt'),
+                                         ('modify', 'medium.txt'), ('upload', 'big.txt')])
+        self.assertEqual([(command, path) for command, path, _ in results], self.executed)
+
+    def test_same_path_in_order(self):
+        commands = [('upload', 'a.txt'), ('upload', 'b.txt'), ('modify', 'a.txt'), ('modify', 'b.txt')]
+        scheduler = client_daemon.SyncScheduler(self.run_command, 4)
+        results = list(scheduler.run(commands))
+        self.assertEqual(len(results), 4)
+        for path in ('a.txt', 'b.txt'):
+            self.assertEqual([command for command, p in self.executed if p == path], ['upload', 'modify'])
+
+    def test_failure_stops_path_commands(self):
+        self.failing.add(('upload', 'a.txt'))
+        commands = [('upload', 'a.txt'), ('modify', 'a.txt'), ('upload', 'b.txt')]
+        scheduler = client_daemon.SyncScheduler(self.run_command, 2)
+        results = list(scheduler.run(commands))
+        self.assertNotIn(('modify', 'a.txt'), self.executed)
+        self.assertIn(('upload', 'b.txt'), self.executed)
+        self.assertEqual(len(results), 2)
+
+    def test_cancel(self):
+        commands = [('upload', 'a.txt'), ('upload', 'b.txt'), ('upload', 'c.txt')]
+        def run_and_cancel(command, path):
+            scheduler.cancel()
+            return self.run_command(command, path)
+        scheduler = client_daemon.SyncScheduler(run_and_cancel, 1)
+        results = list(scheduler.run(commands))
+        self.assertEqual(len(self.executed), 1)
+        self.assertEqual(len(results), 1)
+
+    def test_no_commands(self):
+        scheduler = client_daemon.SyncScheduler(self.run_command, 4)
+        self.assertEqual(list(scheduler.run([])), [])
+
+
+class TestDaemonFileIndex(unittest.TestCase):
+    """
+    Test the use of the file index to skip the hashing of the unchanged files.
+    """
+    def setUp(self):
+        create_environment()
+        create_files(['a.txt', 'dir/b.txt'])
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        self.old_time = time.time() - 60
+        for path in ('a.txt', 'dir/b.txt'):
+            os.utime(os.path.join(TEST_SHARING_FOLDER, path), (self.old_time, self.old_time))
+
+    def tearDown(self):
+        destroy_folder()
+
+    def rewrite(self, path, content):
+        """
+        Change the file content keeping its size, mtime and inode (so that the change isn't noticed).
+        """
+        file_path = os.path.join(TEST_SHARING_FOLDER, path)
+        with open(file_path, 'r+') as f:
+            f.write(content)
+        os.utime(file_path, (self.old_time, self.old_time))
+
+    def test_unchanged_files_not_hashed(self):
+        self.daemon.build_client_snapshot()
+        snapshot = dict(self.daemon.client_snapshot)
+        self.rewrite('a.txt', 'X')
+        # A new daemon uses the persistent index
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+        self.daemon.build_client_snapshot()
+        self.assertEqual(self.daemon.client_snapshot, snapshot)
+
+    def test_index_follows_events(self):
+        self.daemon.build_client_snapshot()
+        md5 = self.daemon.client_snapshot['dir/b.txt'][1]
+        self.daemon.conn_mng = TestCoalescedDeletes.RecordingConnMng()
+        os.rename(os.path.join(TEST_SHARING_FOLDER, 'dir'), os.path.join(TEST_SHARING_FOLDER, 'moved'))
+        self.daemon.on_dir_moved(client_daemon.DirMovedEvent(os.path.join(TEST_SHARING_FOLDER, 'dir'),
+                                                             os.path.join(TEST_SHARING_FOLDER, 'moved')))
+        self.rewrite('moved/b.txt', 'X')
+        self.assertEqual(self.daemon.hash_file(os.path.join(TEST_SHARING_FOLDER, 'moved/b.txt')), md5)
+
+        os.remove(os.path.join(TEST_SHARING_FOLDER, 'a.txt'))
+        self.daemon.on_deleted(client_daemon.FileDeletedEvent(os.path.join(TEST_SHARING_FOLDER, 'a.txt')))
+        self.assertEqual([path for path, in self.daemon.file_index.conn.execute('SELECT path FROM files')],
+                         ['moved/b.txt'])
+
+
+class TestHasher(unittest.TestCase):
+    """
+    Test the hashing of the files on more threads.
+    """
+    def setUp(self):
+        create_environment()
+        create_files(['a.txt', 'dir/b.txt', 'dir/c.txt'])
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+
+    def tearDown(self):
+        self.daemon.hasher.close()
+        destroy_folder()
+
+    def test_md5(self):
+        file_path = os.path.join(TEST_SHARING_FOLDER, 'a.txt')
+        with open(file_path, 'wb') as f:
+            f.write('x' * (client_daemon.Hasher.READ_SIZE + 10))
+        self.assertEqual(client_daemon.Hasher.md5(file_path),
+                         hashlib.md5('x' * (client_daemon.Hasher.READ_SIZE + 10)).hexdigest())
+
+    def test_imap_bounded(self):
+        hasher = client_daemon.Hasher(2, max_pending=3)
+        taken = []
+
+        def items():
+            for i in range(10):
+                taken.append(i)
+                yield i
+
+        results = hasher.imap(lambda i: i * i, items())
+        self.assertEqual(next(results), (0, 0))
+        # Only max_pending items are taken in advance
+        self.assertEqual(len(taken), 3)
+        self.assertEqual(list(results), [(i, i * i) for i in range(1, 10)])
+        hasher.close()
+
+    def test_build_client_snapshot(self):
+        old_snapshot = self.daemon.client_snapshot = {'old.txt': ['', 'old md5']}
+        hash_files = self.daemon.hash_files
+        seen_snapshots = []
+
+        def checking_hash_files(file_paths):
+            for result in hash_files(file_paths):
+                seen_snapshots.append(dict(self.daemon.client_snapshot))
+                yield result
+
+        self.daemon.hash_files = checking_hash_files
+        self.daemon.build_client_snapshot()
+        self.assertEqual(self.daemon.client_snapshot, dict(
+            (path, ['', hashlib.md5(os.path.join(TEST_SHARING_FOLDER, path)).hexdigest()])
+            for path in ('a.txt', 'dir/b.txt', 'dir/c.txt')))
+        # The snapshot is replaced at once when the scan is over, never seen partial
+        self.assertEqual(seen_snapshots, [old_snapshot] * 3)
+
+    def test_events_prehashed(self):
+        paths = [os.path.join(TEST_SHARING_FOLDER, path) for path in ('a.txt', 'dir/b.txt')]
+        self.daemon.on_events_queued([client_daemon.DirMovedEvent(TEST_SHARING_FOLDER, TEST_SHARING_FOLDER)] +
+                                     [FileModifiedEvent(path) for path in paths])
+        self.assertEqual(sorted(self.daemon._prehashed), paths)
+        # The prehashed md5 are used if the files are unchanged
+        self.daemon._prehashed[paths[0]] = (self.daemon._prehashed[paths[0]][0], 'prehashed md5')
+        self.assertEqual(self.daemon.hash_file(paths[0]), 'prehashed md5')
+        self.assertNotIn(paths[0], self.daemon._prehashed)
+        with open(paths[1], 'w') as f:
+            f.write('new content')
+        self.assertEqual(self.daemon.hash_file(paths[1]), hashlib.md5('new content').hexdigest())
+
+
+class TestObserverBackends(unittest.TestCase):
+    """
+    Test the choice of the sharing folder observer and the handling of the lost events.
+    """
+    def setUp(self):
+        create_environment()
+        self.daemon = client_daemon.Daemon(CONFIG_FILEPATH, TEST_SHARING_FOLDER)
+
+    def tearDown(self):
+        destroy_folder()
+
+    def emitter_class(self):
+        return type(list(self.daemon.observer.emitters)[0])
+
+    def test_inotify_observer(self):
+        self.daemon.create_observer()
+        self.assertIs(self.emitter_class(), client_daemon.InotifyEmitter)
+
+    def test_polling_observer(self):
+        self.daemon.cfg['observer'] = client_daemon.Daemon.OBSERVER_POLLING
+        self.daemon.create_observer()
+        self.assertIs(self.emitter_class(), client_daemon.PollingEmitter)
+
+    def test_polling_fallback(self):
+        def fail(*args, **kwargs):
+            raise OSError('inotify watch limit reached')
+
+        original_init = client_daemon.InotifyEmitter.__init__
+        client_daemon.InotifyEmitter.__init__ = fail
+        try:
+            self.daemon.create_observer()
+        finally:
+            client_daemon.InotifyEmitter.__init__ = original_init
+        self.assertIs(self.emitter_class(), client_daemon.PollingEmitter)
+
+    def test_events_lost(self):
+        rescans = []
+        self.daemon.build_client_snapshot = lambda: rescans.append('build_client_snapshot')
+        self.daemon.sync_with_server = lambda: rescans.append('sync_with_server')
+        observer = client_daemon.SkipObserver()
+        watch = observer.schedule(self.daemon, TEST_SHARING_FOLDER, recursive=True)
+        observer.event_queue.put((client_daemon.EventsLostEvent(TEST_SHARING_FOLDER), watch))
+        observer.dispatch_events(observer.event_queue, 0)
+        # The observer thread only wakes up the main loop, that scans again
+        self.assertEqual(rescans, [])
+        r_ready, _, _ = select.select([self.daemon.events_lost_read_fd], [], [], 0)
+        self.assertEqual(r_ready, [self.daemon.events_lost_read_fd])
+        self.daemon.rescan()
+        self.assertEqual(rescans, ['build_client_snapshot', 'sync_with_server'])
+        self.assertEqual(select.select([self.daemon.events_lost_read_fd], [], [], 0)[0], [])
+
+    def test_events_queued(self):
+        queued = []
+        self.daemon.on_events_queued = queued.append
+        self.daemon.on_modified = lambda e: None
+        observer = client_daemon.SkipObserver()
+        watch = observer.schedule(self.daemon, TEST_SHARING_FOLDER, recursive=True)
+        events = [FileModifiedEvent(os.path.join(TEST_SHARING_FOLDER, name)) for name in ('a.txt', 'b.txt')]
+        for event in events:
+            observer.event_queue.put((event, watch))
+        observer.dispatch_events(observer.event_queue, 0)
+        observer.dispatch_events(observer.event_queue, 0)
+        # The handler is told of the events taken from the queue together, once
+        self.assertEqual(queued, [events])
+
+
+class TestChangesListener(unittest.TestCase):
+    """
+    Test the thread that waits for the server change notifications.
+    """
+    class FakeChangesConnMng(object):
+        changelog_timestamp = 5
+
+        def __init__(self, responses):
+            self.responses = responses
+            self.received_data = []
+
+        def dispatch_request(self, cmd, data):
+            self.received_data.append(data)
+            if self.responses:
+                return self.responses.pop(0)
+            time.sleep(0.1)
+            return {'content': {'changelog_timestamp': data['since'], 'changed': False}, 'successful': True}
+
+    def test_notify_changes(self):
+        conn_mng = self.FakeChangesConnMng([
+            {'content': {'changelog_timestamp': 7, 'changed': False}, 'successful': True},
+            {'content': {'changelog_timestamp': 9, 'changed': True}, 'successful': True},
+        ])
+        listener = client_daemon.ChangesListener(conn_mng, 60)
+        listener.start()
+        r_ready, _, _ = select.select([listener], [], [], 5)
+        self.assertEqual(r_ready, [listener])
+        # Wait for the next request, made with the last change timestamp
+        deadline = time.time() + 5
+        while len(conn_mng.received_data) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        listener.stop()
+        listener.pop_notifications()
+        self.assertEqual([data['since'] for data in conn_mng.received_data[:3]], [5, 7, 9])
+        self.assertTrue(listener.supported)
+
+    def test_unsupported(self):
+        conn_mng = self.FakeChangesConnMng([{'content': '', 'successful': False, 'unsupported': True}])
+        listener = client_daemon.ChangesListener(conn_mng, 60)
+        listener.start()
+        listener.join(5)
+        self.assertFalse(listener.is_alive())
+        self.assertFalse(listener.supported)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -9,6 +9,10 @@ import httpretty
 import time
 import shutil
 import urllib
+import hashlib
+import tarfile
+import io
+import mock
 
 # API:
 # - GET /diffs, con parametro timestamp
@@ -96,6 +100,29 @@ class TestConnectionManager(unittest.TestCase):
         httpretty.reset()
         remove_fake_dir()
 
+    def test_connection_pool(self):
+        session = self.cm.session
+        adapter = session.get_adapter(TEST_SERVER_ADDRESS)
+        self.assertEqual(adapter._pool_maxsize, ConnectionManager.DEF_HTTP_POOL_SIZE)
+        self.assertEqual(adapter.max_retries.total, ConnectionManager.DEF_HTTP_RETRIES)
+        # The same server keeps the same connections.
+        self.cm.load_cfg(dict(self.cfg))
+        self.assertIs(self.cm.session, session)
+        # Another server or pool configuration gets a new pool.
+        self.cm.load_cfg(dict(self.cfg, server_address='http://www.otherpyboxtest.com', http_pool_size=2))
+        self.assertIsNot(self.cm.session, session)
+        self.assertEqual(self.cm.session.get_adapter('http://www.otherpyboxtest.com')._pool_maxsize, 2)
+
+    @httpretty.activate
+    def test_requests_share_connection(self):
+        httpretty.register_uri(httpretty.POST, ''.join((self.actions_url, 'delete')), status=200,
+                               body=json.dumps({'server_timestamp': 1}), content_type="application/json")
+        httpretty.register_uri(httpretty.GET, ''.join((self.files_url, 'file.txt')), status=200, body='content')
+        with mock.patch.object(self.cm.session, 'request', wraps=self.cm.session.request) as request:
+            self.assertTrue(self.cm.do_delete({'filepath': 'foo.txt'})['successful'])
+            self.assertTrue(self.cm.do_download({'filepath': 'file.txt'})['successful'])
+        self.assertEqual(request.call_count, 2)
+
     @httpretty.activate
     def test_register_user(self):
         """
@@ -413,6 +440,88 @@ class TestConnectionManager(unittest.TestCase):
         response = self.cm.do_download(data)
         self.assertEqual(response['successful'], True)
 
+    @httpretty.activate
+    def test_download_big_file(self):
+        url = ''.join((self.files_url, 'big.bin'))
+        content = os.urandom(3 * ConnectionManager.DOWNLOAD_CHUNK_SIZE + 10)
+        httpretty.register_uri(httpretty.GET, url, status=200, body=content)
+        response = self.cm.do_download({'filepath': 'big.bin'})
+        self.assertTrue(response['successful'])
+        with open(os.path.join(TEST_SHARING_FOLDER, 'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def _register_ranged_file(self, url, content, etag='"md5"'):
+        """
+        Register a fake file download serving byte ranges like the server,
+        return the list of the requested ranges.
+        """
+        requested_ranges = []
+
+        def serve_range(request, uri, headers):
+            byte_range = request.headers.get('Range')
+            if_range = request.headers.get('If-Range')
+            headers.update({'ETag': etag, 'Accept-Ranges': 'bytes'})
+            if not byte_range or (if_range and if_range != etag):
+                return 200, headers, content
+            requested_ranges.append(byte_range)
+            start, end = [int(n) for n in byte_range.split('=')[1].split('-')]
+            end = min(end, len(content) - 1)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(content))
+            return 206, headers, content[start:end + 1]
+
+        httpretty.register_uri(httpretty.GET, url, body=serve_range)
+        return requested_ranges
+
+    @httpretty.activate
+    def test_download_in_ranges(self):
+        url = ''.join((self.files_url, 'big.bin'))
+        content = os.urandom(1000)
+        self.cm.DOWNLOAD_RANGE_SIZE = 300
+        self.cm.DOWNLOAD_THREADS = 1  # httpretty isn't thread safe
+        requested_ranges = self._register_ranged_file(url, content)
+        response = self.cm.do_download({'filepath': 'big.bin'})
+        self.assertTrue(response['successful'])
+        self.assertEqual(sorted(requested_ranges),
+                         ['bytes=0-299', 'bytes=300-599', 'bytes=600-899', 'bytes=900-999'])
+        with open(os.path.join(TEST_SHARING_FOLDER, 'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # The partial download has been moved to the sharing folder
+        self.assertEqual(os.listdir(os.path.join(CONFIG_DIR, 'downloads')), [])
+
+    @httpretty.activate
+    def test_download_resumed(self):
+        url = ''.join((self.files_url, 'big.bin'))
+        content = os.urandom(1000)
+        self.cm.DOWNLOAD_RANGE_SIZE = 500
+        part_path, state_path = self.cm._partial_download_paths('big.bin')
+        with open(part_path, 'wb') as f:
+            f.write(content[:500] + '\0' * 500)
+        with open(state_path, 'w') as f:
+            json.dump({'etag': '"md5"', 'length': 1000, 'done': [0]}, f)
+        requested_ranges = self._register_ranged_file(url, content)
+        response = self.cm.do_download({'filepath': 'big.bin'})
+        self.assertTrue(response['successful'])
+        # Only the missing range has been downloaded
+        self.assertEqual(requested_ranges, ['bytes=500-999'])
+        with open(os.path.join(TEST_SHARING_FOLDER, 'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    @httpretty.activate
+    def test_download_resumed_of_changed_file(self):
+        url = ''.join((self.files_url, 'big.bin'))
+        content = os.urandom(1000)
+        self.cm.DOWNLOAD_RANGE_SIZE = 500
+        part_path, state_path = self.cm._partial_download_paths('big.bin')
+        with open(part_path, 'wb') as f:
+            f.write('old content')
+        with open(state_path, 'w') as f:
+            json.dump({'etag': '"old_md5"', 'length': 1000, 'done': [0]}, f)
+        self._register_ranged_file(url, content)
+        response = self.cm.do_download({'filepath': 'big.bin'})
+        self.assertTrue(response['successful'])
+        with open(os.path.join(TEST_SHARING_FOLDER, 'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
     @httpretty.activate
     def test_download_file_not_exists(self):
         url = ''.join((self.files_url, 'file.tx'))
@@ -423,6 +532,165 @@ class TestConnectionManager(unittest.TestCase):
         self.assertEqual(response['successful'], False)
         self.assertIsInstance(response['content'], str)
 
+    def _register_chunked_upload(self, received=()):
+        """
+        Register a fake chunked upload (of foo.txt) and its commit, return the list of the received chunks offsets.
+        """
+        uploads_url = ''.join((self.base_url, 'uploads/'))
+        received_offsets = []
+
+        def receive_chunk(request, uri, headers):
+            offset = int(request.querystring['offset'][0])
+            self.assertEqual(request.querystring['md5'][0], hashlib.md5(request.body).hexdigest())
+            received_offsets.append(offset)
+            return 200, headers, json.dumps({'upload_id': 'abc', 'received': []})
+
+        status = json.dumps({'upload_id': 'abc', 'size': 10, 'received': list(received)})
+        httpretty.register_uri(httpretty.POST, uploads_url, status=201, body=status)
+        httpretty.register_uri(httpretty.GET, uploads_url + 'abc', status=200, body=status)
+        httpretty.register_uri(httpretty.PUT, uploads_url + 'abc', body=receive_chunk)
+        httpretty.register_uri(httpretty.POST, ''.join((self.files_url, 'foo.txt')), status=201,
+                               body=json.dumps({'server_timestamp': 1}), content_type="application/json")
+        return received_offsets
+
+    @httpretty.activate
+    def test_do_upload_in_chunks(self):
+        self.cm.UPLOAD_CHUNK_SIZE = 4
+        self.cm.UPLOAD_THREADS = 1  # httpretty isn't thread safe
+        received_offsets = self._register_chunked_upload()
+        response = self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertTrue(response['successful'])
+        self.assertEqual(sorted(received_offsets), [0, 4, 8])
+        # The upload is committed with its upload_id
+        self.assertEqual(httpretty.last_request().parsed_body, {'md5': ['test_md5'], 'upload_id': ['abc']})
+
+    @httpretty.activate
+    def test_do_upload_in_chunks_resumed(self):
+        self.cm.UPLOAD_CHUNK_SIZE = 4
+        self.cm.UPLOAD_THREADS = 1  # httpretty isn't thread safe
+        with open(self.cm._transfer_path('uploads', 'foo.txt') + '.json', 'w') as f:
+            json.dump({'upload_id': 'abc', 'md5': 'test_md5', 'size': 10}, f)
+        received_offsets = self._register_chunked_upload(received=[[0, 4]])
+        response = self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertTrue(response['successful'])
+        # Only the chunks not yet received are sent
+        self.assertEqual(sorted(received_offsets), [4, 8])
+        self.assertEqual(os.listdir(os.path.join(CONFIG_DIR, 'uploads')), [])
+
+    @httpretty.activate
+    def test_do_upload_claiming_content(self):
+        self.cm.CLAIM_MIN_SIZE = 0
+        msg = {'server_timestamp': time.time()}
+        httpretty.register_uri(httpretty.POST, ''.join((self.files_url, 'foo.txt')), status=201,
+                               body=json.dumps(msg), content_type="application/json")
+        response = self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+        # Only the md5 and size are sent
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), 1)
+        self.assertEqual(httpretty.last_request().parsed_body, {'md5': ['test_md5'], 'size': ['10']})
+
+    @httpretty.activate
+    def test_do_upload_claiming_unknown_content(self):
+        self.cm.CLAIM_MIN_SIZE = 0
+        msg = {'server_timestamp': time.time()}
+
+        def claim_or_upload(request, uri, headers):
+            if 'foo.txt :)' in request.body:
+                return 201, headers, json.dumps(msg)
+            return 404, headers, ''
+
+        httpretty.register_uri(httpretty.POST, ''.join((self.files_url, 'foo.txt')), body=claim_or_upload)
+        response = self.cm.do_upload({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+
+    def _make_small_files(self):
+        files = []
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            with open(os.path.join(TEST_SHARING_FOLDER, name), 'w') as f:
+                f.write(name)
+            files.append({'cmd': 'upload', 'filepath': name, 'md5': hashlib.md5(name).hexdigest()})
+        return files
+
+    @httpretty.activate
+    def test_do_upload_bundle(self):
+        self.cm.BUNDLE_MAX_FILES = 2
+        files = self._make_small_files()
+        bundles = []
+
+        def upload_bundle(request, uri, headers):
+            tar = tarfile.open(fileobj=io.BytesIO(request.body))
+            bundles.append([(entry.name, tar.extractfile(entry).read(),
+                             entry.pax_headers[ConnectionManager.BUNDLE_MD5_HEADER]) for entry in tar])
+            return 201, headers, json.dumps({'server_timestamp': len(bundles)})
+
+        httpretty.register_uri(httpretty.POST, ''.join((self.base_url, 'bundles/upload')), body=upload_bundle)
+        response = self.cm.do_upload_bundle({'files': files})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], {'server_timestamp': 2})
+        self.assertEqual(bundles, [[('a.txt', 'a.txt', files[0]['md5']), ('b.txt', 'b.txt', files[1]['md5'])],
+                                   [('c.txt', 'c.txt', files[2]['md5'])]])
+
+    @httpretty.activate
+    def test_do_upload_bundle_unsupported(self):
+        files = self._make_small_files()
+        files[2]['cmd'] = 'modify'
+        httpretty.register_uri(httpretty.POST, ''.join((self.base_url, 'bundles/upload')), status=404)
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            method = httpretty.PUT if name == 'c.txt' else httpretty.POST
+            httpretty.register_uri(method, ''.join((self.files_url, name)), status=201,
+                                   body=json.dumps({'server_timestamp': 10}), content_type="application/json")
+        response = self.cm.do_upload_bundle({'files': files})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], {'server_timestamp': 10})
+        self.assertEqual([(r.method, r.path.split('/')[-1]) for r in httpretty.HTTPretty.latest_requests[1:]],
+                         [('POST', 'a.txt'), ('POST', 'b.txt'), ('PUT', 'c.txt')])
+
+    def _make_bundle(self, entries):
+        bundle = io.BytesIO()
+        tar = tarfile.open(fileobj=bundle, mode='w', format=tarfile.PAX_FORMAT)
+        for name, content, md5 in entries:
+            entry = tarfile.TarInfo(name)
+            entry.size = len(content)
+            entry.pax_headers = {ConnectionManager.BUNDLE_MD5_HEADER: unicode(md5)}
+            tar.addfile(entry, io.BytesIO(content))
+        tar.close()
+        return bundle.getvalue()
+
+    @httpretty.activate
+    def test_do_download_bundle(self):
+        # b.txt doesn't match its md5 and c.txt is left out of the bundle: they are left to be downloaded by themselves.
+        httpretty.register_uri(httpretty.POST, ''.join((self.base_url, 'bundles/download')), status=200,
+                               body=self._make_bundle([('a.txt', 'a', hashlib.md5('a').hexdigest()),
+                                                       ('b.txt', 'b', hashlib.md5('other').hexdigest())]))
+        response = self.cm.do_download_bundle({'filepaths': ['a.txt', 'b.txt', 'c.txt']})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], {'left_out': ['b.txt', 'c.txt']})
+        self.assertEqual(json.loads(httpretty.HTTPretty.latest_requests[0].parsed_body['paths'][0]),
+                         ['a.txt', 'b.txt', 'c.txt'])
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), 1)
+        with open(os.path.join(TEST_SHARING_FOLDER, 'a.txt')) as f:
+            self.assertEqual(f.read(), 'a')
+        self.assertFalse(os.path.exists(os.path.join(TEST_SHARING_FOLDER, 'b.txt')))
+        self.assertEqual([name for name in os.listdir(os.path.join(CONFIG_DIR, 'downloads'))
+                          if name.endswith('.bundle')], [])
+
+    @httpretty.activate
+    def test_do_download_bundle_unexpected_entry(self):
+        httpretty.register_uri(httpretty.POST, ''.join((self.base_url, 'bundles/download')), status=200,
+                               body=self._make_bundle([('../a.txt', 'a', hashlib.md5('a').hexdigest())]))
+        response = self.cm.do_download_bundle({'filepaths': ['a.txt']})
+        self.assertFalse(response['successful'])
+        self.assertFalse(os.path.exists(os.path.join(TEST_SHARING_FOLDER, 'a.txt')))
+
+    @httpretty.activate
+    def test_do_download_bundle_unsupported(self):
+        httpretty.register_uri(httpretty.POST, ''.join((self.base_url, 'bundles/download')), status=404)
+        response = self.cm.do_download_bundle({'filepaths': ['a.txt', 'b.txt']})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], {'left_out': ['a.txt', 'b.txt']})
+
     @httpretty.activate
     def test_do_upload_success(self):
 
@@ -494,6 +762,27 @@ class TestConnectionManager(unittest.TestCase):
         self.assertTrue(response['successful'])
         self.assertEqual(response['content'], msg)
 
+    @httpretty.activate
+    def test_do_batch(self):
+        url = ''.join((self.actions_url, 'batch'))
+        msg = {'server_timestamp': time.time()}
+        httpretty.register_uri(httpretty.POST, url, status=200, body=json.dumps(msg),
+                               content_type="application/json")
+        operations = [{'action': 'delete', 'filepath': 'foo.txt'},
+                      {'action': 'move', 'src': 'bar.txt', 'dst': 'dir/bar.txt'}]
+
+        response = self.cm.do_batch({'operations': operations})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+        self.assertEqual(json.loads(httpretty.last_request().parsed_body['operations'][0]), operations)
+
+    @httpretty.activate
+    def test_do_batch_unsupported(self):
+        httpretty.register_uri(httpretty.POST, ''.join((self.actions_url, 'batch')), status=404)
+        response = self.cm.do_batch({'operations': [{'action': 'delete', 'filepath': 'foo.txt'}]})
+        self.assertFalse(response['successful'])
+        self.assertTrue(response['unsupported'])
+
     @httpretty.activate
     def test_do_modify(self):
         url = ''.join((self.files_url, 'foo.txt'))
@@ -507,6 +796,40 @@ class TestConnectionManager(unittest.TestCase):
         self.assertTrue(response['successful'])
         self.assertEqual(response['content'], msg)
 
+    @httpretty.activate
+    def test_do_modify_with_delta(self):
+        # foo.txt is 'foo.txt :)', changed from 'foo.XXXX:)' on the server
+        self.cm.DELTA_MIN_SIZE = 0
+        signature = {'md5': 'server_md5', 'block_size': 4,
+                     'blocks': [hashlib.md5(block).hexdigest() for block in ('foo.', 'XXXX', ':)')]}
+        httpretty.register_uri(httpretty.GET, ''.join((self.base_url, 'signatures/foo.txt')),
+                               status=200, body=json.dumps(signature), content_type="application/json")
+        msg = {'server_timestamp': time.time()}
+        httpretty.register_uri(httpretty.PUT, ''.join((self.files_url, 'foo.txt')), status=201,
+                               body=json.dumps(msg), content_type="application/json")
+
+        response = self.cm.do_modify({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+        body = httpretty.last_request().body
+        # Only the changed block is sent
+        self.assertIn('[0, null, 2]', body)
+        self.assertIn('txt ', body)
+        self.assertNotIn('foo.txt :)', body)
+
+    @httpretty.activate
+    def test_do_modify_without_signature(self):
+        self.cm.DELTA_MIN_SIZE = 0
+        httpretty.register_uri(httpretty.GET, ''.join((self.base_url, 'signatures/foo.txt')), status=404)
+        msg = {'server_timestamp': time.time()}
+        httpretty.register_uri(httpretty.PUT, ''.join((self.files_url, 'foo.txt')), status=201,
+                               body=json.dumps(msg), content_type="application/json")
+
+        response = self.cm.do_modify({'filepath': 'foo.txt', 'md5': 'test_md5'})
+        self.assertTrue(response['successful'])
+        # The whole file is sent
+        self.assertIn('foo.txt :)', httpretty.last_request().body)
+
     @httpretty.activate
     def test_do_copy(self):
         url = ''.join([self.actions_url, 'copy'])
@@ -535,5 +858,127 @@ class TestConnectionManager(unittest.TestCase):
         self.assertTrue(response['successful'])
         self.assertEqual(response['content'], msg)
 
+    @httpretty.activate
+    def test_get_server_snapshot_delta(self):
+        """
+        Test that after the first snapshot only the changes are asked and applied to the cached snapshot.
+        """
+        url = self.files_url
+        full = {'server_timestamp': 1, 'changelog_timestamp': 10,
+                'files': {'foo.txt': [1, 'md5foo'], 'bar.txt': [1, 'md5bar']},
+                'shared_files': {}}
+        delta = {'server_timestamp': 2, 'changelog_timestamp': 20,
+                 'delta': {'files': {'foo.txt': None, 'spam.txt': [2, 'md5spam']},
+                           'shared_files': {}}}
+        httpretty.register_uri(httpretty.GET, url,
+                               responses=[httpretty.Response(body=json.dumps(full), status=200),
+                                          httpretty.Response(body=json.dumps(delta), status=200)])
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(httpretty.last_request().querystring, {'since': ['0']})
+        self.assertEqual(response['content']['files'], full['files'])
+        # The caller can't change the cached snapshot
+        response['content']['files'].pop('bar.txt')
+
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(httpretty.last_request().querystring, {'since': ['10']})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], {'server_timestamp': 2,
+                                               'files': {'bar.txt': [1, 'md5bar'], 'spam.txt': [2, 'md5spam']},
+                                               'shared_files': {}})
+        self.assertEqual(self.cm.changelog_timestamp, 20)
+
+    @httpretty.activate
+    def test_get_server_snapshot_not_modified(self):
+        """
+        Test that the cached snapshot is given when the server answers 304 Not Modified.
+        """
+        url = self.files_url
+        msg = {'server_timestamp': 1, 'files': {'foo.txt': [1, 'md5foo']}, 'shared_files': {}}
+        httpretty.register_uri(httpretty.GET, url,
+                               responses=[httpretty.Response(body=json.dumps(msg), status=200,
+                                                             etag='"1-1"'),
+                                          httpretty.Response(body='', status=304)])
+        self.cm.do_get_server_snapshot('')
+        self.assertNotIn('If-None-Match', httpretty.last_request().headers)
+        response = self.cm.do_get_server_snapshot('')
+        self.assertEqual(httpretty.last_request().headers['If-None-Match'], '"1-1"')
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+
+    @httpretty.activate
+    def test_wait_changes(self):
+        url = ''.join([self.base_url, 'changes'])
+        msg = {'changelog_timestamp': 10, 'changed': True}
+        httpretty.register_uri(httpretty.GET, url, status=200, body=json.dumps(msg))
+        response = self.cm.do_wait_changes({'since': 5, 'wait': 60})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+        self.assertEqual(httpretty.last_request().querystring, {'since': ['5'], 'wait': ['60']})
+
+    @httpretty.activate
+    def test_wait_changes_unsupported(self):
+        url = ''.join([self.base_url, 'changes'])
+        httpretty.register_uri(httpretty.GET, url, status=404)
+        response = self.cm.do_wait_changes({'since': 5, 'wait': 60})
+        self.assertFalse(response['successful'])
+        self.assertTrue(response['unsupported'])
+
+    @httpretty.activate
+    def test_get_dir_hashes(self):
+        msg = {'hash': 'dir hash', 'entries': {'a.txt': ['f', 'md5a'], 'sub': ['d', 'sub hash']}}
+        httpretty.register_uri(httpretty.GET, ''.join([self.base_url, 'hashes/dir%20name']), status=200,
+                               body=json.dumps(msg))
+        response = self.cm.do_get_dir_hashes({'dirpath': 'dir name'})
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+
+    @httpretty.activate
+    def test_get_dir_hashes_unsupported(self):
+        httpretty.register_uri(httpretty.GET, ''.join([self.base_url, 'hashes/']), status=404)
+        self.assertFalse(self.cm.do_get_dir_hashes({'dirpath': ''})['successful'])
+
+    @httpretty.activate
+    def test_session_token(self):
+        """
+        Test that the session token given by the server is sent instead of the password.
+        """
+        url = self.files_url
+        httpretty.register_uri(httpretty.GET, url, status=200, body='{}',
+                               adding_headers={'X-Session-Token': 'session:123:abc'},
+                               content_type="application/json")
+        self.cm.do_get_server_snapshot('')
+        self.assertEqual(self.cm.auth.token, 'session:123:abc')
+        self.cm.do_get_server_snapshot('')
+        self.assertEqual(httpretty.last_request().headers['Authorization'],
+                         'Basic ' + 'user:session:123:abc'.encode('base64').strip())
+
+    @httpretty.activate
+    def test_session_token_refused(self):
+        """
+        Test that a refused session token is dropped and the request is sent again with the password.
+        """
+        url = self.files_url
+        msg = {'files': 'foo.txt'}
+        httpretty.register_uri(httpretty.GET, url,
+                               responses=[httpretty.Response(body='', status=401),
+                                          httpretty.Response(body=json.dumps(msg), status=200)])
+        self.cm.auth.token = 'session:123:abc'
+        self.cm.auth.password = 'pass'
+        response = self.cm.do_get_server_snapshot('')
+        self.assertTrue(response['successful'])
+        self.assertEqual(response['content'], msg)
+        self.assertIsNone(self.cm.auth.token)
+        self.assertEqual(httpretty.last_request().headers['Authorization'],
+                         'Basic ' + 'user:pass'.encode('base64').strip())
+
+    @httpretty.activate
+    def test_login_keeps_session_token(self):
+        url = self.files_url
+        httpretty.register_uri(httpretty.GET, url, status=200, body='{}',
+                               adding_headers={'X-Session-Token': 'session:123:abc'})
+        self.cm.do_login((USR, PW))
+        self.assertEqual(self.cm.auth.username, USR)
+        self.assertEqual(self.cm.auth.token, 'session:123:abc')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import shutil
+import time
+
+from file_index import FileIndex
+
+TEST_DIR = os.path.join(os.environ['HOME'], 'file_index_test')
+TEST_DB = os.path.join(TEST_DIR, 'file_index.db')
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(TEST_DIR)
+        self.index = FileIndex(TEST_DB)
+        self.stats = {}
+        for path in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt', 'dir2/d.txt'):
+            self.stats[path] = self.make_file(path)
+            self.index.set(path, self.stats[path], 'md5 of ' + path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(TEST_DIR)
+
+    def make_file(self, path, content='content', age=60):
+        """
+        Create the file, modified <age> seconds ago, and return its stat.
+        """
+        file_path = os.path.join(TEST_DIR, path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'w') as f:
+            f.write(content)
+        modified = time.time() - age
+        os.utime(file_path, (modified, modified))
+        return os.stat(file_path)
+
+    def test_get(self):
+        self.assertEqual(self.index.get('a.txt', self.stats['a.txt']), 'md5 of a.txt')
+        self.assertIsNone(self.index.get('unknown.txt', self.stats['a.txt']))
+        # The file has been changed
+        self.assertIsNone(self.index.get('a.txt', self.make_file('a.txt', 'other content')))
+        self.assertIsNone(self.index.get('a.txt', self.make_file('a.txt', age=30)))
+
+    def test_persistence(self):
+        self.index.close()
+        self.index = FileIndex(TEST_DB)
+        self.assertEqual(self.index.get('dir/b.txt', self.stats['dir/b.txt']), 'md5 of dir/b.txt')
+
+    def test_recently_modified_file_not_indexed(self):
+        file_stat = self.make_file('a.txt', 'new content', age=0)
+        self.index.set('a.txt', file_stat, 'new md5')
+        self.assertIsNone(self.index.get('a.txt', file_stat))
+
+    def test_remove(self):
+        self.index.remove('dir')
+        self.index.remove('a.txt')
+        for path in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt'):
+            self.assertIsNone(self.index.get(path, self.stats[path]))
+        self.assertEqual(self.index.get('dir2/d.txt', self.stats['dir2/d.txt']), 'md5 of dir2/d.txt')
+
+    def test_move(self):
+        self.index.move('dir', 'dir2')
+        self.index.move('a.txt', u'n\xe8w.txt')
+        self.assertEqual(self.index.get('dir2/sub/c.txt', self.stats['dir/sub/c.txt']), 'md5 of dir/sub/c.txt')
+        self.assertEqual(self.index.get(u'n\xe8w.txt', self.stats['a.txt']), 'md5 of a.txt')
+        # The moved directory replaced the destination one
+        self.assertIsNone(self.index.get('dir2/d.txt', self.stats['dir2/d.txt']))
+        self.assertIsNone(self.index.get('dir/b.txt', self.stats['dir/b.txt']))
+
+    def test_prune(self):
+        self.index.prune(['a.txt', 'dir/sub/c.txt'])
+        self.assertEqual(self.index.get('a.txt', self.stats['a.txt']), 'md5 of a.txt')
+        self.assertEqual(self.index.get('dir/sub/c.txt', self.stats['dir/sub/c.txt']), 'md5 of dir/sub/c.txt')
+        self.assertIsNone(self.index.get('dir/b.txt', self.stats['dir/b.txt']))
+
+    def test_batch(self):
+        with self.index.batch():
+            self.index.remove('a.txt')
+            # Not committed yet
+            other_conn = FileIndex(TEST_DB)
+            self.assertEqual(other_conn.get('a.txt', self.stats['a.txt']), 'md5 of a.txt')
+        self.assertIsNone(other_conn.get('a.txt', self.stats['a.txt']))
+        other_conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
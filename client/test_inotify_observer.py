@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import shutil
+import tempfile
+from Queue import Queue, Empty
+
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, FileMovedEvent, \
+    DirCreatedEvent, DirDeletedEvent, DirMovedEvent
+from watchdog.observers.api import ObservedWatch
+from watchdog.observers.inotify_c import InotifyConstants
+
+from inotify_observer import InotifyEmitter, EventsLostEvent
+
+TEST_DIR = os.path.join(os.environ['HOME'], 'inotify_test')
+TEST_WATCHED_FOLDER = os.path.join(TEST_DIR, 'watched')
+
+
+def write_file(path, content='content'):
+    with open(os.path.join(TEST_WATCHED_FOLDER, path), 'w') as f:
+        f.write(content)
+
+
+class TestInotifyEmitter(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(os.path.join(TEST_WATCHED_FOLDER, 'dir', 'subdir'))
+        write_file('a.txt')
+        self.event_queue = Queue()
+        self.emitter = InotifyEmitter(self.event_queue, ObservedWatch(TEST_WATCHED_FOLDER, recursive=True))
+        self.emitter.MOVE_PAIRING_DELAY = 0.1
+
+    def tearDown(self):
+        os.close(self.emitter._fd)
+        shutil.rmtree(TEST_DIR)
+
+    def path(self, rel_path):
+        return os.path.join(TEST_WATCHED_FOLDER, rel_path)
+
+    def events(self):
+        """
+        Return the events queued by the emitter for the changes made so far.
+        """
+        for _ in range(3):
+            self.emitter.queue_events(0.2)
+        events = []
+        while True:
+            try:
+                event, _ = self.event_queue.get_nowait()
+            except Empty:
+                return events
+            events.append(event)
+
+    def test_created_and_modified_files(self):
+        write_file('b.txt')
+        write_file('a.txt', 'new content')
+        self.assertEqual(self.events(), [FileCreatedEvent(self.path('b.txt')),
+                                         FileModifiedEvent(self.path('a.txt'))])
+
+    def test_links_created(self):
+        """
+        The links are reported as soon as they are created, since they aren't written.
+        """
+        os.link(self.path('a.txt'), self.path('hard_link.txt'))
+        os.symlink(self.path('a.txt'), self.path('symlink.txt'))
+        self.assertEqual(self.events(), [FileCreatedEvent(self.path('hard_link.txt')),
+                                         FileCreatedEvent(self.path('symlink.txt'))])
+        self.assertEqual(self.emitter._created, set())
+
+    def test_deleted_files_and_directories(self):
+        write_file('dir/subdir/c.txt')
+        self.events()
+        shutil.rmtree(self.path('dir'))
+        self.assertEqual(self.events(), [FileDeletedEvent(self.path('dir/subdir/c.txt')),
+                                         DirDeletedEvent(self.path('dir/subdir')),
+                                         DirDeletedEvent(self.path('dir'))])
+
+    def test_moves_paired(self):
+        os.rename(self.path('a.txt'), self.path('dir/a.txt'))
+        os.rename(self.path('dir'), self.path('moved'))
+        self.assertEqual(self.events(), [FileMovedEvent(self.path('a.txt'), self.path('dir/a.txt')),
+                                         DirMovedEvent(self.path('dir'), self.path('moved'))])
+        # The watches of the moved subdirectories follow them
+        write_file('moved/subdir/b.txt')
+        self.assertEqual(self.events(), [FileCreatedEvent(self.path('moved/subdir/b.txt'))])
+
+    def test_moves_outside_and_inside(self):
+        os.rename(self.path('a.txt'), os.path.join(TEST_DIR, 'a.txt'))
+        os.rename(self.path('dir'), os.path.join(TEST_DIR, 'dir'))
+        self.assertEqual(self.events(), [FileDeletedEvent(self.path('a.txt')), DirDeletedEvent(self.path('dir'))])
+        # The moved out directory isn't watched anymore
+        with open(os.path.join(TEST_DIR, 'dir', 'b.txt'), 'w') as f:
+            f.write('content')
+        self.assertEqual(self.events(), [])
+
+        os.rename(os.path.join(TEST_DIR, 'dir'), self.path('back'))
+        self.assertEqual(self.events(), [DirCreatedEvent(self.path('back')),
+                                         DirCreatedEvent(self.path('back/subdir')),
+                                         FileCreatedEvent(self.path('back/b.txt'))])
+
+    def test_new_directory_content(self):
+        os.makedirs(self.path('new/subdir'))
+        write_file('new/subdir/b.txt')
+        events = self.events()
+        self.assertEqual(events[:2], [DirCreatedEvent(self.path('new')), DirCreatedEvent(self.path('new/subdir'))])
+        self.assertIn(FileCreatedEvent(self.path('new/subdir/b.txt')), events)
+        write_file('new/subdir/c.txt')
+        self.assertEqual(self.events(), [FileCreatedEvent(self.path('new/subdir/c.txt'))])
+
+    def test_queue_overflow(self):
+        self.emitter._handle_event(-1, InotifyConstants.IN_Q_OVERFLOW, 0, '')
+        self.assertEqual(self.events(), [EventsLostEvent(TEST_WATCHED_FOLDER)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import hashlib
+
+from merkle_tree import MerkleSnapshot, EMPTY_HASH, FILE_ENTRY, DIR_ENTRY, entry_hash, dir_hash
+
+
+def md5(content):
+    return hashlib.md5(content).hexdigest()
+
+
+SNAPSHOT = {
+    'a.txt': [1, md5('a')],
+    'dir/b.txt': [2, md5('b')],
+    'dir/sub/c.txt': [3, md5('c')],
+    u'dir2/d\xe8.txt': [4, md5('d')],
+}
+
+
+class TestMerkleSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = MerkleSnapshot(SNAPSHOT)
+
+    def test_hashes(self):
+        sub_hash = dir_hash([entry_hash(FILE_ENTRY, 'c.txt', md5('c'))])
+        dir_hash_ = dir_hash([entry_hash(FILE_ENTRY, 'b.txt', md5('b')), entry_hash(DIR_ENTRY, 'sub', sub_hash)])
+        self.assertEqual(self.snapshot.dir_hash('dir/sub'), sub_hash)
+        self.assertEqual(self.snapshot.dir_hash('dir'), dir_hash_)
+        self.assertEqual(self.snapshot.dir_entries('dir'), {'b.txt': (FILE_ENTRY, md5('b')),
+                                                            'sub': (DIR_ENTRY, sub_hash)})
+        self.assertIsNone(self.snapshot.dir_hash('unknown'))
+        self.assertEqual(MerkleSnapshot().root_hash(), EMPTY_HASH)
+
+    def test_incremental_updates(self):
+        """
+        The hashes updated on each change are the same of a snapshot built from scratch.
+        """
+        self.snapshot['dir/sub/new.txt'] = [5, md5('new')]
+        self.snapshot['a.txt'] = [6, md5('a changed')]
+        self.snapshot.pop(u'dir2/d\xe8.txt')
+        del self.snapshot['dir/b.txt']
+        expected = {
+            'a.txt': [6, md5('a changed')],
+            'dir/sub/c.txt': [3, md5('c')],
+            'dir/sub/new.txt': [5, md5('new')],
+        }
+        self.assertEqual(self.snapshot, expected)
+        self.assertEqual(self.snapshot.root_hash(), MerkleSnapshot(expected).root_hash())
+        self.assertEqual(self.snapshot.dir_hash('dir/sub'), MerkleSnapshot(expected).dir_hash('dir/sub'))
+        # The empty directories aren't in the tree
+        self.assertIsNone(self.snapshot.dir_hash('dir2'))
+
+        self.snapshot.clear()
+        self.assertEqual(self.snapshot.root_hash(), EMPTY_HASH)
+
+    def test_timestamps_ignored(self):
+        root_hash = self.snapshot.root_hash()
+        self.snapshot['a.txt'] = [10, md5('a')]
+        self.assertEqual(self.snapshot.root_hash(), root_hash)
+
+    def test_moved_file(self):
+        """
+        A moved file changes the hashes of both the source and the destination directories.
+        """
+        other = self.snapshot.copy()
+        other['dir/sub/b.txt'] = other.pop('dir/b.txt')
+        self.assertNotEqual(other.root_hash(), self.snapshot.root_hash())
+        self.assertEqual(other.dir_hash('dir2'), self.snapshot.dir_hash('dir2'))
+        self.assertEqual(sorted(self.snapshot.differing_files(other)), ['dir/b.txt', 'dir/sub/b.txt'])
+
+    def test_differing_files(self):
+        other = self.snapshot.copy()
+        self.assertEqual(self.snapshot.differing_files(other), [])
+        other['dir/sub/c.txt'] = [3, md5('c changed')]
+        other['dir3/e.txt'] = [7, md5('e')]
+        other.pop('a.txt')
+        # A file replaced by a directory
+        other.pop(u'dir2/d\xe8.txt')
+        other[u'dir2/d\xe8.txt/f.txt'] = [8, md5('f')]
+        self.assertEqual(sorted(self.snapshot.differing_files(other)),
+                         sorted(['a.txt', 'dir/sub/c.txt', 'dir3/e.txt', u'dir2/d\xe8.txt', u'dir2/d\xe8.txt/f.txt']))
+
+
+if __name__ == '__main__':
+    unittest.main()
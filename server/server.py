@@ -11,13 +11,19 @@ import hashlib
 import time
 import string
 import re
+import sqlite3
+import hmac
+import collections
+import threading
+import tempfile
+import tarfile
 
 join = os.path.join
 normpath = os.path.normpath
 abspath = os.path.abspath
 
 
-from flask import Flask, make_response, request, abort, jsonify
+from flask import Flask, Request, Response, make_response, request, abort, jsonify, g, send_file
 from flask.ext.httpauth import HTTPBasicAuth
 from flask.ext.restful import Resource, Api
 from flask.ext.mail import Mail, Message
@@ -31,11 +37,14 @@ __title__ = 'PyBOX'
 HTTP_OK = 200
 HTTP_CREATED = 201
 HTTP_ACCEPTED = 202
+HTTP_PARTIAL_CONTENT = 206
+HTTP_NOT_MODIFIED = 304
 HTTP_BAD_REQUEST = 400
 HTTP_UNAUTHORIZED = 401
 HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_CONFLICT = 409
+HTTP_RANGE_NOT_SATISFIABLE = 416
 #HTTP 204 No Content: The server successfully processed the request, but is not
 #returning any content. Usually used as a response to a successful delete request.
 HTTP_DELETED = 204 
@@ -46,6 +55,31 @@ URL_PREFIX = '/API/V1'
 SERVER_DIRECTORY = os.path.dirname(__file__)
 # Users login data are stored in a json file in the server
 USERDATA_FILENAME = 'userdata.json'
+# Metadata changes made after the last userdata snapshot are appended to this journal (one json record per line)
+USERDATA_JOURNAL_FILENAME = 'userdata.journal'
+# Number of journal records after which the journal is compacted into the userdata snapshot
+JOURNAL_COMPACTION_THRESHOLD = 10000
+# Users data database used by the sqlite storage backend
+USERDATA_DB_FILENAME = 'userdata.db'
+# Directory (inside FILE_ROOT, so on the same filesystem) where uploads are written before being renamed into place
+UPLOAD_STAGING_DIR = '.uploads'
+# Directory (inside FILE_ROOT) of the chunked upload sessions, resumable until committed
+UPLOAD_SESSIONS_DIR = '.upload_sessions'
+UPLOAD_SESSION_TTL = 60 * 60 * 24 * 7  # seconds since the last received chunk
+# Directory (inside FILE_ROOT) of the blob store: the file contents, stored once by md5, linked by the user files
+OBJECTS_DIR = '.objects'
+# Size of the blocks whose md5 are the file signatures, used to upload only the changed blocks of a file
+SIGNATURE_BLOCK_SIZE = 2 ** 18
+# Pax header of the bundle (tar archive) entries with the md5 of the entry content
+BUNDLE_MD5_HEADER = 'PYBOX.md5'
+# Files bigger than this are left out of the download bundles, to be downloaded by themselves (by ranges)
+BUNDLE_FILE_MAX_SIZE = 2 ** 20
+# Size of the reads of the files streamed in a download bundle
+BUNDLE_READ_SIZE = 2 ** 16
+# Max number of changes kept in memory for each user to answer delta snapshot requests
+CHANGELOG_SIZE = 10000
+# Max time (in seconds) a change notification request waits for changes
+LONG_POLL_MAX_WAIT = 60
 PASSWORD_RECOVERY_EMAIL_TEMPLATE_FILE_PATH = os.path.join(SERVER_DIRECTORY,
                                                           'password_recovery_email_template.txt')
 SIGNUP_EMAIL_TEMPLATE_FILE_PATH = os.path.join(SERVER_DIRECTORY,
@@ -63,9 +97,23 @@ USER_CREATION_TIME = 'creation_timestamp'
 DEFAULT_USER_DIRS = ('Misc', 'Music', 'Photos', 'Projects', 'Work')
 USER_IS_ACTIVE = 'active'
 USER_CREATION_DATA = 'activation_data'
+# Per-user containers journaled path by path instead of as a whole.
+PATH_CONTAINERS = (SNAPSHOT, SHARED_FILES)
+# Change timestamp of a delta snapshot (to be given as <since> argument to get the next delta)
+CHANGELOG_TIMESTAMP = 'changelog_timestamp'
 
 UNWANTED_PASS = 'words'
 
+# Verified credentials are cached to skip the (slow on purpose) password hash check on repeated requests.
+CREDENTIALS_CACHE_TTL = 60 * 5  # seconds
+CREDENTIALS_CACHE_SIZE = 1024
+
+# Session tokens are sent as basic auth passwords, and verified with a cheap HMAC check.
+SESSION_TOKEN_PREFIX = 'session:'
+SESSION_TOKEN_TTL = 60 * 60  # seconds
+# Response header carrying a new session token.
+SESSION_TOKEN_HEADER = 'X-Session-Token'
+
 
 class ServerError(Exception):
     pass
@@ -110,8 +158,368 @@ logger.info('Server {} at {}'.format(launched_or_imported, datetime.datetime.now
 # Server initialization
 # =====================
 userdata = {}
+# Changes made to <userdata> by the current request and not yet journaled:
+# (username, container, path) tuples, where container and path are None for account-level changes.
+pending_changes = []
+# Per-user ChangeLog instances of the path changes (created when the first change of the user is committed)
+changelogs = {}
+# Notified when new changes are logged (i.e. to wake up the pending change notification requests)
+changes_condition = threading.Condition()
+# The server runs threaded to hold the change notification requests, while the requests
+# (that read or change <userdata>) are still served one at a time.
+userdata_lock = threading.RLock()
+
+# Verified credentials cache: {hmac(username, password): (username, stored password hash, expiry time)}
+credentials_cache = collections.OrderedDict()
+# Random key (never stored) used to not keep plain passwords (or their fast hashes) in memory.
+credentials_cache_key = os.urandom(32)
+# Session tokens signing key: tokens are valid until the server restarts (or they expire).
+session_secret_key = os.urandom(32)
+# Serializes the state updates of the upload sessions (whose chunks are received concurrently)
+upload_sessions_lock = threading.Lock()
+# Per-user index of the contents the user can claim: {username: (last user change timestamp, {md5: server path})}
+content_indexes = {}
+# Per-user directory hashes of the user files: {username: DirectoryHashes}
+dir_hashes = {}
+
+
+
+def blob_bucket(md5):
+    """
+    Return the directory, in the blob store, of the blobs of the file contents whose md5 is <md5>.
+    :param md5: str
+    :return: str
+    """
+    return join(FILE_ROOT, OBJECTS_DIR, md5[:2], md5)
+
+
+def blob_path(md5, sha256):
+    """
+    Return the path of the blob of the file content whose md5 is <md5> and whose sha256 is <sha256>.
+    Blobs are keyed by sha256, and grouped by the md5 the clients know the contents by:
+    different contents with the same md5 are stored as different blobs.
+    :param md5: str
+    :param sha256: str
+    :return: str
+    """
+    return join(blob_bucket(md5), sha256)
+
+
+def link_file(src, dst):
+    """
+    Make dst (replacing it if it exists) a hard link to the file src, i.e. a copy which takes no disk space.
+    The server never writes files in place, so linked files are never changed together.
+    :param src: str
+    :param dst: str
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    staging_dir = join(FILE_ROOT, UPLOAD_STAGING_DIR)
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    tmp_path = join(staging_dir, '{}.link'.format(os.urandom(8).encode('hex')))
+    os.link(src, tmp_path)
+    os.rename(tmp_path, dst)
+
+
+def store_file(src_path, md5, sha256, filepath):
+    """
+    Store the file src_path, whose content md5 is <md5> and sha256 is <sha256>, as the user file filepath
+    (replacing it if it exists).
+    Each content is stored once, in the blob store, and the user files are hard links to their blob
+    (so the blob refcount is its number of links): if the blob already exists src_path is just removed.
+    :param src_path: str
+    :param md5: str
+    :param sha256: str
+    :param filepath: str
+    """
+    path = blob_path(md5, sha256)
+    if os.path.isfile(path):
+        os.remove(src_path)
+    else:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(src_path, path)
+    link_file(path, filepath)
+
+
+def release_blob(md5):
+    """
+    Remove the blobs of the contents whose md5 is <md5> that no user file links anymore.
+    :param md5: str
+    """
+    bucket = blob_bucket(md5)
+    try:
+        for sha256 in os.listdir(bucket):
+            path = join(bucket, sha256)
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+        if not os.listdir(bucket):
+            os.rmdir(bucket)
+    except OSError:
+        pass
+
+
+class StagedUpload(object):
+    """
+    Temporary file in the upload staging directory, used as the stream of an uploaded file:
+    the md5 (sent to the clients) and the sha256 (the blob store key) of the content are computed
+    while the request body is written, so the upload is never read again, and the file is atomically
+    renamed to its destination.
+    """
+    def __init__(self):
+        staging_dir = join(FILE_ROOT, UPLOAD_STAGING_DIR)
+        if not os.path.isdir(staging_dir):
+            os.makedirs(staging_dir)
+        fd, self.name = tempfile.mkstemp(dir=staging_dir)
+        self.file = os.fdopen(fd, 'w+b')
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.committed = False
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def commit(self, filepath):
+        """
+        Store the uploaded file as filepath (replacing an existing file).
+        :param filepath: str
+        """
+        self.file.close()
+        os.chmod(self.name, 0644)  # mkstemp creates the file readable only by the owner
+        store_file(self.name, self.hexdigest(), self.sha256.hexdigest(), filepath)
+        self.committed = True
+
+    def discard(self):
+        """
+        Remove the temporary file if it has not been committed.
+        """
+        self.file.close()
+        if not self.committed and os.path.exists(self.name):
+            os.remove(self.name)
+
+
+class ClaimedContent(object):
+    """
+    Content already stored in the server (in the user files or in the files shared with the user),
+    claimed by md5 and size instead of being uploaded again.
+    """
+    def __init__(self, src_path, md5):
+        self.src_path = src_path
+        self.md5 = md5
+
+    def hexdigest(self):
+        return self.md5
+
+    def commit(self, filepath):
+        """
+        Make filepath (replacing an existing file) share the claimed content.
+        :param filepath: str
+        """
+        link_file(self.src_path, filepath)
+
+    def discard(self):
+        pass
+
+
+class UploadSession(object):
+    """
+    Chunked upload of a file. The received chunks are verified and written in place in a file of the final size
+    and the received byte ranges are recorded beside it, so the upload can be resumed (even after a server restart)
+    until it's committed by a Files post or put.
+    """
+    def __init__(self, upload_id, username, size, received=None):
+        self.upload_id = upload_id
+        self.username = username
+        self.size = size
+        # {str offset: length}
+        self.received = received or {}
+        self.data_path = join(FILE_ROOT, UPLOAD_SESSIONS_DIR, upload_id)
+        self.state_path = self.data_path + '.json'
+        self.content_md5 = None
+        self.content_sha256 = None
+
+    @classmethod
+    def create(cls, username, size):
+        """
+        Start a new upload session of a file of <size> bytes (removing the expired ones).
+        :param username: str
+        :param size: int
+        """
+        sessions_dir = join(FILE_ROOT, UPLOAD_SESSIONS_DIR)
+        if not os.path.isdir(sessions_dir):
+            os.makedirs(sessions_dir)
+        expiry = time.time() - UPLOAD_SESSION_TTL
+        for filename in os.listdir(sessions_dir):
+            path = join(sessions_dir, filename)
+            if os.path.getmtime(path) < expiry:
+                os.remove(path)
+        upload_session = cls(os.urandom(16).encode('hex'), username, size)
+        with open(upload_session.data_path, 'wb') as f:
+            f.truncate(size)
+        upload_session.save()
+        return upload_session
+
+    @classmethod
+    def load(cls, upload_id, username):
+        """
+        Return the upload session <upload_id> of the user, or None if it doesn't exist.
+        :param upload_id: str
+        :param username: str
+        """
+        if not upload_id or not all(c in string.hexdigits for c in upload_id):
+            return None
+        upload_session = cls(upload_id, username, 0)
+        try:
+            with open(upload_session.state_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if state['username'] != username:
+            return None
+        upload_session.size = state['size']
+        upload_session.received = state['received']
+        return upload_session
+
+    def save(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'username': self.username, 'size': self.size, 'received': self.received}, f)
+        os.rename(tmp_path, self.state_path)
+
+    def status(self):
+        """
+        Return the upload session state, sent to the client.
+        json format: {'upload_id': str, 'size': int, 'received': [[<offset>, <length>], ...]}
+        """
+        return {'upload_id': self.upload_id,
+                'size': self.size,
+                'received': sorted([int(offset), length] for offset, length in self.received.iteritems())}
+
+    def write_chunk(self, offset, stream, md5, chunk_len=2 ** 16):
+        """
+        Stage the chunk read from stream, computing its md5 at the same time, and if the md5 is the given one
+        write it at the given offset and record it as received.
+        Chunks of different requests can be received at the same time, but a chunk overlapping the bytes
+        already received is rejected, so the bytes acknowledged to the client are never overwritten.
+        Return False if the md5 doesn't match, the chunk exceeds the file size or it overlaps the received bytes.
+        :param offset: int
+        :param stream: file
+        :param md5: str
+        :return: bool
+        """
+        staged_chunk = StagedUpload()
+        try:
+            length = 0
+            while True:
+                chunk = stream.read(chunk_len)
+                if not chunk:
+                    break
+                length += len(chunk)
+                if offset + length > self.size:
+                    return False
+                staged_chunk.write(chunk)
+            if staged_chunk.hexdigest() != md5:
+                return False
+            staged_chunk.seek(0)
+            with upload_sessions_lock:
+                # Reload the state, that could be changed by the concurrent chunk requests.
+                self.received = UploadSession.load(self.upload_id, self.username).received
+                if self._overlaps_received(offset, length):
+                    return False
+                with open(self.data_path, 'r+b') as f:
+                    f.seek(offset)
+                    shutil.copyfileobj(staged_chunk, f, chunk_len)
+                self.received[str(offset)] = length
+                self.save()
+            return True
+        finally:
+            staged_chunk.discard()
+
+    def _overlaps_received(self, offset, length):
+        """
+        Check if the <length> bytes starting at <offset> overlap the bytes already received.
+        :return: bool
+        """
+        for received_offset, received_length in self.received.iteritems():
+            if int(received_offset) < offset + length and offset < int(received_offset) + received_length:
+                return True
+        return False
+
+    def is_complete(self):
+        """
+        Check if all the bytes of the file have been received.
+        :return: bool
+        """
+        end = 0
+        for offset, length in sorted((int(offset), length) for offset, length in self.received.iteritems()):
+            if offset > end:
+                return False
+            end = max(end, offset + length)
+        return end >= self.size
+
+    def _calculate_digests(self, chunk_len=2 ** 16):
+        """
+        Compute the md5 and the sha256 of the uploaded file, reading it once.
+        """
+        md5, sha256 = hashlib.md5(), hashlib.sha256()
+        with open(self.data_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_len)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                sha256.update(chunk)
+        self.content_md5, self.content_sha256 = md5.hexdigest(), sha256.hexdigest()
+
+    def hexdigest(self):
+        if self.content_md5 is None:
+            self._calculate_digests()
+        return self.content_md5
+
+    def commit(self, filepath):
+        """
+        Store the uploaded file as filepath (replacing an existing file) and close the session.
+        :param filepath: str
+        """
+        os.chmod(self.data_path, 0644)
+        store_file(self.data_path, self.hexdigest(), self.content_sha256, filepath)
+        os.remove(self.state_path)
+
+    def discard(self):
+        for path in (self.data_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class UploadRequest(Request):
+    """
+    Request that writes the uploaded files to StagedUpload instances.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return self.new_staged_upload()
+
+    def new_staged_upload(self):
+        """
+        Return a new StagedUpload, removed at the end of the request if it isn't committed.
+        """
+        staged_upload = StagedUpload()
+        if not hasattr(self, 'staged_uploads'):
+            self.staged_uploads = []
+        self.staged_uploads.append(staged_upload)
+        return staged_upload
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.testing = __name__ != '__main__'  # Reasonable assumption?
 # if True, you can see the exception traceback, suppress the sending of emails, etc.
 EMAIL_SETTINGS_FILEPATH = join(os.path.dirname(__file__),
@@ -272,15 +680,326 @@ def init_user_directory(username, default_dirs=DEFAULT_USER_DIRS):
     return compute_dir_state(dirpath)
 
 
-def load_userdata():
-    data = {}
-    try:
-        with open(USERDATA_FILENAME, 'rb') as fp:
-            data = json.load(fp, 'utf-8')
-    except IOError:
-        # If the user data file does not exists, don't raise an exception.
-        # (the file will be created with the first user creation)
+def _apply_journal_record(data, record):
+    """
+    Apply a single journal record to the userdata dict <data>.
+    Records are lists in one of these formats:
+        ['user', username, account_fields, containers]
+        ['deluser', username]
+        ['path', username, container, path, value]  (value None means the path was removed)
+    """
+    kind, username = record[0], record[1]
+    if kind == 'user':
+        fields, containers = record[2], record[3]
+        old = data.get(username, {})
+        for container in containers:
+            fields[container] = old.get(container, {})
+        data[username] = fields
+    elif kind == 'deluser':
+        data.pop(username, None)
+    elif kind == 'path':
+        container, path, value = record[2], record[3], record[4]
+        single_user_data = data.get(username)
+        if single_user_data is None:
+            return
+        if value is None:
+            single_user_data.get(container, {}).pop(path, None)
+        else:
+            single_user_data.setdefault(container, {})[path] = value
+    else:
+        raise ServerInternalError('Unknown journal record: {}'.format(record))
+
+
+class JsonStorage(object):
+    """
+    Store userdata in a json snapshot file plus an append-only journal of the changes made after it.
+    """
+    name = 'json'
+
+    def __init__(self, snapshot_filename=USERDATA_FILENAME, journal_filename=USERDATA_JOURNAL_FILENAME):
+        self.snapshot_filename = snapshot_filename
+        self.journal_filename = journal_filename
+        # Number of records in the journal since the last snapshot.
+        self.journal_length = 0
+
+    def load(self):
+        """
+        Load the userdata snapshot from disk and replay the journal on it.
+        :return: dict
+        """
+        data = {}
+        try:
+            with open(self.snapshot_filename, 'rb') as fp:
+                data = json.load(fp, 'utf-8')
+        except IOError:
+            # If the user data file does not exists, don't raise an exception.
+            # (the file will be created with the first user creation)
+            pass
+
+        self.journal_length = 0
+        try:
+            with open(self.journal_filename, 'rb') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line, 'utf-8')
+                    except ValueError:
+                        # A truncated last record (i.e. crash while appending) is lost, like the request that wrote it.
+                        logger.warn('Skipping corrupted journal record: {}'.format(repr(line)))
+                        continue
+                    _apply_journal_record(data, record)
+                    self.journal_length += 1
+        except IOError:
+            pass
+        logger.debug('{:,} journal records replayed'.format(self.journal_length))
+        return data
+
+    def save(self, data):
+        """
+        Write <data> as the new json snapshot and truncate the journal.
+        The snapshot is written to a temporary file and renamed over the old one,
+        so a crash never leaves a half-written userdata file.
+        """
+        tmp_filename = self.snapshot_filename + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            json.dump(data, fp, 'utf-8', indent=4)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_filename, self.snapshot_filename)
+        with open(self.journal_filename, 'wb'):
+            pass
+        self.journal_length = 0
+
+    def write_changes(self, records):
+        """
+        Append the journal <records> to the journal file.
+        """
+        with open(self.journal_filename, 'ab') as fp:
+            fp.write(''.join(json.dumps(record, encoding='utf-8') + '\n' for record in records))
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.journal_length += len(records)
+
+    def attach(self, username, single_user_data):
+        """
+        The whole userdata is kept in memory: nothing to do.
+        """
         pass
+
+
+class SqliteContainer(collections.MutableMapping):
+    """
+    The <files> or <shared_files> of an user stored in the files table of a SqliteStorage:
+    each path is read from and written to the database when it's accessed, so the path containers
+    are never loaded in memory. The writes join the transaction committed by the next commit_userdata().
+    """
+    def __init__(self, conn, username, container):
+        self.conn = conn
+        self.username = username
+        self.container = container
+
+    def __getitem__(self, path):
+        row = self.conn.execute('SELECT timestamp, md5 FROM files WHERE username = ? AND container = ? AND path = ?',
+                                (self.username, self.container, path)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return list(row)
+
+    def __setitem__(self, path, value):
+        self.conn.execute('INSERT OR REPLACE INTO files (username, container, path, timestamp, md5) '
+                          'VALUES (?, ?, ?, ?, ?)', (self.username, self.container, path, value[0], value[1]))
+
+    def __delitem__(self, path):
+        cursor = self.conn.execute('DELETE FROM files WHERE username = ? AND container = ? AND path = ?',
+                                   (self.username, self.container, path))
+        if not cursor.rowcount:
+            raise KeyError(path)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM files WHERE username = ? AND container = ?',
+                                 (self.username, self.container)).fetchone()[0]
+
+    def keys(self):
+        # Fetched at once, so the container can be changed while its paths are iterated.
+        return [path for path, in self.conn.execute('SELECT path FROM files WHERE username = ? AND container = ?',
+                                                    (self.username, self.container))]
+
+    def iteritems(self):
+        for path, timestamp, md5 in self.conn.execute(
+                'SELECT path, timestamp, md5 FROM files WHERE username = ? AND container = ?',
+                (self.username, self.container)).fetchall():
+            yield path, [timestamp, md5]
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+
+class SqliteStorage(object):
+    """
+    Store userdata in a sqlite database: account data in the users table (as json, without the path containers
+    and the shares), every <files> and <shared_files> entry as a row of the files table, keyed by
+    (username, container, path), and the shares as rows of the grants table, keyed by (owner, path, grantee).
+    The loaded path containers are SqliteContainer instances, so the request handlers look every path up
+    in the database and only the accounts and the shares are kept in memory.
+    The changes of a request are written in a single transaction.
+    """
+    name = 'sqlite'
+    # Changes are written in place, so there is never a journal to compact.
+    journal_length = 0
+    # Account fields rebuilt from the grants table
+    SHARE_FIELDS = ('shared_with_me', 'shared_with_others')
+
+    def __init__(self, filename=USERDATA_DB_FILENAME):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS users ('
+                              'username TEXT PRIMARY KEY, '
+                              'data TEXT NOT NULL, '
+                              'containers TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                              'username TEXT NOT NULL, '
+                              'container TEXT NOT NULL, '
+                              'path TEXT NOT NULL, '
+                              'timestamp INTEGER NOT NULL, '
+                              'md5 TEXT NOT NULL, '
+                              'PRIMARY KEY (username, container, path))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS grants ('
+                              'owner TEXT NOT NULL, '
+                              'path TEXT NOT NULL, '
+                              'grantee TEXT NOT NULL, '
+                              'PRIMARY KEY (owner, path, grantee))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS grants_grantee ON grants (grantee)')
+
+    def load(self):
+        """
+        Load the accounts and the shares from the database, with the path containers bound to it.
+        :return: dict
+        """
+        data = {}
+        for username, fields, containers in self.conn.execute('SELECT username, data, containers FROM users'):
+            single_user_data = json.loads(fields)
+            for field in self.SHARE_FIELDS:
+                single_user_data[field] = {}
+            for container in json.loads(containers):
+                single_user_data[container] = SqliteContainer(self.conn, username, container)
+            data[username] = single_user_data
+        for owner, path, grantee in self.conn.execute('SELECT owner, path, grantee FROM grants ORDER BY rowid'):
+            if owner in data:
+                data[owner]['shared_with_others'].setdefault(path, []).append(grantee)
+            if grantee in data:
+                data[grantee]['shared_with_me'].setdefault(owner, []).append(path)
+        return data
+
+    def attach(self, username, single_user_data):
+        """
+        Bind to the database the path containers of <single_user_data> that are still in memory
+        (i.e. of a new user), storing their entries.
+        """
+        for container in PATH_CONTAINERS:
+            value = single_user_data.get(container)
+            if value is not None and not isinstance(value, SqliteContainer):
+                bound = SqliteContainer(self.conn, username, container)
+                with self.conn:
+                    bound.update(value)
+                single_user_data[container] = bound
+
+    def _write_record(self, record):
+        kind, username = record[0], record[1]
+        if kind == 'user':
+            fields = dict((key, value) for key, value in record[2].iteritems() if key not in self.SHARE_FIELDS)
+            self.conn.execute('INSERT OR REPLACE INTO users (username, data, containers) VALUES (?, ?, ?)',
+                              (username, json.dumps(fields), json.dumps(record[3])))
+            # The grants are written from the owner side: shared_with_me is rebuilt from them.
+            self.conn.execute('DELETE FROM grants WHERE owner = ?', (username,))
+            for path, grantees in record[2].get('shared_with_others', {}).iteritems():
+                self.conn.executemany('INSERT OR IGNORE INTO grants (owner, path, grantee) VALUES (?, ?, ?)',
+                                      [(username, path, grantee) for grantee in grantees])
+        elif kind == 'deluser':
+            self.conn.execute('DELETE FROM users WHERE username = ?', (username,))
+            self.conn.execute('DELETE FROM files WHERE username = ?', (username,))
+            self.conn.execute('DELETE FROM grants WHERE owner = ?', (username,))
+        elif kind == 'path':
+            # Already written if the container is bound to the database: rewriting it is harmless.
+            container, path, value = record[2], record[3], record[4]
+            if value is None:
+                self.conn.execute('DELETE FROM files WHERE username = ? AND container = ? AND path = ?',
+                                  (username, container, path))
+            else:
+                self.conn.execute('INSERT OR REPLACE INTO files (username, container, path, timestamp, md5) '
+                                  'VALUES (?, ?, ?, ?, ?)', (username, container, path, value[0], value[1]))
+        else:
+            raise ServerInternalError('Unknown journal record: {}'.format(record))
+
+    def save(self, data):
+        """
+        Replace the database content with <data>.
+        """
+        # Read the bound containers before their rows are deleted.
+        records = [record for username, single_user_data in data.iteritems()
+                   for record in _user_records(username, single_user_data)]
+        with self.conn:
+            self.conn.execute('DELETE FROM users')
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute('DELETE FROM grants')
+            for record in records:
+                self._write_record(record)
+
+    def write_changes(self, records):
+        """
+        Apply the journal <records> to the database in a single transaction
+        (which includes the changes already written by the bound containers).
+        """
+        with self.conn:
+            for record in records:
+                self._write_record(record)
+
+
+STORAGE_BACKENDS = {JsonStorage.name: JsonStorage,
+                    SqliteStorage.name: SqliteStorage}
+
+# The userdata storage backend (changeable from command line)
+storage = JsonStorage()
+
+
+def _user_record(username, single_user_data):
+    """
+    Return the journal record of the account data (everything but the path containers) of <username>.
+    :return: list
+    """
+    fields = dict((key, value) for key, value in single_user_data.iteritems() if key not in PATH_CONTAINERS)
+    containers = [c for c in PATH_CONTAINERS if c in single_user_data]
+    return ['user', username, fields, containers]
+
+
+def _user_records(username, single_user_data):
+    """
+    Return the journal records needed to rebuild the whole <single_user_data> of <username>.
+    :return: list
+    """
+    records = [_user_record(username, single_user_data)]
+    containers = records[0][3]
+    for container in containers:
+        for path, value in single_user_data[container].iteritems():
+            records.append(['path', username, container, path, value])
+    return records
+
+
+def load_userdata():
+    """
+    Load the userdata from the storage backend.
+    :return: dict
+    """
+    data = storage.load()
     logger.debug('Registered user(s): {}'.format(', '.join(data.keys())))
     logger.info('{:,} registered user(s) found'.format(len(data)))
     return data
@@ -288,19 +1007,276 @@ def load_userdata():
 
 def save_userdata():
     """
-    Save module level <userdata> dict to disk as json.
+    Save the whole module level <userdata> dict to the storage backend
+    (for the json backend, write a new snapshot and truncate the journal).
     :return: None
     """
-    with open(USERDATA_FILENAME, 'wb') as fp:
-        json.dump(userdata, fp, 'utf-8', indent=4)
+    storage.save(userdata)
+    del pending_changes[:]
     logger.info('Saved {:,} users'.format(len(userdata)))
 
 
+def mark_changed(username, container=None, path=None):
+    """
+    Record that the <userdata> entry of <username> has been changed and must be journaled
+    by the next commit_userdata() call.
+    If <container> (SNAPSHOT or SHARED_FILES) and <path> are given, only that path is journaled,
+    otherwise the account data (everything but the containers) is journaled.
+    :param username: str
+    :param container: str
+    :param path: str
+    """
+    pending_changes.append((username, container, path))
+
+
+def _journal_record(username, container, path):
+    """
+    Build the journal record for a change marked by mark_changed(), reading the current value from <userdata>.
+    :return: list
+    """
+    single_user_data = userdata.get(username)
+    if container is None:
+        if single_user_data is None:
+            return ['deluser', username]
+        return _user_record(username, single_user_data)
+    if single_user_data is None:
+        value = None
+    else:
+        value = single_user_data.get(container, {}).get(path)
+    return ['path', username, container, path, value]
+
+
+class ChangeLog(object):
+    """
+    Bounded log of the changes of the paths of an user (<files> and <shared_files>), used to give
+    to the clients only the changes made after a given change timestamp instead of the whole snapshot.
+    Removed paths are logged as tombstones (value None).
+    """
+    # Changes made before the server start are not logged.
+    start_timestamp = now_timestamp()
+    # Last timestamp given to a change: change timestamps are strictly increasing.
+    last_timestamp = start_timestamp
+
+    def __init__(self, size=None):
+        self.size = size or CHANGELOG_SIZE
+        # (timestamp, container, path, value) tuples, sorted by timestamp
+        self.entries = collections.deque()
+        # Changes made up to this timestamp are no more (or were never) in the log.
+        self.truncated_at = ChangeLog.start_timestamp
+        # Timestamp of the last logged change
+        self.last_change = ChangeLog.start_timestamp
+
+    @classmethod
+    def new_timestamp(cls):
+        """
+        Return a new change timestamp (a server timestamp greater than the previous one).
+        :return: long
+        """
+        cls.last_timestamp = max(now_timestamp(), cls.last_timestamp + 1)
+        return cls.last_timestamp
+
+    def append(self, timestamp, container, path, value):
+        self.entries.append((timestamp, container, path, value))
+        self.last_change = timestamp
+        while len(self.entries) > self.size:
+            self.truncated_at = self.entries.popleft()[0]
+
+    def since(self, timestamp):
+        """
+        Return the changes made after <timestamp> as a dict {container: {path: value}} (with the last
+        value of each changed path, None for removed ones), or None if some of them are no more in the log.
+        :param timestamp: long
+        :return: dict
+        """
+        if timestamp < self.truncated_at:
+            return None
+        delta = dict((container, {}) for container in PATH_CONTAINERS)
+        for change_timestamp, container, path, value in reversed(self.entries):
+            if change_timestamp <= timestamp:
+                break
+            delta[container].setdefault(path, value)
+        return delta
+
+
+class DirectoryHashes(object):
+    """
+    Merkle tree of the <files> of an user: the hash of each directory is the xor of the hashes of its entries
+    (the md5 of the entry kind, name and file md5 or directory hash), so a changed path only updates the
+    hashes of the directories above it. The clients compute the same hashes to find which directories differ.
+    """
+    FILE = 'f'
+    DIR = 'd'
+    EMPTY_HASH = '0' * 32
+
+    def __init__(self, files, last_change):
+        # {dirpath: [xor of the entry hashes, {name: (kind, file md5 or directory hash)}]}, the root dirpath is ''
+        self.dirs = {}
+        # Change timestamp of the last change applied
+        self.last_change = last_change
+        for path, (_, md5) in files.iteritems():
+            self.update(path, md5)
+
+    @staticmethod
+    def entry_hash(kind, name, digest):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return int(hashlib.md5(kind + name + '\0' + digest).hexdigest(), 16)
+
+    def update(self, path, md5):
+        """
+        Set the md5 of the file at <path> (None if it has been removed).
+        """
+        parts = path.split('/')
+        kind, new_digest = DirectoryHashes.FILE, md5
+        while parts:
+            name = parts.pop()
+            dirpath = '/'.join(parts)
+            node = self.dirs.get(dirpath)
+            old_digest = node[1][name][1] if node and name in node[1] else None
+            if old_digest == new_digest:
+                break
+            if node is None:
+                node = self.dirs[dirpath] = [0, {}]
+            old_dir_digest = '%032x' % node[0] if node[1] else None
+            if old_digest is not None:
+                node[0] ^= self.entry_hash(kind, name, old_digest)
+                del node[1][name]
+            if new_digest is not None:
+                node[0] ^= self.entry_hash(kind, name, new_digest)
+                node[1][name] = (kind, new_digest)
+            if node[1]:
+                new_dir_digest = '%032x' % node[0]
+            else:
+                del self.dirs[dirpath]
+                new_dir_digest = None
+            if old_dir_digest == new_dir_digest:
+                break
+            kind, new_digest = DirectoryHashes.DIR, new_dir_digest
+
+    def get(self, dirpath):
+        """
+        Return the hash and the entries {name: [kind, digest]} of the directory at <dirpath> ('' for the root),
+        or None if there isn't any file in it.
+        :return: dict
+        """
+        node = self.dirs.get(dirpath)
+        if node is None:
+            if dirpath:
+                return None
+            return {'hash': DirectoryHashes.EMPTY_HASH, 'entries': {}}
+        return {'hash': '%032x' % node[0], 'entries': dict((name, list(entry)) for name, entry in node[1].iteritems())}
+
+
+def _log_changes(records):
+    """
+    Add the path changes of the journal <records> to the users change logs, and apply them
+    to the cached directory hashes.
+    """
+    with changes_condition:
+        timestamp = ChangeLog.new_timestamp()
+        for record in records:
+            if record[0] == 'path':
+                username, container, path, value = record[1:]
+                if username not in changelogs:
+                    changelogs[username] = ChangeLog()
+                changelogs[username].append(timestamp, container, path, value)
+                hashes = dir_hashes.get(username)
+                if hashes:
+                    if container == SNAPSHOT:
+                        hashes.update(path, value[1] if value else None)
+                    hashes.last_change = timestamp
+            elif record[0] == 'deluser':
+                # Start a new log: the removed user's paths are not logged as tombstones.
+                changelog = changelogs[record[1]] = ChangeLog()
+                changelog.truncated_at = changelog.last_change = timestamp
+                dir_hashes.pop(record[1], None)
+        changes_condition.notify_all()
+
+
+def last_user_change(username):
+    """
+    Return the change timestamp of the last logged change of <username>.
+    :return: long
+    """
+    changelog = changelogs.get(username)
+    return changelog.last_change if changelog else ChangeLog.start_timestamp
+
+
+def commit_userdata():
+    """
+    Write the changes marked since the last commit to the storage backend, so that the cost of
+    persisting a request is proportional to its changes instead of to the whole <userdata>.
+    The json journal is compacted into the userdata snapshot when it grows over JOURNAL_COMPACTION_THRESHOLD.
+    :return: int (number of journaled records)
+    """
+    if not pending_changes:
+        return 0
+    seen = set()
+    records = []
+    # Journal each changed entry once, with its final value.
+    for change in pending_changes:
+        if change in seen:
+            continue
+        seen.add(change)
+        records.append(_journal_record(*change))
+    del pending_changes[:]
+
+    storage.write_changes(records)
+    for record in records:
+        if record[0] == 'user':
+            storage.attach(record[1], userdata[record[1]])
+    _log_changes(records)
+    logger.debug('Journaled {:,} userdata changes'.format(len(records)))
+
+    if storage.journal_length > JOURNAL_COMPACTION_THRESHOLD:
+        save_userdata()
+    return len(records)
+
+
 def reset_userdata():
     """
     Clear userdata dictionary.
     """
     userdata.clear()
+    del pending_changes[:]
+    changelogs.clear()
+    content_indexes.clear()
+    dir_hashes.clear()
+
+
+def content_index(username):
+    """
+    Return the index {md5: server path} of the user files and of the files shared with the user,
+    rebuilt only when the user paths have changed.
+    :param username: str
+    :return: dict
+    """
+    last_change = last_user_change(username)
+    cached = content_indexes.get(username)
+    if cached and cached[0] == last_change:
+        return cached[1]
+    index = {}
+    for path, (_, md5) in userdata[username][SHARED_FILES].iteritems():
+        _, owner, owner_path = path.split('/', 2)
+        index[md5] = userpath2serverpath(owner, owner_path)
+    for path, (_, md5) in userdata[username][SNAPSHOT].iteritems():
+        index[md5] = userpath2serverpath(username, path)
+    content_indexes[username] = (last_change, index)
+    return index
+
+
+def user_dir_hashes(username):
+    """
+    Return the directory hashes of the user files, built when first needed and then updated
+    with the changes committed (rebuilt if they missed some).
+    :param username: str
+    :return: DirectoryHashes
+    """
+    last_change = last_user_change(username)
+    hashes = dir_hashes.get(username)
+    if hashes is None or hashes.last_change != last_change:
+        hashes = dir_hashes[username] = DirectoryHashes(userdata[username][SNAPSHOT], last_change)
+    return hashes
 
 
 def _is_shared_with_others(path, username):
@@ -314,10 +1290,92 @@ def _is_shared_with_others(path, username):
     return False
 
 
+def track_user_file(username, path, md5, last_server_timestamp):
+    """
+    Update <userdata> after a file of <username> has been written (without committing the changes).
+    :param username: str
+    :param path: str
+    :param md5: str (md5 of the written file)
+    :param last_server_timestamp: long
+    """
+    old_md5 = userdata[username]['files'].get(normpath(path), [None, None])[1]
+    userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
+    userdata[username]['files'][normpath(path)] = [last_server_timestamp, md5]
+    if old_md5 and old_md5 != md5:
+        release_blob(old_md5)
+    mark_changed(username)
+    mark_changed(username, SNAPSHOT, normpath(path))
+
+    # if path is a shared path then update userdata to permit all user to synchronize with the share
+    if _is_shared_with_others(path, username):
+        shared_path = path.split('/')[0]
+        for user in userdata[username]['shared_with_others'][shared_path]:
+            res = 'shared/{0}/{1}'.format(username, path)
+            userdata[user]['shared_files'][res] = [last_server_timestamp, md5]
+            mark_changed(user, SHARED_FILES, res)
+
+
+def _credentials_digest(username, password):
+    """
+    Return the key of the <username>, <password> pair in the credentials cache.
+    :return: str
+    """
+    return hmac.new(credentials_cache_key, '{}:{}'.format(username, password), hashlib.sha256).digest()
+
+
+def invalidate_credentials(username):
+    """
+    Remove all the cached credentials of <username> (i.e. when its password changes).
+    """
+    for digest, (cached_username, _, _) in credentials_cache.items():
+        if cached_username == username:
+            credentials_cache.pop(digest)
+
+
+def _session_token_mac(username, expiry, stored_pw):
+    """
+    Return the signature of a session token of <username> expiring at <expiry>.
+    The stored password hash is signed too, so that a password change invalidates the tokens.
+    :return: str
+    """
+    return hmac.new(session_secret_key, '{}|{}|{}'.format(username, expiry, stored_pw), hashlib.sha256).hexdigest()
+
+
+def make_session_token(username):
+    """
+    Return a new session token for <username>, valid for SESSION_TOKEN_TTL seconds.
+    Format: '<SESSION_TOKEN_PREFIX><expiry time>:<signature>'
+    :param username: str
+    :return: str
+    """
+    expiry = int(time.time()) + SESSION_TOKEN_TTL
+    return '{}{}:{}'.format(SESSION_TOKEN_PREFIX, expiry,
+                            _session_token_mac(username, expiry, userdata[username][PWD]))
+
+
+def check_session_token(username, token):
+    """
+    Return the expiry time of the session <token> of <username> if it is valid, otherwise None.
+    :return: int
+    """
+    try:
+        expiry, mac = token[len(SESSION_TOKEN_PREFIX):].split(':')
+        expiry = int(expiry)
+    except ValueError:
+        return None
+    if expiry < time.time():
+        return None
+    if not hmac.compare_digest(str(mac), _session_token_mac(username, expiry, userdata[username][PWD])):
+        return None
+    return expiry
+
+
 @auth.verify_password
 def verify_password(username, password):
     """
     We redefine this function to check password with the encrypted one.
+    Verified credentials are cached for CREDENTIALS_CACHE_TTL seconds.
+    A session token can be given instead of the password.
     """
     if not username:
         # Warning/info?
@@ -326,7 +1384,31 @@ def verify_password(username, password):
     if single_user_data:
         stored_pw = single_user_data.get(PWD)
         assert stored_pw is not None, 'Server error: user data must contain a password!'
-        res = sha256_crypt.verify(password, stored_pw)
+        if password.startswith(SESSION_TOKEN_PREFIX):
+            expiry = check_session_token(username, password)
+            if expiry is not None:
+                g.session_token_auth = True
+                # Renew the token when half of its life is gone.
+                g.renew_session_token = expiry - time.time() < SESSION_TOKEN_TTL / 2
+                return True
+        digest = _credentials_digest(username, password)
+        cached = credentials_cache.pop(digest, None)
+        # The stored password hash is checked too, so a changed password is never accepted from the cache.
+        if cached and cached[1] == stored_pw and cached[2] > time.time():
+            res = True
+        else:
+            res = sha256_crypt.verify(password, stored_pw)
+            if res:
+                cached = (username, stored_pw, time.time() + CREDENTIALS_CACHE_TTL)
+            else:
+                cached = None
+        if cached:
+            # (Re)insert as the most recently used entry, dropping the least recently used ones.
+            credentials_cache[digest] = cached
+            while len(credentials_cache) > CREDENTIALS_CACHE_SIZE:
+                credentials_cache.popitem(last=False)
+        # Give a session token to the client, to be used instead of the password in the next requests.
+        g.renew_session_token = res
     else:
         logger.info('User "{}" does not exist'.format(username))
         res = False
@@ -352,7 +1434,10 @@ def activate_user(username, encrypted_password):
                         'shared_files': {}
                         }
     userdata[username] = single_user_data
-    save_userdata()
+    mark_changed(username)
+    for path in dir_snapshot:
+        mark_changed(username, SNAPSHOT, path)
+    commit_userdata()
     response = 'User "{}" activated.\n'.format(username), HTTP_OK
 
     logger.debug(response)
@@ -373,7 +1458,8 @@ def create_user(username, password, activation_code):
                                                  'activation_code': activation_code}
                             }
         userdata[username] = single_user_data
-        save_userdata()
+        mark_changed(username)
+        commit_userdata()
         response = 'User activation email sent to {}'.format(username), HTTP_CREATED
     else:
         raise ServerInternalError('Unexpected error: username and password must not be empty here!!!\n'
@@ -440,6 +1526,7 @@ class Users(Resource):
                      USER_ACTIVATION_TIMEOUT]
         for username in to_remove:
             userdata.pop(username)
+            mark_changed(username)
         return to_remove
 
     @auth.login_required
@@ -533,6 +1620,7 @@ class Users(Resource):
 
         # Pending users cleanup
         expired_pending_users = self._clean_inactive_users()
+        commit_userdata()
         logging.info('Expired pending users: {}'.format(expired_pending_users))
 
         if username in userdata:
@@ -559,6 +1647,9 @@ class Users(Resource):
                         enc_pass = _encrypt_password(new_password)
                         userdata[username][PWD] = enc_pass
                         userdata[username].pop('recoverpass_data')
+                        invalidate_credentials(username)
+                        mark_changed(username)
+                        commit_userdata()
                         return 'Password changed succesfully', HTTP_OK
                 # NB: old generated tokens are refused, but, currently, they are not removed from userdata.
                 return 'Invalid code', HTTP_NOT_FOUND
@@ -603,9 +1694,13 @@ class Users(Resource):
         if userdata[username][USER_IS_ACTIVE]:
             # Remove also the user's folder
             shutil.rmtree(userpath2serverpath(username))
+            for _, md5 in userdata[username][SNAPSHOT].itervalues():
+                release_blob(md5)
 
         userdata.pop(username)
-        save_userdata()
+        invalidate_credentials(username)
+        mark_changed(username)
+        commit_userdata()
         return 'User "{}" removed.\n'.format(username), HTTP_OK
 
 
@@ -646,12 +1741,14 @@ class UsersRecoverPassword(Resource):
                 'recoverpass_code': recoverpass_code,
                 'timestamp': now_timestamp()
                 }
-            save_userdata()
+            mark_changed(username)
+            commit_userdata()
 
         elif userdata[username][USER_IS_ACTIVE] is False:
             userdata[username][USER_CREATION_DATA] = {'creation_timestamp': now_timestamp(),
                                                       'activation_code': recoverpass_code}
-            save_userdata()
+            mark_changed(username)
+            commit_userdata()
         # the else case is already covered in the first if
 
         return 'Reset email sent to {}'.format(username), HTTP_ACCEPTED
@@ -664,18 +1761,20 @@ class Actions(Resource):
         methods = {'delete': self._delete,
                    'copy': self._copy,
                    'move': self._move,
+                   'batch': self._batch,
                    }
         try:
             resp = methods[cmd](username)
         except KeyError:
             abort(HTTP_NOT_FOUND)
         else:
-            save_userdata()
+            commit_userdata()
             return resp
 
     def _delete(self, username):
         """
-        Delete a file for a given <filepath>, and return the current server timestamp in a json.
+        Delete a file (or a directory with all its files) for a given <filepath>, and return the current server
+        timestamp in a json.
         json format: {LAST_SERVER_TIMESTAMP: int}
         """
         filepath = request.form['filepath']
@@ -684,47 +1783,99 @@ class Actions(Resource):
             abort(HTTP_FORBIDDEN)
 
         abspath = os.path.abspath(join(FILE_ROOT, username, filepath))
-
-        try:
-            os.remove(abspath)
-        except OSError:
-            # This error raises when the file is missing
+        if os.path.isfile(abspath):
+            delete = self._delete_file
+        elif os.path.isdir(abspath):
+            if abspath == os.path.abspath(join(FILE_ROOT, username)):
+                abort(HTTP_FORBIDDEN)
+            delete = self._delete_dir
+        else:
             abort(HTTP_NOT_FOUND)
-        self._clear_dirs(os.path.dirname(abspath), username)
 
         # file deleted, last_server_timestamp is set to current timestamp
         last_server_timestamp = now_timestamp()
+        delete(username, filepath, last_server_timestamp)
+        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+
+    def _delete_file(self, username, filepath, last_server_timestamp):
+        """
+        Delete the file <filepath> (already checked) and its metadata.
+        """
+        abspath = os.path.abspath(join(FILE_ROOT, username, filepath))
+        os.remove(abspath)
+        self._clear_dirs(os.path.dirname(abspath), username)
+
         userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'].pop(normpath(filepath))
-
-        if _is_shared_with_others(filepath, username):
-            auto_remove_share = False
-            shared_path = filepath.split('/')[0]
-            # check if must be removed the share
-            shared_abspath = os.path.abspath(join(FILE_ROOT, username, shared_path))
-
-            if not os.path.exists(shared_abspath):
-                # maybe difficult to understand this check:
-                # if share_abspath is a file then the previous code has deleted it so it must be removed automatically
-                # by the share
-                #
-                # if share_abspath is a folder then we have 2 case:
-                # if the folder exist then it means that it isn't empty, otherwise the _clear_dirs function would have
-                # deleted it
-                # if the folder doesn't exists then it must be removed from share
-                auto_remove_share = True
-
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, filepath)
-                userdata[user]['shared_files'].pop(res)
-                if auto_remove_share:
-                    userdata[user]['shared_with_me'][username].remove(shared_path)
+        _, md5 = userdata[username]['files'].pop(normpath(filepath))
+        release_blob(md5)
+        mark_changed(username)
+        mark_changed(username, SNAPSHOT, normpath(filepath))
+        self._untrack_shared_paths(username, [normpath(filepath)])
 
-            if auto_remove_share:
-                userdata[username]['shared_with_others'].pop(shared_path)
+    def _delete_dir(self, username, dirpath, last_server_timestamp):
+        """
+        Delete the directory <dirpath> (already checked) with all its files and their metadata.
+        """
+        abspath = os.path.abspath(join(FILE_ROOT, username, dirpath))
+        shutil.rmtree(abspath)
+        self._clear_dirs(os.path.dirname(abspath), username)
 
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
+        mark_changed(username)
+        paths = self._dir_paths(username, dirpath)
+        for path in paths:
+            _, md5 = userdata[username]['files'].pop(path)
+            release_blob(md5)
+            mark_changed(username, SNAPSHOT, path)
+        self._untrack_shared_paths(username, paths)
+
+    def _dir_paths(self, username, dirpath):
+        """
+        Return the paths of the files of <username> inside the directory <dirpath>.
+        """
+        prefix = normpath(dirpath) + '/'
+        return [path for path in userdata[username]['files'] if path.startswith(prefix)]
+
+    def _track_shared_paths(self, username, paths, last_server_timestamp):
+        """
+        Add the new (or changed) <paths> of <username> to the shared files of the users they are shared with.
+        """
+        for path in paths:
+            if _is_shared_with_others(path, username):
+                md5 = userdata[username]['files'][path][1]
+                for user in userdata[username]['shared_with_others'][path.split('/')[0]]:
+                    res = 'shared/{0}/{1}'.format(username, path)
+                    userdata[user]['shared_files'][res] = [last_server_timestamp, md5]
+                    mark_changed(user, SHARED_FILES, res)
+
+    def _untrack_shared_paths(self, username, paths):
+        """
+        Remove the removed <paths> of <username> from the shared files of the users they are shared with,
+        and remove the shares whose root path has been removed.
+        """
+        shared_paths = set()
+        for path in paths:
+            if _is_shared_with_others(path, username):
+                shared_path = path.split('/')[0]
+                shared_paths.add(shared_path)
+                for user in userdata[username]['shared_with_others'][shared_path]:
+                    res = 'shared/{0}/{1}'.format(username, path)
+                    userdata[user]['shared_files'].pop(res)
+                    mark_changed(user, SHARED_FILES, res)
+
+        for shared_path in shared_paths:
+            # maybe difficult to understand this check:
+            # if the shared path is a file then the previous code has removed it so it must be removed automatically
+            # by the share
+            #
+            # if the shared path is a folder then we have 2 case:
+            # if the folder exist then it means that it isn't empty, otherwise the _clear_dirs function would have
+            # deleted it
+            # if the folder doesn't exists then it must be removed from share
+            if not os.path.exists(os.path.abspath(join(FILE_ROOT, username, shared_path))):
+                for user in userdata[username]['shared_with_others'].pop(shared_path):
+                    userdata[user]['shared_with_me'][username].remove(shared_path)
+                    mark_changed(user)
 
     def _copy(self, username):
         """
@@ -742,27 +1893,75 @@ class Actions(Resource):
             abort(HTTP_FORBIDDEN)
 
         if os.path.isfile(server_src):
-            if not os.path.exists(os.path.dirname(server_dst)):
-                os.makedirs(os.path.dirname(server_dst))
-            shutil.copy(server_src, server_dst)
+            copy = self._copy_file
+        elif os.path.isdir(server_src):
+            self._check_dir_transfer(username, src, dst)
+            copy = self._copy_dir
         else:
             abort(HTTP_NOT_FOUND)
 
-        last_server_timestamp = file_timestamp(server_dst)
+        last_server_timestamp = now_timestamp()
+        copy(username, src, dst, last_server_timestamp)
+        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+
+    def _copy_file(self, username, src, dst, last_server_timestamp):
+        """
+        Copy the file <src> (already checked) to <dst> and update the metadata.
+        """
+        server_src = userpath2serverpath(username, src)
+        server_dst = userpath2serverpath(username, dst)
+        if not os.path.exists(os.path.dirname(server_dst)):
+            os.makedirs(os.path.dirname(server_dst))
+        # The copy shares the content of the source.
+        link_file(server_src, server_dst)
 
         _, md5 = userdata[username]['files'][normpath(src)]
+        old_dst_md5 = userdata[username]['files'].get(normpath(dst), [None, None])[1]
         userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
         userdata[username]['files'][normpath(dst)] = [last_server_timestamp, md5]
+        if old_dst_md5 and old_dst_md5 != md5:
+            release_blob(old_dst_md5)
+        mark_changed(username)
+        mark_changed(username, SNAPSHOT, normpath(dst))
 
         # if path is a shared path then track it in all users that have that share
-        if _is_shared_with_others(normpath(dst), username):
-            shared_path = normpath(dst).split('/')[0]
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, normpath(dst))
-                userdata[user]['shared_files'][res] = [last_server_timestamp, md5]
+        self._track_shared_paths(username, [normpath(dst)], last_server_timestamp)
 
-        save_userdata()
-        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+    def _copy_dir(self, username, src, dst, last_server_timestamp):
+        """
+        Copy the directory <src> (already checked) with all its files to <dst> and update the metadata.
+        """
+        files = userdata[username]['files']
+        dst_paths = []
+        for src_path in self._dir_paths(username, src):
+            dst_path = join(normpath(dst), src_path[len(normpath(src)) + 1:])
+            server_dst = userpath2serverpath(username, dst_path)
+            if not os.path.exists(os.path.dirname(server_dst)):
+                os.makedirs(os.path.dirname(server_dst))
+            # The copies share the contents of the sources.
+            link_file(userpath2serverpath(username, src_path), server_dst)
+            files[dst_path] = [last_server_timestamp, files[src_path][1]]
+            mark_changed(username, SNAPSHOT, dst_path)
+            dst_paths.append(dst_path)
+
+        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
+        mark_changed(username)
+        self._track_shared_paths(username, dst_paths, last_server_timestamp)
+
+    def _check_dir_transfer(self, username, src, dst):
+        """
+        Abort the copy or move of the directory <src> to <dst> if it isn't allowed: the destination must be a new path
+        outside the source directory.
+        """
+        server_src = userpath2serverpath(username, src)
+        server_dst = userpath2serverpath(username, dst)
+        if not (check_path(src, username) and check_path(dst, username)) or \
+                server_src == userpath2serverpath(username):
+            abort(HTTP_FORBIDDEN)
+        if os.path.exists(server_dst):
+            abort(HTTP_CONFLICT)
+        if server_dst.startswith(server_src + os.sep):
+            abort(HTTP_BAD_REQUEST)
 
     def _move(self, username):
         """
@@ -778,34 +1977,117 @@ class Actions(Resource):
             abort(HTTP_FORBIDDEN)
 
         if os.path.isfile(server_src):
-            if not os.path.exists(os.path.dirname(server_dst)):
-                os.makedirs(os.path.dirname(server_dst))
-            shutil.move(server_src, server_dst)
+            move = self._move_file
+        elif os.path.isdir(server_src):
+            self._check_dir_transfer(username, src, dst)
+            move = self._move_dir
         else:
             abort(HTTP_NOT_FOUND)
-        self._clear_dirs(os.path.dirname(server_src), username)
 
         last_server_timestamp = now_timestamp()
+        move(username, src, dst, last_server_timestamp)
+        return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+
+    def _move_file(self, username, src, dst, last_server_timestamp):
+        """
+        Move the file <src> (already checked) to <dst> and update the metadata.
+        """
+        server_src = userpath2serverpath(username, src)
+        server_dst = userpath2serverpath(username, dst)
+        if not os.path.exists(os.path.dirname(server_dst)):
+            os.makedirs(os.path.dirname(server_dst))
+        shutil.move(server_src, server_dst)
+        self._clear_dirs(os.path.dirname(server_src), username)
 
         _, md5 = userdata[username]['files'][normpath(src)]
+        old_dst_md5 = userdata[username]['files'].get(normpath(dst), [None, None])[1]
         userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
         userdata[username]['files'].pop(normpath(src))
         userdata[username]['files'][normpath(dst)] = [last_server_timestamp, md5]
+        if old_dst_md5 and old_dst_md5 != md5:
+            release_blob(old_dst_md5)
+        mark_changed(username)
+        mark_changed(username, SNAPSHOT, normpath(src))
+        mark_changed(username, SNAPSHOT, normpath(dst))
 
         # if path is a shared path then track it in all users that have that share
-        if _is_shared_with_others(normpath(dst), username):
-            shared_path = normpath(dst).split('/')[0]
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, normpath(dst))
-                userdata[user]['shared_files'][res] = [last_server_timestamp, md5]
-
-        if _is_shared_with_others(normpath(src), username):
-            shared_path = normpath(src).split('/')[0]
-            for user in userdata[username]['shared_with_others'][shared_path]:
-                res = 'shared/{0}/{1}'.format(username, normpath(src))
-                userdata[user]['shared_files'].pop(res)
+        self._track_shared_paths(username, [normpath(dst)], last_server_timestamp)
+        self._untrack_shared_paths(username, [normpath(src)])
 
-        save_userdata()
+    def _move_dir(self, username, src, dst, last_server_timestamp):
+        """
+        Move the directory <src> (already checked) to <dst> with a single rename, and rewrite the paths
+        of its files in the metadata.
+        """
+        server_src = userpath2serverpath(username, src)
+        server_dst = userpath2serverpath(username, dst)
+        if not os.path.exists(os.path.dirname(server_dst)):
+            os.makedirs(os.path.dirname(server_dst))
+        os.rename(server_src, server_dst)
+        self._clear_dirs(os.path.dirname(server_src), username)
+
+        files = userdata[username]['files']
+        src_paths = self._dir_paths(username, src)
+        dst_paths = [join(normpath(dst), src_path[len(normpath(src)) + 1:]) for src_path in src_paths]
+        for src_path, dst_path in zip(src_paths, dst_paths):
+            files[dst_path] = [last_server_timestamp, files.pop(src_path)[1]]
+            mark_changed(username, SNAPSHOT, src_path)
+            mark_changed(username, SNAPSHOT, dst_path)
+
+        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
+        mark_changed(username)
+        self._track_shared_paths(username, dst_paths, last_server_timestamp)
+        self._untrack_shared_paths(username, src_paths)
+
+    def _batch(self, username):
+        """
+        Apply a list of delete/copy/move operations with a single metadata commit, and return
+        the server timestamp (the same for all the operations) in a json.
+        All the operations are checked (taking into account the previous ones) before applying any of them,
+        so that a batch with a wrong operation is rejected as a whole.
+        form: operations = json list of {'action': 'delete', 'filepath': str} or
+                                        {'action': 'copy' or 'move', 'src': str, 'dst': str}
+        json format: {LAST_SERVER_TIMESTAMP: int}
+        """
+        try:
+            operations = json.loads(request.form.get('operations', ''))
+        except ValueError:
+            abort(HTTP_BAD_REQUEST)
+        if not isinstance(operations, list) or not operations:
+            abort(HTTP_BAD_REQUEST)
+
+        # Paths created (True) or removed (False) by the operations already checked
+        batch_paths = {}
+
+        def is_file(path):
+            return batch_paths.get(normpath(path), os.path.isfile(userpath2serverpath(username, path)))
+
+        steps = []
+        for operation in operations:
+            action = operation.get('action') if isinstance(operation, dict) else None
+            if action == 'delete':
+                paths = [operation.get('filepath')]
+                apply_operation = self._delete_file
+            elif action == 'copy' or action == 'move':
+                paths = [operation.get('src'), operation.get('dst')]
+                apply_operation = self._copy_file if action == 'copy' else self._move_file
+            else:
+                abort(HTTP_BAD_REQUEST)
+            if not all(isinstance(path, basestring) and path for path in paths):
+                abort(HTTP_BAD_REQUEST)
+            if not all(check_path(path, username) for path in paths):
+                abort(HTTP_FORBIDDEN)
+            if not is_file(paths[0]):
+                abort(HTTP_NOT_FOUND)
+            if action != 'copy':
+                batch_paths[normpath(paths[0])] = False
+            if action != 'delete':
+                batch_paths[normpath(paths[1])] = True
+            steps.append((apply_operation, paths))
+
+        last_server_timestamp = now_timestamp()
+        for apply_operation, paths in steps:
+            apply_operation(username, *(paths + [last_server_timestamp]))
         return jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
 
     def _clear_dirs(self, path, root):
@@ -843,6 +2125,39 @@ def calculate_file_md5(fp, chunk_len=2 ** 16):
     return res
 
 
+def _read_file_range(fp, length, chunk_len=2 ** 16):
+    """
+    Yield <length> bytes read from the current position of the file fp, closing it at the end.
+    :fp: file (an open file object)
+    :length: int
+    :chunk_len: int (number of file bytes read per cycle - default = 2^16)
+    """
+    try:
+        while length > 0:
+            chunk = fp.read(min(chunk_len, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fp.close()
+
+
+def calculate_file_signature(fp, block_size=SIGNATURE_BLOCK_SIZE):
+    """
+    Return the list of the md5 digests of the consecutive blocks of the file content.
+    :fp: file (an open file object)
+    :block_size: int
+    """
+    blocks = []
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        blocks.append(hashlib.md5(block).hexdigest())
+    return blocks
+
+
 def compute_dir_state(root_path):  # TODO: make function accepting just an username instead of an user root_path.
     """
     Walk on root_path returning the directory snapshot in a dict (dict keys are identified by this 2 constants:
@@ -894,7 +2209,7 @@ class Shares(Resource):
 
         # create the share
         self._share(root_path, username, owner)
-        save_userdata()
+        commit_userdata()
 
         return HTTP_OK
 
@@ -910,12 +2225,12 @@ class Shares(Resource):
             users = userdata[owner]['shared_with_others'][root_path]
             for user in users:
                 self._remove_share_from_user(root_path, user, owner)
-                save_userdata()
+            commit_userdata()
             return HTTP_DELETED
 
         if username in userdata[owner]['shared_with_others'][root_path]:
             self._remove_share_from_user(root_path, username, owner)
-            save_userdata()
+            commit_userdata()
             return HTTP_DELETED
 
         abort(HTTP_NOT_FOUND)
@@ -931,14 +2246,18 @@ class Shares(Resource):
                     temp_path = string.replace(root, join(file_root_abs_path, owner), '')
                     res = 'shared/{0}/{1}'.format(owner, join(temp_path[1:], f))
                     userdata[username]['shared_files'].pop(res)
+                    mark_changed(username, SHARED_FILES, res)
 
             userdata[username]['shared_with_me'][owner].remove(root_path)
             userdata[owner]['shared_with_others'][root_path].remove(username)
         else:  # it's a single file
             res = 'shared/{0}/{1}'.format(owner, root_path)
             userdata[username]['shared_files'].pop(res)
+            mark_changed(username, SHARED_FILES, res)
             userdata[username]['shared_with_me'][owner].remove(root_path)
             userdata[owner]['shared_with_others'][root_path].remove(username)
+        mark_changed(username)
+        mark_changed(owner)
 
     def _is_shared(self, path, owner):
         """Check if the path is a valid shared path"""
@@ -961,6 +2280,8 @@ class Shares(Resource):
             abort(HTTP_CONFLICT)
         userdata[username]['shared_with_me'][owner].append(path)
         userdata[owner]['shared_with_others'][path].append(username)
+        mark_changed(username)
+        mark_changed(owner)
 
         # track the shared files into userdata
         abs_path = os.path.abspath(join(FILE_ROOT, owner, path))
@@ -969,9 +2290,13 @@ class Shares(Resource):
             for root, dirs, files in os.walk(abs_path):
                 for f in files:
                     temp_path = string.replace(root, join(file_root_abs_path, owner), '')
-                    userdata[username]['shared_files']['shared/{0}/{1}'.format(owner, join(temp_path[1:], f))] = userdata[owner]['files'][join(temp_path[1:], f)]
+                    res = 'shared/{0}/{1}'.format(owner, join(temp_path[1:], f))
+                    userdata[username]['shared_files'][res] = userdata[owner]['files'][join(temp_path[1:], f)]
+                    mark_changed(username, SHARED_FILES, res)
         else:
-            userdata[username]['shared_files']['shared/{0}/{1}'.format(owner, path)] = userdata[owner]['files'][path]
+            res = 'shared/{0}/{1}'.format(owner, path)
+            userdata[username]['shared_files'][res] = userdata[owner]['files'][path]
+            mark_changed(username, SHARED_FILES, res)
 
     def _is_sharable(self, path, owner):
         """
@@ -984,6 +2309,350 @@ class Shares(Resource):
         return False
 
 
+class Session(Resource):
+    """
+    Session tokens handling class.
+    """
+    @auth.login_required
+    def post(self):
+        """
+        Return a new session token for the logged user, to be used as basic auth password
+        instead of the real one. The request must be authenticated with the real password.
+        json format: {'token': str, 'ttl': int}
+        """
+        if getattr(g, 'session_token_auth', False):
+            abort(HTTP_FORBIDDEN)
+        # The token is already in the response json.
+        g.renew_session_token = False
+        resp = jsonify({'token': make_session_token(auth.username()),
+                        'ttl': SESSION_TOKEN_TTL})
+        resp.status_code = HTTP_CREATED
+        return resp
+
+
+class Changes(Resource):
+    """
+    Change notification (long polling) class.
+    """
+    @auth.login_required
+    def get(self):
+        """
+        Wait until the logged user snapshot changes after the change timestamp given as <since> argument,
+        for at most <wait> seconds (LONG_POLL_MAX_WAIT at most), and return if it changed.
+        json format: {CHANGELOG_TIMESTAMP: int, 'changed': bool}
+        """
+        username = auth.username()
+        try:
+            since = long(request.args['since'])
+            wait = min(float(request.args.get('wait', 0)), LONG_POLL_MAX_WAIT)
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+
+        deadline = time.time() + wait
+        # Let the other requests be served while waiting.
+        userdata_lock.release()
+        try:
+            with changes_condition:
+                while True:
+                    changed = last_user_change(username) > since
+                    remaining = deadline - time.time()
+                    if changed or remaining <= 0:
+                        break
+                    changes_condition.wait(remaining)
+                last_timestamp = ChangeLog.last_timestamp
+        finally:
+            userdata_lock.acquire()
+        return jsonify({CHANGELOG_TIMESTAMP: last_timestamp, 'changed': changed})
+
+
+class Uploads(Resource):
+    """
+    Chunked (resumable) uploads class. A completed upload is committed like an uploaded file,
+    posting or putting its <upload_id> (instead of the file) to the file path.
+    """
+    def _get_upload_session(self, upload_id):
+        upload_session = UploadSession.load(upload_id, auth.username())
+        if upload_session is None:
+            abort(HTTP_NOT_FOUND)
+        return upload_session
+
+    @auth.login_required
+    def post(self, upload_id=None):
+        """
+        Start the upload of a file of <size> bytes.
+        json format: see UploadSession.status()
+        """
+        if upload_id is not None:
+            abort(HTTP_BAD_REQUEST)
+        try:
+            size = int(request.form['size'])
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+        if size < 0:
+            abort(HTTP_BAD_REQUEST)
+        resp = jsonify(UploadSession.create(auth.username(), size).status())
+        resp.status_code = HTTP_CREATED
+        return resp
+
+    @auth.login_required
+    def get(self, upload_id):
+        """
+        Return the state of the upload (i.e. to resume it sending the chunks not yet received).
+        json format: see UploadSession.status()
+        """
+        return jsonify(self._get_upload_session(upload_id).status())
+
+    @auth.login_required
+    def put(self, upload_id):
+        """
+        Receive the chunk, sent as request body, starting at byte <offset>, whose md5 is <md5>.
+        json format: see UploadSession.status()
+        """
+        upload_session = self._get_upload_session(upload_id)
+        try:
+            offset = int(request.args['offset'])
+            md5 = request.args['md5']
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+        if not 0 <= offset <= upload_session.size:
+            abort(HTTP_BAD_REQUEST)
+
+        # Let the other requests (i.e. the other chunks) be served while receiving.
+        userdata_lock.release()
+        try:
+            received = upload_session.write_chunk(offset, request.stream, md5)
+        finally:
+            userdata_lock.acquire()
+        if not received:
+            abort(HTTP_CONFLICT)
+        return jsonify(upload_session.status())
+
+    @auth.login_required
+    def delete(self, upload_id):
+        """
+        Abort the upload.
+        """
+        self._get_upload_session(upload_id).discard()
+        return '', HTTP_DELETED
+
+
+class Signatures(Resource):
+    """
+    File signatures class: the md5 of the blocks of a file, used by the clients to upload only the changed blocks.
+    The blocks are at fixed offsets, so they don't survive an insert or a delete (which shifts all the next blocks):
+    only the blocks edited in place are the changed ones, otherwise most of the file is sent again.
+    """
+    @auth.login_required
+    def get(self, path):
+        """
+        Return the signature of the authenticated user file given its path relative to the user directory.
+        json format: {'md5': str, 'block_size': int, 'blocks': [<block md5>, ...]}
+        """
+        username = auth.username()
+        if not check_path(path, username):
+            abort(HTTP_FORBIDDEN)
+        if normpath(path) not in userdata[username][SNAPSHOT]:
+            abort(HTTP_NOT_FOUND)
+        try:
+            with open(userpath2serverpath(username, path), 'rb') as f:
+                blocks = calculate_file_signature(f, SIGNATURE_BLOCK_SIZE)
+        except IOError:
+            abort(HTTP_NOT_FOUND)
+        return jsonify({'md5': userdata[username][SNAPSHOT][normpath(path)][1],
+                        'block_size': SIGNATURE_BLOCK_SIZE,
+                        'blocks': blocks})
+
+
+class Hashes(Resource):
+    """
+    Directory hashes class: the Merkle tree of the user files, used by the clients to compare
+    only the directories whose hashes differ.
+    """
+    @auth.login_required
+    def get(self, path=''):
+        """
+        Return the hash and the entries of the authenticated user directory given its path relative to the
+        user directory (the root if not given).
+        json format: {'hash': str, 'entries': {<name>: [<'f' (file) or 'd' (directory)>, <md5 or hash>], ...}}
+        """
+        username = auth.username()
+        path = normpath(path).strip('/') if path else ''
+        if path and not check_path(path, username):
+            abort(HTTP_FORBIDDEN)
+        result = user_dir_hashes(username).get(path)
+        if result is None:
+            abort(HTTP_NOT_FOUND)
+        return jsonify(result)
+
+
+class Bundles(Resource):
+    """
+    Bundles class: many small files transferred with a single request, as a tar archive.
+    """
+    @auth.login_required
+    def post(self, cmd):
+        username = auth.username()
+        methods = {'upload': self._upload,
+                   'download': self._download,
+                   }
+        try:
+            method = methods[cmd]
+        except KeyError:
+            abort(HTTP_NOT_FOUND)
+        return method(username)
+
+    def _upload(self, username):
+        """
+        Create (or replace) the files of the tar archive sent as the request body, given the path
+        relative to the user directory as the entry name and its md5 as the BUNDLE_MD5_HEADER pax header.
+        The archive is read once, writing each entry to the staging directory while checking its md5,
+        then all the files are stored and their metadata committed together.
+        Return the server timestamp (the same for all the files).
+        json format: {LAST_SERVER_TIMESTAMP: int}
+        """
+        uploads = []
+        paths = set()
+        try:
+            bundle = tarfile.open(fileobj=request.stream, mode='r|', encoding='utf-8')
+            for entry in bundle:
+                path = normpath(entry.name.decode('utf-8'))
+                md5 = entry.pax_headers.get(BUNDLE_MD5_HEADER)
+                if not entry.isfile() or not md5 or path in paths:
+                    abort(HTTP_BAD_REQUEST)
+                if not check_path(path, username):
+                    abort(HTTP_FORBIDDEN)
+                if os.path.isdir(userpath2serverpath(username, path)):
+                    abort(HTTP_CONFLICT)
+                upload = request.new_staged_upload()
+                shutil.copyfileobj(bundle.extractfile(entry), upload)
+                if upload.hexdigest() != md5:
+                    abort(HTTP_CONFLICT)
+                uploads.append((path, upload))
+                paths.add(path)
+        except tarfile.TarError:
+            abort(HTTP_BAD_REQUEST)
+        if not uploads:
+            abort(HTTP_BAD_REQUEST)
+        # A file can't be stored under another file, already existent or in the bundle.
+        dirpaths = set()
+        for path in paths:
+            dirpath = os.path.dirname(path)
+            while dirpath and dirpath not in dirpaths:
+                dirpaths.add(dirpath)
+                dirpath = os.path.dirname(dirpath)
+        for dirpath in dirpaths:
+            server_dirpath = userpath2serverpath(username, dirpath)
+            if dirpath in paths or (os.path.exists(server_dirpath) and not os.path.isdir(server_dirpath)):
+                abort(HTTP_CONFLICT)
+
+        last_server_timestamp = now_timestamp()
+        for path, upload in uploads:
+            filepath = userpath2serverpath(username, path)
+            if not os.path.exists(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            upload.commit(filepath)
+            track_user_file(username, path, upload.hexdigest(), last_server_timestamp)
+        commit_userdata()
+
+        resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
+        resp.status_code = HTTP_CREATED
+        return resp
+
+    def _download(self, username):
+        """
+        Stream the tar archive of the files in <paths> (json list of paths relative to the user directory,
+        shared files included), with their md5 as the BUNDLE_MD5_HEADER pax header of the entries.
+        The unknown files and the files bigger than BUNDLE_FILE_MAX_SIZE are left out of the archive:
+        the client downloads them by themselves.
+        """
+        try:
+            paths = json.loads(request.form['paths'])
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+        if not isinstance(paths, list) or not all(isinstance(path, basestring) for path in paths):
+            abort(HTTP_BAD_REQUEST)
+
+        # The metadata are read now, while holding the userdata lock: the archive is streamed after
+        # the request is handled, so the files are opened (and skipped if missing) one at a time meanwhile.
+        entries = []
+        for path in paths:
+            path = normpath(path)
+            if path in userdata[username][SHARED_FILES]:
+                _, owner, owner_path = path.split('/', 2)
+                md5 = userdata[username][SHARED_FILES][path][1]
+            elif path in userdata[username][SNAPSHOT]:
+                owner, owner_path = username, path
+                md5 = userdata[username][SNAPSHOT][path][1]
+            else:
+                continue
+            entries.append((path, userpath2serverpath(owner, owner_path), md5))
+
+        def generate():
+            for path, filepath, md5 in entries:
+                try:
+                    f = open(filepath, 'rb')
+                except IOError:
+                    continue
+                with f:
+                    file_stat = os.fstat(f.fileno())
+                    if file_stat.st_size > BUNDLE_FILE_MAX_SIZE:
+                        continue
+                    entry = tarfile.TarInfo(path.encode('utf-8'))
+                    entry.size = file_stat.st_size
+                    entry.mtime = file_stat.st_mtime
+                    entry.pax_headers = {BUNDLE_MD5_HEADER: unicode(md5)}
+                    yield entry.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+                    remaining = entry.size
+                    while remaining:
+                        data = f.read(min(BUNDLE_READ_SIZE, remaining))
+                        if not data:
+                            # The file has been truncated meanwhile: the entry md5 check fails on the client.
+                            data = tarfile.NUL * remaining
+                        remaining -= len(data)
+                        yield data
+                    padding = entry.size % tarfile.BLOCKSIZE
+                    if padding:
+                        yield tarfile.NUL * (tarfile.BLOCKSIZE - padding)
+            # End of archive marker
+            yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+        return Response(generate(), mimetype='application/x-tar')
+
+
+@app.before_request
+def lock_userdata():
+    """
+    Serve one request at a time (change notification requests release the lock while waiting).
+    """
+    userdata_lock.acquire()
+    g.userdata_locked = True
+
+
+@app.teardown_request
+def unlock_userdata(exc):
+    if getattr(g, 'userdata_locked', False):
+        g.userdata_locked = False
+        userdata_lock.release()
+
+
+@app.teardown_request
+def discard_staged_uploads(exc):
+    for staged_upload in getattr(request, 'staged_uploads', []):
+        staged_upload.discard()
+
+
+@app.after_request
+def add_session_token(response):
+    """
+    Add a new session token to the response of requests authenticated with the password
+    or with a session token near to its expiry.
+    """
+    if getattr(g, 'renew_session_token', False) and response.status_code < HTTP_BAD_REQUEST \
+            and auth.username() in userdata:
+        response.headers[SESSION_TOKEN_HEADER] = make_session_token(auth.username())
+    return response
+
+
 class Files(Resource):
     """
     Class that handle files as web resources.
@@ -1010,6 +2679,7 @@ class Files(Resource):
             else:
                 if not check_path(path, username):
                     abort(HTTP_FORBIDDEN)
+                owner = username
                 user_rootpath = join(FILE_ROOT, username)
                 dirname = join(user_rootpath, os.path.dirname(path))
                 fp = path
@@ -1018,26 +2688,118 @@ class Files(Resource):
             if not os.path.exists(dirname):
                 abort(HTTP_NOT_FOUND)
             s_filename = secure_filename(os.path.split(path)[-1])
+            filepath = os.path.abspath(join(user_rootpath, fp))
+            # The md5 of the file content is its (strong) entity tag, used to validate the range requests.
+            md5 = userdata[owner][SNAPSHOT].get(normpath(fp), [None, None])[1]
 
             try:
-                response = make_response(_read_file(join(user_rootpath, fp)))
-            except IOError:
+                if self._is_range_request(md5):
+                    response = self._send_file_range(filepath)
+                else:
+                    # The file is streamed (or sent by the front-end web server if app.use_x_sendfile is set),
+                    # so it's never loaded in memory.
+                    response = send_file(filepath, mimetype='application/octet-stream',
+                                         add_etags=False, cache_timeout=0)
+            except (IOError, OSError):
                 response = 'Error: file {} not found.\n'.format(path), HTTP_NOT_FOUND
             else:
                 response.headers['Content-Disposition'] = 'attachment; filename=%s' % s_filename
+                response.headers['Accept-Ranges'] = 'bytes'
+                if md5:
+                    response.set_etag(md5)
+        elif request.if_none_match and self._snapshot_etag(username) in request.if_none_match:
+            # The client snapshot is up to date.
+            response = app.response_class(status=HTTP_NOT_MODIFIED)
+            response.set_etag(self._snapshot_etag(username))
+        elif 'since' in request.args:
+            response = self._get_delta(username)
+            response.set_etag(self._snapshot_etag(username))
         else:
             # If path is not given, return the snapshot of user directory.
             user_rootpath = join(FILE_ROOT, username)
             logger.debug('launch snapshot of {}...'.format(repr(user_rootpath)))
-            snapshot = userdata[username][SNAPSHOT]
+            snapshot = dict(userdata[username][SNAPSHOT].iteritems())
             logger.info('snapshot returned {:,} files'.format(len(snapshot)))
             last_server_timestamp = userdata[username][LAST_SERVER_TIMESTAMP]
-            shared_files = userdata[username][SHARED_FILES]
+            shared_files = dict(userdata[username][SHARED_FILES].iteritems())
             response = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp,
                                 SNAPSHOT: snapshot, 
                                 SHARED_FILES: shared_files})
+            response.set_etag(self._snapshot_etag(username))
         logging.debug(response)
         return response
+
+    def _is_range_request(self, md5):
+        """
+        Check if the request asks for a single byte range of the file with the given md5,
+        that is, without If-Range or with an If-Range matching the md5.
+        Requests with multiple ranges get the whole file.
+        :param md5: str
+        :return: bool
+        """
+        if not request.range or request.range.units != 'bytes' or len(request.range.ranges) != 1:
+            return False
+        if 'If-Range' in request.headers:
+            return bool(md5) and request.if_range.etag == md5
+        return True
+
+    def _send_file_range(self, filepath):
+        """
+        Return a partial content response with the byte range of the file requested by the Range header,
+        or a range not satisfiable response. The whole file is returned if it's empty.
+        :param filepath: str
+        """
+        size = os.path.getsize(filepath)
+        if not size:
+            return send_file(filepath, mimetype='application/octet-stream', add_etags=False, cache_timeout=0)
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response = app.response_class(status=HTTP_RANGE_NOT_SATISFIABLE)
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        start, stop = byte_range
+        f = open(filepath, 'rb')
+        f.seek(start)
+        response = app.response_class(_read_file_range(f, stop - start), HTTP_PARTIAL_CONTENT,
+                                      mimetype='application/octet-stream', direct_passthrough=True)
+        response.headers['Content-Range'] = request.range.make_content_range(size).to_header()
+        response.content_length = stop - start
+        response.cache_control.no_cache = True
+        return response
+
+    def _snapshot_etag(self, username):
+        """
+        Return the entity tag of the user snapshot, which changes whenever the user <files>
+        or <shared_files> change (or the server restarts).
+        :return: str
+        """
+        return '{}-{}'.format(userdata[username][LAST_SERVER_TIMESTAMP], last_user_change(username))
+
+    def _get_delta(self, username):
+        """
+        Return the changes of the user snapshot made after the change timestamp given as <since> argument,
+        or the whole snapshot if they are no more available.
+        json format (CHANGELOG_TIMESTAMP is the <since> argument for the next request):
+            {LAST_SERVER_TIMESTAMP: int, CHANGELOG_TIMESTAMP: int, 'delta': {SNAPSHOT: {<path>: [<timestamp>, <md5>] or None},
+                                                                             SHARED_FILES: {...}}}
+            {LAST_SERVER_TIMESTAMP: int, CHANGELOG_TIMESTAMP: int, SNAPSHOT: {...}, SHARED_FILES: {...}}
+        """
+        try:
+            since = long(request.args['since'])
+        except ValueError:
+            abort(HTTP_BAD_REQUEST)
+        changelog = changelogs.get(username) or ChangeLog()
+        response = {LAST_SERVER_TIMESTAMP: userdata[username][LAST_SERVER_TIMESTAMP],
+                    CHANGELOG_TIMESTAMP: ChangeLog.last_timestamp}
+        delta = changelog.since(since)
+        if delta is None:
+            logger.info('changes since {} not available: returning the whole snapshot'.format(since))
+            response[SNAPSHOT] = dict(userdata[username][SNAPSHOT].iteritems())
+            response[SHARED_FILES] = dict(userdata[username][SHARED_FILES].iteritems())
+        else:
+            logger.info('delta snapshot returned {:,} changes'.format(sum(len(d) for d in delta.values())))
+            response['delta'] = delta
+        return jsonify(response)
     
     def _is_shared_with_me(self, path, username):
         """Check if the path belong to a shared path"""
@@ -1051,14 +2813,75 @@ class Files(Resource):
                 return True
         return False
 
-    def _update_shared_files(self, path, username, timestamp, md5):
-        """Track the path in all users that have that share"""
+    def _get_upload(self, username):
+        """
+        Return the uploaded file: the file sent with the request (a StagedUpload),
+        the completed chunked upload given as <upload_id> (an UploadSession)
+        or, if no file is sent, the content the user can access whose md5 is <md5> and whose size is <size>
+        (a ClaimedContent). If there is no such content the client has to send the file.
+        :param username: str
+        """
+        if 'file' not in request.files and 'size' in request.form:
+            md5 = request.form['md5']
+            # Only the contents the user can access are claimed, linking the file they are known by
+            # (that is a link to the blob of that very content).
+            src_path = content_index(username).get(md5)
+            try:
+                if src_path is None or os.path.getsize(src_path) != int(request.form['size']):
+                    abort(HTTP_NOT_FOUND)
+            except (OSError, ValueError):
+                abort(HTTP_NOT_FOUND)
+            return ClaimedContent(src_path, md5)
+        if 'upload_id' in request.form:
+            upload_session = UploadSession.load(request.form['upload_id'], username)
+            if upload_session is None:
+                abort(HTTP_NOT_FOUND)
+            if not upload_session.is_complete():
+                abort(HTTP_BAD_REQUEST)
+            return upload_session
+        return request.files['file'].stream
+
+    def _apply_delta(self, username, path, filepath):
+        """
+        Rebuild the uploaded file from the delta against the server file (see Signatures).
+        <delta> is the json list of the blocks of the new file: the index of a block of the server file,
+        or null for the next block sent in <file>. <base_md5> is the md5 of the server file the delta is based on.
+        Only the last block sent can be shorter than SIGNATURE_BLOCK_SIZE.
+        Return the rebuilt file (a StagedUpload).
+        :param username: str
+        :param path: str
+        :param filepath: str
+        """
+        if request.form.get('base_md5') != userdata[username][SNAPSHOT].get(normpath(path), [None, None])[1]:
+            # The file has been changed since the client got its signature.
+            abort(HTTP_CONFLICT)
+        try:
+            delta = json.loads(request.form['delta'])
+        except ValueError:
+            abort(HTTP_BAD_REQUEST)
+        new_blocks = request.files['file'].stream if 'file' in request.files else None
+        if not isinstance(delta, list):
+            abort(HTTP_BAD_REQUEST)
+        upload = request.new_staged_upload()
+        with open(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            for i, block in enumerate(delta):
+                if block is None:
+                    if new_blocks is None:
+                        abort(HTTP_BAD_REQUEST)
+                    data = new_blocks.read(SIGNATURE_BLOCK_SIZE)
+                    if not data or (len(data) < SIGNATURE_BLOCK_SIZE and i < len(delta) - 1):
+                        # A missing block, or a short one that would shift the next blocks.
+                        abort(HTTP_BAD_REQUEST)
+                    upload.write(data)
+                elif isinstance(block, int) and not isinstance(block, bool) and \
+                        0 <= block * SIGNATURE_BLOCK_SIZE < size:
+                    f.seek(block * SIGNATURE_BLOCK_SIZE)
+                    upload.write(f.read(SIGNATURE_BLOCK_SIZE))
+                else:
+                    abort(HTTP_BAD_REQUEST)
+        return upload
 
-        shared_path = path.split('/')[0]
-        for user in userdata[username]['shared_with_others'][shared_path]:
-            res = 'shared/{0}/{1}'.format(username, path)
-            userdata[user]['shared_files'][res] = [timestamp, md5]
-    
     def _get_dirname_filename(self, path):
         """
         Return dirname(directory name) and filename(file name) for a given path to complete
@@ -1074,25 +2897,19 @@ class Files(Resource):
 
         return dirname, filename
 
-    def _update_user_path(self, username, path):
+    def _update_user_path(self, username, path, new_md5):
         """
         Make all needed updates to <userdata> (dict and disk) after a post or a put.
-        Return the last modification int timestamp of written file.
+        Return the new server timestamp of the written file.
         :param username: str
         :param path: str
+        :param new_md5: str (md5 of the written file, computed while it was uploaded)
         :return: int
         """
-        filepath = userpath2serverpath(username, path)
-        last_server_timestamp = file_timestamp(filepath)
-        new_md5 = calculate_file_md5(open(filepath, 'rb'))
-        userdata[username][LAST_SERVER_TIMESTAMP] = last_server_timestamp
-        userdata[username]['files'][normpath(path)] = [last_server_timestamp, new_md5]
-
-        # if path is a shared path then update userdata to permit all user to synchronize with the share
-        if _is_shared_with_others(path, username):
-            self._update_shared_files(path, username, last_server_timestamp, new_md5)
-
-        save_userdata()
+        # The written file can be a link to a blob stored before, so its mtime isn't the write time.
+        last_server_timestamp = now_timestamp()
+        track_user_file(username, path, new_md5, last_server_timestamp)
+        commit_userdata()
         return last_server_timestamp
 
     @auth.login_required
@@ -1105,11 +2922,12 @@ class Files(Resource):
         """
         username = auth.username()
 
-        upload_file = request.files['file']
+        upload = self._get_upload(username)
         md5 = request.form['md5']
         dirname, filename = self._get_dirname_filename(path)
 
-        if calculate_file_md5(upload_file) != md5:
+        if upload.hexdigest() != md5:
+            upload.discard()
             abort(HTTP_CONFLICT)
 
         if not os.path.exists(dirname):
@@ -1119,10 +2937,10 @@ class Files(Resource):
                 abort(HTTP_FORBIDDEN)
 
         filepath = join(dirname, filename)
-        upload_file.save(filepath)
+        upload.commit(filepath)
 
         # Update and save <userdata>, and return the last server timestamp.
-        last_server_timestamp = self._update_user_path(username, path)
+        last_server_timestamp = self._update_user_path(username, path, md5)
 
         resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
         resp.status_code = HTTP_CREATED
@@ -1133,25 +2951,29 @@ class Files(Resource):
         """
         Modify an authenticated user file in the server (uploading and overwriting it)
         given the path relative to the user directory. The file must exist in the server.
+        Only the changed blocks of the file can be uploaded, giving the <delta> (see _apply_delta).
         Return the file timestamp of the file updated in the server.
         :param path: str
         """
         username = auth.username()
-        upload_file = request.files['file']
         md5 = request.form['md5']
         dirname, filename = self._get_dirname_filename(path)
+        filepath = join(dirname, filename)
+        if not os.path.isfile(filepath):
+            abort(HTTP_NOT_FOUND)
 
-        if calculate_file_md5(upload_file) != md5:
+        if 'delta' in request.form:
+            upload = self._apply_delta(username, path, filepath)
+        else:
+            upload = self._get_upload(username)
+        if upload.hexdigest() != md5:
+            upload.discard()
             abort(HTTP_CONFLICT)
 
-        filepath = join(dirname, filename)
-        if os.path.isfile(filepath):
-            upload_file.save(filepath)
-        else:
-            abort(HTTP_NOT_FOUND)
+        upload.commit(filepath)
 
         # Update and save <userdata>, and return the last server timestamp.
-        last_server_timestamp = self._update_user_path(username, path)
+        last_server_timestamp = self._update_user_path(username, path, md5)
 
         resp = jsonify({LAST_SERVER_TIMESTAMP: last_server_timestamp})
         resp.status_code = HTTP_CREATED
@@ -1163,6 +2985,12 @@ api.add_resource(Actions, '{}/actions/<string:cmd>'.format(URL_PREFIX))
 api.add_resource(Shares, '{}/shares/<path:root_path>/<string:username>'.format(URL_PREFIX), '{}/shares/<path:root_path>'.format(URL_PREFIX))
 api.add_resource(Users, '{}/users/<string:username>'.format(URL_PREFIX))
 api.add_resource(UsersRecoverPassword, '{}/users/<string:username>/reset'.format(URL_PREFIX))
+api.add_resource(Session, '{}/session'.format(URL_PREFIX))
+api.add_resource(Changes, '{}/changes'.format(URL_PREFIX))
+api.add_resource(Uploads, '{}/uploads/<string:upload_id>'.format(URL_PREFIX), '{}/uploads/'.format(URL_PREFIX))
+api.add_resource(Signatures, '{}/signatures/<path:path>'.format(URL_PREFIX))
+api.add_resource(Hashes, '{}/hashes/<path:path>'.format(URL_PREFIX), '{}/hashes/'.format(URL_PREFIX))
+api.add_resource(Bundles, '{}/bundles/<string:cmd>'.format(URL_PREFIX))
 
 # Set the flask.ext.mail.Mail instance
 mail = configure_email()
@@ -1180,6 +3008,11 @@ def main():
                         [default: %(default)s]. Ignored if --verbose or --debug option is set.')
     parser.add_argument('-H', '--host', default='0.0.0.0',
                         help='set host address to run the server. [default: %(default)s].')
+    parser.add_argument('--storage', default=JsonStorage.name, choices=sorted(STORAGE_BACKENDS),
+                        help='set the users data storage backend. [default: %(default)s].')
+    parser.add_argument('--x-sendfile', default=False, action='store_true',
+                        help='let the front-end web server send the downloaded files (X-Sendfile header). \
+                        [default: %(default)s].')
     args = parser.parse_args()
 
     if args.debug:
@@ -1196,9 +3029,15 @@ def main():
 
     update_passwordmeter_terms(UNWANTED_PASS)
 
+    global storage
+    storage = STORAGE_BACKENDS[args.storage]()
+    app.use_x_sendfile = args.x_sendfile
     userdata.update(load_userdata())
+    if storage.journal_length:
+        # Fold the replayed journal into a fresh snapshot.
+        save_userdata()
     init_root_structure()
-    app.run(host=args.host, debug=args.debug)
+    app.run(host=args.host, debug=args.debug, threaded=True)
 
 if __name__ == '__main__':
     main()
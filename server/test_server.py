@@ -17,6 +17,10 @@ import hashlib
 import tempfile
 import random
 import string
+import threading
+import time
+import io
+import tarfile
 import mock
 
 import server
@@ -89,6 +93,7 @@ def _create_file(username, user_relpath, content, update_userdata=True):
     if update_userdata:
         server.userdata[username][server.SNAPSHOT][user_relpath] = [mtime,
                                                                     server.calculate_file_md5(open(filepath, 'rb'))]
+        server.mark_changed(username, server.SNAPSHOT, user_relpath)
     return mtime
 
 
@@ -354,6 +359,32 @@ class TestRequests(unittest.TestCase):
 
         # check that uploaded path NOT exists in username files dict
         self.assertNotIn(user_relative_upload_filepath, server.userdata[USR][server.SNAPSHOT])
+        # check that the staged upload has been removed
+        self.assertEqual(os.listdir(os.path.join(server.FILE_ROOT, server.UPLOAD_STAGING_DIR)), [])
+
+    def test_files_post_hashes_while_uploading(self):
+        """
+        Test that the uploaded file is hashed while it is written: the stored md5 is the computed one,
+        the file is never read again and no staged upload is left behind.
+        """
+        user_relative_upload_filepath = 'testupload/testfile.txt'
+        upload_test_url = SERVER_FILES_API + user_relative_upload_filepath
+        uploaded_filepath = userpath2serverpath(USR, user_relative_upload_filepath)
+        test_file, test_md5 = _make_temp_file()
+        try:
+            with mock.patch.object(server, 'calculate_file_md5') as mocked_md5:
+                test = self.app.post(upload_test_url,
+                                     headers=make_basicauth_headers(USR, PW),
+                                     data={'file': test_file, 'md5': test_md5},
+                                     follow_redirects=True)
+        finally:
+            test_file.close()
+        self.assertEqual(test.status_code, server.HTTP_CREATED)
+        self.assertFalse(mocked_md5.called)
+        self.assertEqual(server.userdata[USR][server.SNAPSHOT][user_relative_upload_filepath][1], test_md5)
+        self.assertEqual(server.calculate_file_md5(open(uploaded_filepath, 'rb')), test_md5)
+        self.assertEqual(os.listdir(os.path.join(server.FILE_ROOT, server.UPLOAD_STAGING_DIR)), [])
+        os.remove(uploaded_filepath)
 
     def test_files_put_with_auth(self):
         """
@@ -651,6 +682,63 @@ class TestGetRequests(unittest.TestCase):
                             headers=make_basicauth_headers(USR, PW))
         self.assertEqual(test.status_code, server.HTTP_OK)
 
+    def test_files_get_content(self):
+        """
+        Test that the downloaded file is streamed with its content.
+        """
+        test = self.app.get(self.DOWNLOAD_TEST_URL,
+                            headers=make_basicauth_headers(USR, PW))
+        self.assertTrue(test.is_streamed)
+        self.assertEqual(test.data, 'some text')
+        self.assertEqual(test.headers['Content-Disposition'], 'attachment; filename=testfile.txt')
+
+    def test_files_get_with_x_sendfile(self):
+        with mock.patch.dict(server.app.config, {'USE_X_SENDFILE': True}):
+            test = self.app.get(self.DOWNLOAD_TEST_URL,
+                                headers=make_basicauth_headers(USR, PW))
+        self.assertEqual(test.headers['X-Sendfile'], userpath2serverpath(USR, self.USER_RELATIVE_DOWNLOAD_FILEPATH))
+        self.assertEqual(test.data, '')
+
+    def _get_with_headers(self, **headers):
+        headers.update(make_basicauth_headers(USR, PW))
+        return self.app.get(self.DOWNLOAD_TEST_URL, headers=headers)
+
+    def test_files_get_range(self):
+        """
+        Test the download of a byte range of the file ('some text'), validated by its md5.
+        """
+        md5 = server.userdata[USR][server.SNAPSHOT][self.USER_RELATIVE_DOWNLOAD_FILEPATH][1]
+        test = self._get_with_headers(Range='bytes=5-')
+        self.assertEqual(test.status_code, server.HTTP_PARTIAL_CONTENT)
+        self.assertEqual(test.data, 'text')
+        self.assertEqual(test.headers['Content-Range'], 'bytes 5-8/9')
+        self.assertEqual(test.headers['ETag'], '"{}"'.format(md5))
+
+        test = self._get_with_headers(Range='bytes=0-3', **{'If-Range': '"{}"'.format(md5)})
+        self.assertEqual(test.status_code, server.HTTP_PARTIAL_CONTENT)
+        self.assertEqual(test.data, 'some')
+
+    def test_files_get_range_of_changed_file(self):
+        """
+        Test that the whole file is returned if it's changed since the given If-Range entity tag.
+        """
+        test = self._get_with_headers(Range='bytes=5-', **{'If-Range': '"old_md5"'})
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertEqual(test.data, 'some text')
+
+    def test_files_get_range_not_satisfiable(self):
+        test = self._get_with_headers(Range='bytes=100-200')
+        self.assertEqual(test.status_code, server.HTTP_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(test.headers['Content-Range'], 'bytes */9')
+
+    def test_files_get_multiple_ranges(self):
+        """
+        Test that the whole file is returned when more ranges are requested.
+        """
+        test = self._get_with_headers(Range='bytes=0-1,4-5')
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        self.assertEqual(test.data, 'some text')
+
     def test_files_get_existing_file_with_wrong_password(self):
         """
         Test that server return a HTTP_UNAUTHORIZED error if
@@ -1133,6 +1221,583 @@ class TestUsersRecoverPassword(unittest.TestCase):
         self.assertNotEqual(server.userdata[self.active_user]['password'], 'weakpass')
 
 
+class TestCredentialsCache(unittest.TestCase):
+    """
+    Testing the cache of verified credentials.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        server.credentials_cache.clear()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+
+    def tearDown(self):
+        server.credentials_cache.clear()
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def get_snapshot(self, pw):
+        return self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(self.user, pw))
+
+    def test_password_verified_once(self):
+        with mock.patch.object(server.sha256_crypt, 'verify', wraps=server.sha256_crypt.verify) as verify:
+            for _ in range(3):
+                self.assertEqual(self.get_snapshot(self.pw).status_code, HTTP_OK)
+        self.assertEqual(verify.call_count, 1)
+
+    def test_wrong_password_not_cached(self):
+        self.assertEqual(self.get_snapshot(self.pw).status_code, HTTP_OK)
+        self.assertEqual(self.get_snapshot('wrong').status_code, 401)
+        self.assertEqual(self.get_snapshot('wrong').status_code, 401)
+        self.assertEqual(len(server.credentials_cache), 1)
+
+    def test_expired_credentials(self):
+        with mock.patch('server.CREDENTIALS_CACHE_TTL', -1):
+            with mock.patch.object(server.sha256_crypt, 'verify', wraps=server.sha256_crypt.verify) as verify:
+                self.get_snapshot(self.pw)
+                self.get_snapshot(self.pw)
+        self.assertEqual(verify.call_count, 2)
+
+    def test_password_change_invalidates_cache(self):
+        self.assertEqual(self.get_snapshot(self.pw).status_code, HTTP_OK)
+        server.userdata[self.user]['recoverpass_data'] = {'recoverpass_code': 'code',
+                                                          'timestamp': server.now_timestamp()}
+        test = self.app.put(SERVER_API + 'users/{}'.format(self.user),
+                            data={'recoverpass_code': 'code', 'password': 'New.Pass_123'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(len(server.credentials_cache), 0)
+        self.assertEqual(self.get_snapshot(self.pw).status_code, 401)
+        self.assertEqual(self.get_snapshot('New.Pass_123').status_code, HTTP_OK)
+
+    def test_cache_size_is_bounded(self):
+        with mock.patch('server.CREDENTIALS_CACHE_SIZE', 2):
+            with mock.patch.object(server.sha256_crypt, 'verify', return_value=True):
+                for pw in ('a', 'b', 'c'):
+                    self.get_snapshot(pw)
+        self.assertEqual(len(server.credentials_cache), 2)
+        self.assertNotIn(server._credentials_digest(self.user, 'a'), server.credentials_cache)
+
+
+class TestSessionTokens(unittest.TestCase):
+    """
+    Testing the authentication with session tokens.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        server.credentials_cache.clear()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.session_url = urlparse.urljoin(SERVER_API, 'session')
+
+    def tearDown(self):
+        server.credentials_cache.clear()
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def get_snapshot(self, pw):
+        return self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(self.user, pw))
+
+    def test_post_session(self):
+        test = self.app.post(self.session_url, headers=make_basicauth_headers(self.user, self.pw))
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        token = json.loads(test.data)['token']
+        with mock.patch.object(server.sha256_crypt, 'verify') as verify:
+            self.assertEqual(self.get_snapshot(token).status_code, HTTP_OK)
+        self.assertFalse(verify.called)
+
+    def test_post_session_with_token(self):
+        token = server.make_session_token(self.user)
+        test = self.app.post(self.session_url, headers=make_basicauth_headers(self.user, token))
+        self.assertEqual(test.status_code, HTTP_FORBIDDEN)
+
+    def test_token_header(self):
+        test = self.get_snapshot(self.pw)
+        token = test.headers[server.SESSION_TOKEN_HEADER]
+        test = self.get_snapshot(token)
+        self.assertEqual(test.status_code, HTTP_OK)
+        # A fresh token is not renewed.
+        self.assertNotIn(server.SESSION_TOKEN_HEADER, test.headers)
+
+    def test_token_renewal(self):
+        with mock.patch('time.time', return_value=server.time.time() - server.SESSION_TOKEN_TTL * 0.75):
+            token = server.make_session_token(self.user)
+        test = self.get_snapshot(token)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertIn(server.SESSION_TOKEN_HEADER, test.headers)
+
+    def test_invalid_tokens(self):
+        token = server.make_session_token(self.user)
+        self.assertEqual(self.get_snapshot(token[:-1] + 'x').status_code, 401)
+        self.assertEqual(self.get_snapshot(server.SESSION_TOKEN_PREFIX + 'foo').status_code, 401)
+        with mock.patch('server.SESSION_TOKEN_TTL', -1):
+            expired_token = server.make_session_token(self.user)
+        self.assertEqual(self.get_snapshot(expired_token).status_code, 401)
+
+    def test_password_change_invalidates_token(self):
+        token = server.make_session_token(self.user)
+        server.userdata[self.user][server.PWD] = server._encrypt_password('New.Pass_123')
+        self.assertEqual(self.get_snapshot(token).status_code, 401)
+
+
+class TestDeltaSnapshot(unittest.TestCase):
+    """
+    Testing the delta snapshot: GET /files/?since=<changelog timestamp>
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        _manually_create_user(SHAREUSR, SHAREUSRPW)
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def get_delta(self, since, user=None, pw=None):
+        test = self.app.get(SERVER_FILES_API, query_string={'since': since},
+                            headers=make_basicauth_headers(user or self.user, pw or self.pw))
+        self.assertEqual(test.status_code, HTTP_OK)
+        return json.loads(test.data)
+
+    def test_full_snapshot_if_changes_not_available(self):
+        obj = self.get_delta(0)
+        self.assertNotIn('delta', obj)
+        self.assertEqual(obj[server.SNAPSHOT], server.userdata[self.user][server.SNAPSHOT])
+        self.assertEqual(obj[server.SHARED_FILES], {})
+        self.assertEqual(obj[server.CHANGELOG_TIMESTAMP], server.ChangeLog.last_timestamp)
+
+    def test_delta(self):
+        since = self.get_delta(0)[server.CHANGELOG_TIMESTAMP]
+        _create_file(self.user, 'foo.txt', 'foo')
+        self.app.post(SERVER_ACTIONS_API + 'move',
+                      headers=make_basicauth_headers(self.user, self.pw),
+                      data={'src': 'foo.txt', 'dst': 'bar/foo.txt'})
+        obj = self.get_delta(since)
+        self.assertNotIn(server.SNAPSHOT, obj)
+        self.assertEqual(obj['delta'], {server.SNAPSHOT: {'foo.txt': None,
+                                                          'bar/foo.txt': server.userdata[self.user][server.SNAPSHOT]['bar/foo.txt']},
+                                        server.SHARED_FILES: {}})
+        self.assertEqual(obj[server.LAST_SERVER_TIMESTAMP], server.userdata[self.user][server.LAST_SERVER_TIMESTAMP])
+        # Nothing changed in the meantime
+        obj = self.get_delta(obj[server.CHANGELOG_TIMESTAMP])
+        self.assertEqual(obj['delta'], {server.SNAPSHOT: {}, server.SHARED_FILES: {}})
+
+    def test_shared_files_delta(self):
+        self.app.post(SERVER_SHARES_API + 'Music/' + SHAREUSR, headers=make_basicauth_headers(self.user, self.pw))
+        since = self.get_delta(0, SHAREUSR, SHAREUSRPW)[server.CHANGELOG_TIMESTAMP]
+        self.app.post(SERVER_ACTIONS_API + 'delete', headers=make_basicauth_headers(self.user, self.pw),
+                      data={'filepath': 'Music/Music.txt'})
+        obj = self.get_delta(since, SHAREUSR, SHAREUSRPW)
+        self.assertEqual(obj['delta'][server.SHARED_FILES], {'shared/{}/Music/Music.txt'.format(self.user): None})
+
+    def test_truncated_changelog(self):
+        since = self.get_delta(0)[server.CHANGELOG_TIMESTAMP]
+        with mock.patch('server.CHANGELOG_SIZE', 2):
+            for filename in ('a', 'b', 'c'):
+                _create_file(self.user, filename, filename)
+                server.commit_userdata()
+        obj = self.get_delta(since)
+        self.assertNotIn('delta', obj)
+        self.assertIn('c', obj[server.SNAPSHOT])
+
+    def test_not_modified(self):
+        test = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(self.user, self.pw))
+        etag = test.headers['ETag']
+        headers = make_basicauth_headers(self.user, self.pw)
+        headers['If-None-Match'] = etag
+        test = self.app.get(SERVER_FILES_API, headers=headers)
+        self.assertEqual(test.status_code, server.HTTP_NOT_MODIFIED)
+        self.assertEqual(test.data, '')
+        # Changes of the snapshot change the etag
+        self.app.post(SERVER_ACTIONS_API + 'delete', headers=make_basicauth_headers(self.user, self.pw),
+                      data={'filepath': 'WELCOME'})
+        test = self.app.get(SERVER_FILES_API, query_string={'since': 0}, headers=headers)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertNotEqual(test.headers['ETag'], etag)
+
+    def test_shared_files_change_etag(self):
+        etag = self.app.get(SERVER_FILES_API, headers=make_basicauth_headers(SHAREUSR, SHAREUSRPW)).headers['ETag']
+        self.app.post(SERVER_SHARES_API + 'Music/' + SHAREUSR, headers=make_basicauth_headers(self.user, self.pw))
+        headers = make_basicauth_headers(SHAREUSR, SHAREUSRPW)
+        headers['If-None-Match'] = etag
+        test = self.app.get(SERVER_FILES_API, headers=headers)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertIn('shared/{}/Music/Music.txt'.format(self.user), json.loads(test.data)[server.SHARED_FILES])
+
+    def test_bad_since(self):
+        test = self.app.get(SERVER_FILES_API, query_string={'since': 'foo'},
+                            headers=make_basicauth_headers(self.user, self.pw))
+        self.assertEqual(test.status_code, HTTP_BAD_REQUEST)
+
+
+class TestChanges(unittest.TestCase):
+    """
+    Testing the change notifications: GET /changes?since=<changelog timestamp>&wait=<seconds>
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.changes_url = urlparse.urljoin(SERVER_API, 'changes')
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def get_changes(self, since, wait, app=None):
+        test = (app or self.app).get(self.changes_url, query_string={'since': since, 'wait': wait},
+                                     headers=make_basicauth_headers(self.user, self.pw))
+        self.assertEqual(test.status_code, HTTP_OK)
+        return json.loads(test.data)
+
+    def test_changed(self):
+        obj = self.get_changes(0, 10)
+        self.assertTrue(obj['changed'])
+        self.assertEqual(obj[server.CHANGELOG_TIMESTAMP], server.ChangeLog.last_timestamp)
+
+    def test_timeout(self):
+        since = server.ChangeLog.last_timestamp
+        start = time.time()
+        obj = self.get_changes(since, 0.2)
+        self.assertFalse(obj['changed'])
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_wake_up_on_change(self):
+        since = server.ChangeLog.last_timestamp
+        result = {}
+
+        def wait_changes():
+            result.update(self.get_changes(since, 30, server.app.test_client()))
+        waiting = threading.Thread(target=wait_changes)
+        waiting.start()
+        time.sleep(0.2)
+        # The waiting request doesn't block the other ones
+        test = self.app.post(SERVER_ACTIONS_API + 'delete', headers=make_basicauth_headers(self.user, self.pw),
+                             data={'filepath': 'WELCOME'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        waiting.join(5)
+        self.assertFalse(waiting.is_alive())
+        self.assertTrue(result['changed'])
+
+    def test_bad_arguments(self):
+        test = self.app.get(self.changes_url, query_string={'since': 'foo'},
+                            headers=make_basicauth_headers(self.user, self.pw))
+        self.assertEqual(test.status_code, HTTP_BAD_REQUEST)
+
+
+class TestUploads(unittest.TestCase):
+    """
+    Testing the chunked uploads: POST /uploads/, PUT /uploads/<upload_id>?offset=<offset>&md5=<md5>,
+    committed posting/putting the upload_id to /files/<path>.
+    """
+    CONTENT = 'chunked upload test content'
+
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.uploads_url = urlparse.urljoin(SERVER_API, 'uploads/')
+        self.headers = make_basicauth_headers(self.user, self.pw)
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def start_upload(self, size):
+        test = self.app.post(self.uploads_url, headers=self.headers, data={'size': size})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        return json.loads(test.data)['upload_id']
+
+    def send_chunk(self, upload_id, offset, chunk, md5=None):
+        md5 = md5 or hashlib.md5(chunk).hexdigest()
+        return self.app.put(self.uploads_url + upload_id, headers=self.headers, data=chunk,
+                            query_string={'offset': offset, 'md5': md5})
+
+    def test_upload_in_chunks(self):
+        upload_id = self.start_upload(len(self.CONTENT))
+        # Chunks can be sent in any order.
+        self.assertEqual(self.send_chunk(upload_id, 10, self.CONTENT[10:]).status_code, HTTP_OK)
+        self.assertEqual(self.send_chunk(upload_id, 0, self.CONTENT[:10]).status_code, HTTP_OK)
+
+        test = self.app.post(SERVER_FILES_API + 'chunked.txt', headers=self.headers,
+                             data={'upload_id': upload_id, 'md5': hashlib.md5(self.CONTENT).hexdigest()})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        with open(userpath2serverpath(self.user, 'chunked.txt')) as f:
+            self.assertEqual(f.read(), self.CONTENT)
+        self.assertEqual(server.userdata[self.user][server.SNAPSHOT]['chunked.txt'][1],
+                         hashlib.md5(self.CONTENT).hexdigest())
+        # The upload session is closed.
+        test = self.app.get(self.uploads_url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+    def test_resume_upload(self):
+        upload_id = self.start_upload(len(self.CONTENT))
+        self.send_chunk(upload_id, 0, self.CONTENT[:10])
+        test = self.app.get(self.uploads_url + upload_id, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(json.loads(test.data)['received'], [[0, 10]])
+
+    def test_chunk_with_bad_md5(self):
+        upload_id = self.start_upload(len(self.CONTENT))
+        test = self.send_chunk(upload_id, 0, self.CONTENT[:10], md5='bad_md5')
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        test = self.app.get(self.uploads_url + upload_id, headers=self.headers)
+        self.assertEqual(json.loads(test.data)['received'], [])
+
+    def test_chunk_with_bad_md5_not_written(self):
+        upload_id = self.start_upload(len(self.CONTENT))
+        self.send_chunk(upload_id, 0, self.CONTENT[:10])
+        test = self.send_chunk(upload_id, 10, 'X' * (len(self.CONTENT) - 10), md5='bad_md5')
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        with open(os.path.join(server.FILE_ROOT, server.UPLOAD_SESSIONS_DIR, upload_id), 'rb') as f:
+            self.assertEqual(f.read(), self.CONTENT[:10] + '\0' * (len(self.CONTENT) - 10))
+        self.assertEqual(os.listdir(os.path.join(server.FILE_ROOT, server.UPLOAD_STAGING_DIR)), [])
+
+    def test_overlapping_chunk(self):
+        """
+        A chunk overlapping the received bytes is rejected, without changing them.
+        """
+        upload_id = self.start_upload(len(self.CONTENT))
+        self.send_chunk(upload_id, 0, self.CONTENT[:10])
+        test = self.send_chunk(upload_id, 5, 'X' * 10)
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        self.assertEqual(self.send_chunk(upload_id, 10, self.CONTENT[10:]).status_code, HTTP_OK)
+        test = self.app.post(SERVER_FILES_API + 'chunked.txt', headers=self.headers,
+                             data={'upload_id': upload_id, 'md5': hashlib.md5(self.CONTENT).hexdigest()})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+
+    def test_chunk_exceeding_size(self):
+        upload_id = self.start_upload(5)
+        test = self.send_chunk(upload_id, 0, self.CONTENT)
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+
+    def test_commit_incomplete_upload(self):
+        upload_id = self.start_upload(len(self.CONTENT))
+        self.send_chunk(upload_id, 10, self.CONTENT[10:])
+        test = self.app.post(SERVER_FILES_API + 'chunked.txt', headers=self.headers,
+                             data={'upload_id': upload_id, 'md5': hashlib.md5(self.CONTENT).hexdigest()})
+        self.assertEqual(test.status_code, HTTP_BAD_REQUEST)
+        self.assertNotIn('chunked.txt', server.userdata[self.user][server.SNAPSHOT])
+
+    def test_upload_of_other_user(self):
+        upload_id = self.start_upload(len(self.CONTENT))
+        _manually_create_user('other', 'pass')
+        test = self.app.get(self.uploads_url + upload_id, headers=make_basicauth_headers('other', 'pass'))
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+
+class TestDeltaUpload(unittest.TestCase):
+    """
+    Testing the upload of the changed blocks of a file: GET /signatures/<path>, then PUT /files/<path>
+    with the delta.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.headers = make_basicauth_headers(self.user, self.pw)
+        self.path = 'delta.txt'
+        _create_file(self.user, self.path, 'aaaabbbbcccc')
+        self.base_md5 = server.userdata[self.user][server.SNAPSHOT][self.path][1]
+        self.block_size_patcher = mock.patch.object(server, 'SIGNATURE_BLOCK_SIZE', 4)
+        self.block_size_patcher.start()
+
+    def tearDown(self):
+        self.block_size_patcher.stop()
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def put_delta(self, delta, new_blocks, new_content, base_md5=None):
+        return self.app.put(SERVER_FILES_API + self.path, headers=self.headers,
+                            data={'file': (io.BytesIO(new_blocks), 'blocks'),
+                                  'delta': json.dumps(delta),
+                                  'base_md5': base_md5 or self.base_md5,
+                                  'md5': hashlib.md5(new_content).hexdigest()})
+
+    def test_signature(self):
+        test = self.app.get(urlparse.urljoin(SERVER_API, 'signatures/') + self.path, headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(json.loads(test.data),
+                         {'md5': self.base_md5,
+                          'block_size': 4,
+                          'blocks': [hashlib.md5(block).hexdigest() for block in ('aaaa', 'bbbb', 'cccc')]})
+
+    def test_signature_of_missing_file(self):
+        test = self.app.get(urlparse.urljoin(SERVER_API, 'signatures/') + 'missing.txt', headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+    def test_put_delta(self):
+        new_content = 'ccccaaaaXXXXbbbbYY'
+        test = self.put_delta([2, 0, None, 1, None], 'XXXXYY', new_content)
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        with open(userpath2serverpath(self.user, self.path)) as f:
+            self.assertEqual(f.read(), new_content)
+        self.assertEqual(server.userdata[self.user][server.SNAPSHOT][self.path][1],
+                         hashlib.md5(new_content).hexdigest())
+
+    def test_put_delta_of_changed_file(self):
+        test = self.put_delta([0, None], 'XXXX', 'aaaaXXXX', base_md5='old_md5')
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        with open(userpath2serverpath(self.user, self.path)) as f:
+            self.assertEqual(f.read(), 'aaaabbbbcccc')
+
+    def test_put_delta_with_bad_md5(self):
+        test = self.put_delta([0, None], 'XXXX', 'aaaaYYYY')
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        self.assertEqual(os.listdir(os.path.join(server.FILE_ROOT, server.UPLOAD_STAGING_DIR)), [])
+
+    def test_put_delta_with_bad_block_index(self):
+        for block in (3, -1, True, 'a'):
+            test = self.put_delta([0, block], '', 'aaaa')
+            self.assertEqual(test.status_code, HTTP_BAD_REQUEST)
+        with open(userpath2serverpath(self.user, self.path)) as f:
+            self.assertEqual(f.read(), 'aaaabbbbcccc')
+
+    def test_put_delta_with_short_block(self):
+        """
+        Only the last block sent can be shorter than the block size.
+        """
+        test = self.put_delta([None, 0], 'XX', 'XXaaaa')
+        self.assertEqual(test.status_code, HTTP_BAD_REQUEST)
+        test = self.put_delta([0, None, None], 'XXXX', 'aaaaXXXX')
+        self.assertEqual(test.status_code, HTTP_BAD_REQUEST)
+        with open(userpath2serverpath(self.user, self.path)) as f:
+            self.assertEqual(f.read(), 'aaaabbbbcccc')
+
+
+class TestBlobStore(unittest.TestCase):
+    """
+    Testing the deduplicated storage of the file contents: user files are hard links to the blobs.
+    """
+    CONTENT = 'deduplicated content'
+
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.headers = make_basicauth_headers(self.user, self.pw)
+        self.md5 = hashlib.md5(self.CONTENT).hexdigest()
+        self.sha256 = hashlib.sha256(self.CONTENT).hexdigest()
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def upload(self, path, content, method='post'):
+        test = getattr(self.app, method)(SERVER_FILES_API + path, headers=self.headers,
+                                         data={'file': (io.BytesIO(content), 'file'),
+                                               'md5': hashlib.md5(content).hexdigest()})
+        self.assertEqual(test.status_code, HTTP_CREATED)
+
+    def delete(self, path):
+        test = self.app.post(urlparse.urljoin(SERVER_API, 'actions/delete'), headers=self.headers,
+                             data={'filepath': path})
+        self.assertEqual(test.status_code, HTTP_OK)
+
+    def test_same_content_stored_once(self):
+        self.upload('a.txt', self.CONTENT)
+        self.upload('dir/b.txt', self.CONTENT)
+        blob = server.blob_path(self.md5, self.sha256)
+        self.assertTrue(os.path.samefile(blob, userpath2serverpath(self.user, 'a.txt')))
+        self.assertTrue(os.path.samefile(blob, userpath2serverpath(self.user, 'dir/b.txt')))
+        self.assertEqual(os.stat(blob).st_nlink, 3)
+
+        # The blob is removed with its last file.
+        self.delete('a.txt')
+        self.assertTrue(os.path.exists(blob))
+        self.delete('dir/b.txt')
+        self.assertFalse(os.path.exists(blob))
+        self.assertFalse(os.path.exists(server.blob_bucket(self.md5)))
+
+    def test_same_md5_stored_apart(self):
+        """
+        Different contents are different blobs even if they have the same md5 (and size).
+        """
+        staging_dir = os.path.join(server.FILE_ROOT, server.UPLOAD_STAGING_DIR)
+        os.makedirs(staging_dir)
+        paths = []
+        for content in ('content 1', 'content 2'):
+            src_path = os.path.join(staging_dir, 'upload')
+            with open(src_path, 'w') as f:
+                f.write(content)
+            paths.append(userpath2serverpath(self.user, content))
+            server.store_file(src_path, self.md5, hashlib.sha256(content).hexdigest(), paths[-1])
+        with open(paths[0]) as f:
+            self.assertEqual(f.read(), 'content 1')
+        with open(paths[1]) as f:
+            self.assertEqual(f.read(), 'content 2')
+        self.assertEqual(len(os.listdir(server.blob_bucket(self.md5))), 2)
+
+        os.remove(paths[0])
+        server.release_blob(self.md5)
+        self.assertEqual(os.listdir(server.blob_bucket(self.md5)), [hashlib.sha256('content 2').hexdigest()])
+
+    def test_copy_shares_content(self):
+        self.upload('a.txt', self.CONTENT)
+        test = self.app.post(urlparse.urljoin(SERVER_API, 'actions/copy'), headers=self.headers,
+                             data={'src': 'a.txt', 'dst': 'copy.txt'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertTrue(os.path.samefile(userpath2serverpath(self.user, 'a.txt'),
+                                         userpath2serverpath(self.user, 'copy.txt')))
+        self.assertEqual(server.userdata[self.user][server.SNAPSHOT]['copy.txt'][1], self.md5)
+
+    def claim(self, path, md5, size, headers=None):
+        return self.app.post(SERVER_FILES_API + path, headers=headers or self.headers,
+                             data={'md5': md5, 'size': size})
+
+    def test_claim_stored_content(self):
+        self.upload('a.txt', self.CONTENT)
+        test = self.claim('claimed.txt', self.md5, len(self.CONTENT))
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        self.assertTrue(os.path.samefile(userpath2serverpath(self.user, 'a.txt'),
+                                         userpath2serverpath(self.user, 'claimed.txt')))
+        self.assertEqual(server.userdata[self.user][server.SNAPSHOT]['claimed.txt'][1], self.md5)
+
+    def test_claim_unknown_content(self):
+        test = self.claim('claimed.txt', self.md5, len(self.CONTENT))
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+        self.assertNotIn('claimed.txt', server.userdata[self.user][server.SNAPSHOT])
+
+    def test_claim_with_wrong_size(self):
+        self.upload('a.txt', self.CONTENT)
+        test = self.claim('claimed.txt', self.md5, len(self.CONTENT) + 1)
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+    def test_claim_content_of_other_user(self):
+        self.upload('a.txt', self.CONTENT)
+        _manually_create_user('other', 'pass')
+        test = self.claim('claimed.txt', self.md5, len(self.CONTENT), make_basicauth_headers('other', 'pass'))
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+
+    def test_modify_releases_old_content(self):
+        self.upload('a.txt', self.CONTENT)
+        self.upload('a.txt', 'new content', method='put')
+        self.assertFalse(os.path.exists(server.blob_bucket(self.md5)))
+        with open(userpath2serverpath(self.user, 'a.txt')) as f:
+            self.assertEqual(f.read(), 'new content')
+
+
 def get_dic_dir_states():
     """
     Return a tuple with dictionary state and directory state of all users.
@@ -1146,13 +1811,345 @@ def get_dic_dir_states():
         single_user_data.pop('password')  # not very beautiful
         single_user_data.pop(server.USER_CREATION_TIME)  # not very beautiful
         dic_state[username] = single_user_data
-        dir_state = json.load(open('userdata.json', "rb"))
+        # userdata as persisted on disk (snapshot + journal)
+        dir_state = server.load_userdata()
         dir_state[username].pop(server.PWD)  # not very beatiful cit. ibidem
         dir_state[username].pop(server.USER_CREATION_TIME)  # not very beatiful cit. ibidem
 
     return dic_state, dir_state
 
 
+class TestBatchActions(unittest.TestCase):
+    """
+    Testing the batch of delete/copy/move actions applied with a single request.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.headers = make_basicauth_headers(self.user, self.pw)
+        for path in ('a.txt', 'dir/b.txt', 'dir/c.txt'):
+            _create_file(self.user, path, 'content of {}'.format(path))
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def batch(self, operations):
+        return self.app.post(urlparse.urljoin(SERVER_API, 'actions/batch'), headers=self.headers,
+                             data={'operations': json.dumps(operations)})
+
+    def test_batch(self):
+        test = self.batch([{'action': 'delete', 'filepath': 'dir/b.txt'},
+                           {'action': 'move', 'src': 'a.txt', 'dst': 'moved/a.txt'},
+                           {'action': 'copy', 'src': 'moved/a.txt', 'dst': 'copy.txt'}])
+        self.assertEqual(test.status_code, HTTP_OK)
+        timestamp = json.loads(test.data)[server.LAST_SERVER_TIMESTAMP]
+        files = server.userdata[self.user][server.SNAPSHOT]
+        for path in ('copy.txt', 'dir/c.txt', 'moved/a.txt'):
+            self.assertIn(path, files)
+        self.assertNotIn('a.txt', files)
+        self.assertNotIn('dir/b.txt', files)
+        self.assertEqual(files['moved/a.txt'][0], timestamp)
+        self.assertEqual(files['copy.txt'][0], timestamp)
+        self.assertEqual(server.userdata[self.user][server.LAST_SERVER_TIMESTAMP], timestamp)
+        self.assertFalse(os.path.exists(userpath2serverpath(self.user, 'dir/b.txt')))
+        self.assertFalse(os.path.exists(userpath2serverpath(self.user, 'a.txt')))
+        self.assertTrue(os.path.isfile(userpath2serverpath(self.user, 'copy.txt')))
+
+    def test_batch_rejected_as_a_whole(self):
+        test = self.batch([{'action': 'delete', 'filepath': 'a.txt'},
+                           {'action': 'delete', 'filepath': 'a.txt'}])
+        self.assertEqual(test.status_code, HTTP_NOT_FOUND)
+        self.assertTrue(os.path.isfile(userpath2serverpath(self.user, 'a.txt')))
+        self.assertIn('a.txt', server.userdata[self.user][server.SNAPSHOT])
+
+        test = self.batch([{'action': 'delete', 'filepath': 'a.txt'},
+                           {'action': 'move', 'src': 'dir/b.txt', 'dst': '../../b.txt'},
+                           {'action': 'delete', 'filepath': '../../b.txt'}])
+        self.assertEqual(test.status_code, HTTP_FORBIDDEN)
+        self.assertTrue(os.path.isfile(userpath2serverpath(self.user, 'a.txt')))
+
+    def test_batch_with_escaping_destination(self):
+        for action in ('copy', 'move'):
+            test = self.batch([{'action': action, 'src': 'a.txt', 'dst': '../other/evil.txt'}])
+            self.assertEqual(test.status_code, HTTP_FORBIDDEN)
+            self.assertFalse(os.path.exists(os.path.join(server.FILE_ROOT, 'other', 'evil.txt')))
+            self.assertNotIn('../other/evil.txt', server.userdata[self.user][server.SNAPSHOT])
+            self.assertTrue(os.path.isfile(userpath2serverpath(self.user, 'a.txt')))
+
+    def test_bad_batch(self):
+        files = dict(server.userdata[self.user][server.SNAPSHOT])
+        for operations in ([], [{'action': 'rename', 'src': 'a.txt', 'dst': 'b.txt'}],
+                           [{'action': 'move', 'src': 'a.txt'}], {'action': 'delete', 'filepath': 'a.txt'}):
+            self.assertEqual(self.batch(operations).status_code, server.HTTP_BAD_REQUEST)
+        test = self.app.post(urlparse.urljoin(SERVER_API, 'actions/batch'), headers=self.headers,
+                             data={'operations': 'not json'})
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+        self.assertEqual(server.userdata[self.user][server.SNAPSHOT], files)
+
+
+class TestDirectoryActions(unittest.TestCase):
+    """
+    Testing the delete, copy and move actions on whole directories.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.headers = make_basicauth_headers(self.user, self.pw)
+        for path in ('dir/a.txt', 'dir/sub/b.txt', 'dirty.txt'):
+            _create_file(self.user, path, 'content of {}'.format(path))
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def action(self, cmd, data):
+        return self.app.post(SERVER_ACTIONS_API + cmd, headers=self.headers, data=data)
+
+    def test_delete_dir(self):
+        md5 = server.userdata[self.user][server.SNAPSHOT]['dir/a.txt'][1]
+        test = self.action('delete', {'filepath': 'dir'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        files = server.userdata[self.user][server.SNAPSHOT]
+        self.assertNotIn('dir/a.txt', files)
+        self.assertNotIn('dir/sub/b.txt', files)
+        self.assertIn('dirty.txt', files)
+        self.assertFalse(os.path.exists(userpath2serverpath(self.user, 'dir')))
+        self.assertFalse(os.path.exists(server.blob_bucket(md5)))
+
+    def test_move_dir(self):
+        md5 = server.userdata[self.user][server.SNAPSHOT]['dir/sub/b.txt'][1]
+        test = self.action('move', {'src': 'dir', 'dst': 'new/dir'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        timestamp = json.loads(test.data)[server.LAST_SERVER_TIMESTAMP]
+        files = server.userdata[self.user][server.SNAPSHOT]
+        self.assertNotIn('dir/a.txt', files)
+        self.assertEqual(files['new/dir/sub/b.txt'], [timestamp, md5])
+        self.assertIn('new/dir/a.txt', files)
+        self.assertTrue(os.path.isfile(userpath2serverpath(self.user, 'new/dir/sub/b.txt')))
+        self.assertFalse(os.path.exists(userpath2serverpath(self.user, 'dir')))
+
+    def test_copy_dir(self):
+        test = self.action('copy', {'src': 'dir', 'dst': 'copy'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        files = server.userdata[self.user][server.SNAPSHOT]
+        for path in ('dir/a.txt', 'dir/sub/b.txt', 'copy/a.txt', 'copy/sub/b.txt'):
+            self.assertIn(path, files)
+        self.assertEqual(files['copy/a.txt'][1], files['dir/a.txt'][1])
+        self.assertTrue(os.path.samefile(userpath2serverpath(self.user, 'dir/a.txt'),
+                                         userpath2serverpath(self.user, 'copy/a.txt')))
+        # 'dirty.txt' isn't inside 'dir'
+        self.assertEqual(sorted(path for path in files if path.startswith('copy')), ['copy/a.txt', 'copy/sub/b.txt'])
+
+    def test_bad_dir_actions(self):
+        self.assertEqual(self.action('move', {'src': 'dir', 'dst': 'dir/sub/dir'}).status_code,
+                         server.HTTP_BAD_REQUEST)
+        self.assertEqual(self.action('copy', {'src': 'dir', 'dst': 'dirty.txt'}).status_code, server.HTTP_CONFLICT)
+        self.assertEqual(self.action('move', {'src': 'dir', 'dst': '../dir'}).status_code, server.HTTP_FORBIDDEN)
+        self.assertEqual(self.action('delete', {'filepath': ''}).status_code, server.HTTP_FORBIDDEN)
+        self.assertIn('dir/a.txt', server.userdata[self.user][server.SNAPSHOT])
+
+    def test_move_shared_dir(self):
+        share_user = 'pluto'
+        _manually_create_user(share_user, 'pass')
+        test = self.app.post(urlparse.urljoin(SERVER_SHARES_API, 'dir/' + share_user), headers=self.headers)
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertIn('shared/pippo/dir/a.txt', server.userdata[share_user]['shared_files'])
+
+        # Moving the shared root removes the share
+        test = self.action('move', {'src': 'dir', 'dst': 'moved'})
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertNotIn('shared/pippo/dir/a.txt', server.userdata[share_user]['shared_files'])
+        self.assertNotIn('dir', server.userdata[self.user]['shared_with_others'])
+        self.assertNotIn('dir', server.userdata[share_user]['shared_with_me'][self.user])
+
+
+class TestBundles(unittest.TestCase):
+    """
+    Testing the upload of many files with a single request.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.headers = make_basicauth_headers(self.user, self.pw)
+        _create_file(self.user, 'old.txt', 'old content')
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def make_bundle(self, files):
+        """
+        Return a tar archive of the (path, content, md5) <files>.
+        """
+        bundle = io.BytesIO()
+        tar = tarfile.open(fileobj=bundle, mode='w', format=tarfile.PAX_FORMAT, encoding='utf-8')
+        for path, content, md5 in files:
+            entry = tarfile.TarInfo(path)
+            entry.size = len(content)
+            entry.pax_headers = {server.BUNDLE_MD5_HEADER: unicode(md5)}
+            tar.addfile(entry, io.BytesIO(content))
+        tar.close()
+        return bundle.getvalue()
+
+    def upload(self, files):
+        return self.app.post(urlparse.urljoin(SERVER_API, 'bundles/upload'), headers=self.headers,
+                             data=self.make_bundle(files), content_type='application/x-tar')
+
+    def test_upload_bundle(self):
+        files = [(path, content, hashlib.md5(content).hexdigest())
+                 for path, content in (('a.txt', 'a'), ('dir/b.txt', 'b'), ('old.txt', 'new content'))]
+        test = self.upload(files)
+        self.assertEqual(test.status_code, HTTP_CREATED)
+        timestamp = json.loads(test.data)[server.LAST_SERVER_TIMESTAMP]
+        snapshot = server.userdata[self.user][server.SNAPSHOT]
+        for path, content, md5 in files:
+            self.assertEqual(snapshot[path], [timestamp, md5])
+            self.assertEqual(open(userpath2serverpath(self.user, path)).read(), content)
+        self.assertEqual(os.listdir(os.path.join(server.FILE_ROOT, server.UPLOAD_STAGING_DIR)), [])
+
+    def test_upload_bundle_with_wrong_md5(self):
+        test = self.upload([('a.txt', 'a', hashlib.md5('a').hexdigest()),
+                            ('old.txt', 'new content', hashlib.md5('other').hexdigest())])
+        self.assertEqual(test.status_code, HTTP_CONFLICT)
+        # No file of the bundle is stored
+        self.assertNotIn('a.txt', server.userdata[self.user][server.SNAPSHOT])
+        self.assertFalse(os.path.exists(userpath2serverpath(self.user, 'a.txt')))
+        self.assertEqual(open(userpath2serverpath(self.user, 'old.txt')).read(), 'old content')
+        self.assertEqual(os.listdir(os.path.join(server.FILE_ROOT, server.UPLOAD_STAGING_DIR)), [])
+
+    def test_upload_bundle_under_a_file(self):
+        server.commit_userdata()
+        md5 = hashlib.md5('a').hexdigest()
+        for files in ([('a.txt', 'a', md5), ('old.txt/b.txt', 'a', md5)],
+                      [('a.txt', 'a', md5), ('c.txt/b.txt', 'a', md5), ('c.txt', 'a', md5)]):
+            test = self.upload(files)
+            self.assertEqual(test.status_code, HTTP_CONFLICT)
+            # No file of the bundle is stored
+            self.assertNotIn('a.txt', server.userdata[self.user][server.SNAPSHOT])
+            self.assertFalse(os.path.exists(userpath2serverpath(self.user, 'a.txt')))
+            self.assertEqual(server.pending_changes, [])
+        self.assertEqual(open(userpath2serverpath(self.user, 'old.txt')).read(), 'old content')
+
+    def test_bad_bundles(self):
+        md5 = hashlib.md5('a').hexdigest()
+        self.assertEqual(self.upload([('../a.txt', 'a', md5)]).status_code, HTTP_FORBIDDEN)
+        self.assertEqual(self.upload([('a.txt', 'a', md5), ('a.txt', 'a', md5)]).status_code,
+                         server.HTTP_BAD_REQUEST)
+        self.assertEqual(self.upload([]).status_code, server.HTTP_BAD_REQUEST)
+        test = self.app.post(urlparse.urljoin(SERVER_API, 'bundles/upload'), headers=self.headers,
+                             data='not a tar archive', content_type='application/x-tar')
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+
+    def download(self, paths):
+        return self.app.post(urlparse.urljoin(SERVER_API, 'bundles/download'), headers=self.headers,
+                             data={'paths': json.dumps(paths)})
+
+    def test_download_bundle(self):
+        files = [(path, content, hashlib.md5(content).hexdigest())
+                 for path, content in ((u'a.txt', 'a' * 1000), (u'dir/b.txt', 'b'), (u'big.txt', 'c' * 3000))]
+        self.upload([(path.encode('utf-8'), content, md5) for path, content, md5 in files])
+        old_max_size = server.BUNDLE_FILE_MAX_SIZE
+        server.BUNDLE_FILE_MAX_SIZE = 2000
+        try:
+            test = self.download([path for path, _, _ in files] + ['unknown.txt'])
+            # The archive is streamed: the files are read while the response data is consumed.
+            data = test.data
+        finally:
+            server.BUNDLE_FILE_MAX_SIZE = old_max_size
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        tar = tarfile.open(fileobj=io.BytesIO(data), mode='r|', encoding='utf-8')
+        entries = [(entry.name.decode('utf-8'), tar.extractfile(entry).read(),
+                    entry.pax_headers[server.BUNDLE_MD5_HEADER]) for entry in tar]
+        # The big and the unknown files are left out
+        self.assertEqual(entries, files[:2])
+
+    def test_bad_download_bundles(self):
+        self.assertEqual(self.download('a.txt').status_code, server.HTTP_BAD_REQUEST)
+        test = self.app.post(urlparse.urljoin(SERVER_API, 'bundles/download'), headers=self.headers)
+        self.assertEqual(test.status_code, server.HTTP_BAD_REQUEST)
+
+
+class TestHashes(unittest.TestCase):
+    """
+    Testing the directory hashes of the user files.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        self.headers = make_basicauth_headers(self.user, self.pw)
+        for path in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt'):
+            _create_file(self.user, path, 'content of ' + path)
+        server.commit_userdata()
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def get_hashes(self, path=''):
+        return self.app.get(SERVER_API + 'hashes/' + path, headers=self.headers)
+
+    def expected(self, path):
+        """
+        Return the directory hashes of <path> built from scratch from the user snapshot.
+        """
+        return server.DirectoryHashes(server.userdata[self.user][server.SNAPSHOT], 0).get(path)
+
+    def test_get_hashes(self):
+        test = self.get_hashes()
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        root = json.loads(test.data)
+        self.assertEqual(root, self.expected(''))
+        self.assertEqual(root['entries']['a.txt'], [server.DirectoryHashes.FILE,
+                                                    hashlib.md5('content of a.txt').hexdigest()])
+
+        sub = json.loads(self.get_hashes('dir/sub').data)
+        self.assertEqual(sub['entries'], {'c.txt': [server.DirectoryHashes.FILE,
+                                                    hashlib.md5('content of dir/sub/c.txt').hexdigest()]})
+        dir_entry_hash = server.DirectoryHashes.entry_hash(server.DirectoryHashes.DIR, 'sub', sub['hash'])
+        dir_ = json.loads(self.get_hashes('dir').data)
+        self.assertEqual(dir_['entries']['sub'], [server.DirectoryHashes.DIR, sub['hash']])
+        self.assertEqual(int(dir_['hash'], 16),
+                         dir_entry_hash ^ server.DirectoryHashes.entry_hash(server.DirectoryHashes.FILE, 'b.txt',
+                                                                            dir_['entries']['b.txt'][1]))
+
+    def test_hashes_updated_with_changes(self):
+        self.get_hashes()
+        hashes = server.dir_hashes[self.user]
+        test = self.app.post(urlparse.urljoin(SERVER_API, 'actions/delete'), headers=self.headers,
+                             data={'filepath': 'dir/sub/c.txt'})
+        self.assertEqual(test.status_code, server.HTTP_OK)
+        _create_file(self.user, 'dir/new.txt', 'new content')
+        server.commit_userdata()
+
+        for path in ('', 'dir'):
+            self.assertEqual(json.loads(self.get_hashes(path).data), self.expected(path))
+        self.assertEqual(self.get_hashes('dir/sub').status_code, server.HTTP_NOT_FOUND)
+        # Updated, not rebuilt
+        self.assertIs(server.dir_hashes[self.user], hashes)
+
+    def test_bad_hashes_requests(self):
+        self.assertEqual(self.get_hashes('unknown').status_code, server.HTTP_NOT_FOUND)
+        self.assertEqual(self.get_hashes('a.txt').status_code, server.HTTP_NOT_FOUND)
+        self.assertEqual(self.get_hashes('../other').status_code, server.HTTP_FORBIDDEN)
+
+
 class TestUserdataConsistence(unittest.TestCase):
     """
     Testing consistence between userdata dictionary and actual files.
@@ -1216,6 +2213,142 @@ class TestUserdataConsistence(unittest.TestCase):
         # WIP: Test not complete. TODO: Do more things! Put, ...?
 
 
+class TestUserdataJournal(unittest.TestCase):
+    """
+    Testing the userdata journal: changes are appended to the journal and replayed by load_userdata.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        server.save_userdata()
+
+    def tearDown(self):
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def journal_records(self):
+        with open(server.USERDATA_JOURNAL_FILENAME, 'rb') as fp:
+            return [json.loads(line) for line in fp]
+
+    def test_save_userdata_truncates_journal(self):
+        self.assertEqual(self.journal_records(), [])
+        self.assertEqual(server.load_userdata(), json.loads(json.dumps(server.userdata)))
+
+    def test_actions_are_journaled(self):
+        _create_file(self.user, 'foo.txt', 'foo')
+        self.app.post(SERVER_ACTIONS_API + 'move',
+                      headers=make_basicauth_headers(self.user, self.pw),
+                      data={'src': 'foo.txt', 'dst': 'bar/foo.txt'})
+        records = self.journal_records()
+        # Only the changed entries are journaled: the account data and the involved paths.
+        self.assertIn(['path', self.user, server.SNAPSHOT, 'foo.txt', None], records)
+        self.assertEqual(len([r for r in records if r[0] == 'path']), 2)
+        # The snapshot is untouched while the journal replay gives the current userdata.
+        self.assertNotIn('bar/foo.txt', json.load(open(server.USERDATA_FILENAME))[self.user][server.SNAPSHOT])
+        self.assertEqual(server.load_userdata(), json.loads(json.dumps(server.userdata)))
+
+    def test_user_deletion_is_journaled(self):
+        self.app.delete(urlparse.urljoin(SERVER_API, 'users/' + self.user),
+                        headers=make_basicauth_headers(self.user, self.pw))
+        self.assertEqual(self.journal_records(), [['deluser', self.user]])
+        self.assertNotIn(self.user, server.load_userdata())
+
+    def test_corrupted_journal_tail_is_skipped(self):
+        _create_file(self.user, 'foo.txt', 'foo')
+        server.commit_userdata()
+        with open(server.USERDATA_JOURNAL_FILENAME, 'ab') as fp:
+            fp.write('["path", "pip')
+        self.assertIn('foo.txt', server.load_userdata()[self.user][server.SNAPSHOT])
+
+    def test_journal_compaction(self):
+        with mock.patch('server.JOURNAL_COMPACTION_THRESHOLD', 2):
+            for filename in ('a', 'b', 'c'):
+                _create_file(self.user, filename, filename)
+            server.commit_userdata()
+        self.assertEqual(self.journal_records(), [])
+        self.assertEqual(server.storage.journal_length, 0)
+        self.assertIn('c', json.load(open(server.USERDATA_FILENAME))[self.user][server.SNAPSHOT])
+
+
+class TestSqliteStorage(unittest.TestCase):
+    """
+    Testing the sqlite userdata storage backend.
+    """
+    def setUp(self):
+        setup_test_dir()
+        server.reset_userdata()
+        self.default_storage = server.storage
+        server.storage = server.SqliteStorage()
+        self.app = server.app.test_client()
+        self.app.testing = True
+        self.user, self.pw = 'pippo', 'pass'
+        _manually_create_user(self.user, self.pw)
+        server.save_userdata()
+
+    def tearDown(self):
+        server.storage.conn.close()
+        server.storage = self.default_storage
+        server.reset_userdata()
+        tear_down_test_dir()
+
+    def test_save_and_load(self):
+        self.assertEqual(server.load_userdata(), json.loads(json.dumps(server.userdata)))
+
+    def test_changes_are_stored(self):
+        _create_file(self.user, 'foo.txt', 'foo')
+        self.app.post(SERVER_ACTIONS_API + 'copy',
+                      headers=make_basicauth_headers(self.user, self.pw),
+                      data={'src': 'foo.txt', 'dst': 'bar/foo.txt'})
+        self.app.post(SERVER_ACTIONS_API + 'delete',
+                      headers=make_basicauth_headers(self.user, self.pw),
+                      data={'filepath': 'WELCOME'})
+        # The handlers read and write the user files through the database.
+        self.assertIsInstance(server.userdata[self.user][server.SNAPSHOT], server.SqliteContainer)
+        # Reopen the database to be sure that the changes have been committed.
+        server.storage.conn.close()
+        server.storage = server.SqliteStorage()
+        stored = server.load_userdata()
+        self.assertIn('bar/foo.txt', stored[self.user][server.SNAPSHOT])
+        self.assertNotIn('WELCOME', stored[self.user][server.SNAPSHOT])
+        self.assertEqual(stored[self.user][server.SNAPSHOT]['foo.txt'][1], hashlib.md5('foo').hexdigest())
+
+    def test_container(self):
+        files = server.SqliteContainer(server.storage.conn, self.user, server.SNAPSHOT)
+        self.assertEqual(dict(files.iteritems()), server.userdata[self.user][server.SNAPSHOT])
+        files['new.txt'] = [1, 'md5']
+        self.assertEqual(files['new.txt'], [1, 'md5'])
+        self.assertIn('new.txt', files)
+        self.assertEqual(files.pop('new.txt'), [1, 'md5'])
+        self.assertNotIn('new.txt', files)
+        self.assertIsNone(files.get('new.txt'))
+        self.assertRaises(KeyError, files.__delitem__, 'new.txt')
+        self.assertEqual(len(files), len(server.userdata[self.user][server.SNAPSHOT]))
+
+    def test_grants(self):
+        _manually_create_user('other', 'pass')
+        server.save_userdata()
+        test = self.app.post(SERVER_SHARES_API + 'Music/other',
+                             headers=make_basicauth_headers(self.user, self.pw))
+        self.assertEqual(test.status_code, HTTP_OK)
+        self.assertEqual(server.storage.conn.execute('SELECT owner, path, grantee FROM grants').fetchall(),
+                         [(self.user, 'Music', 'other')])
+        stored = server.load_userdata()
+        self.assertEqual(stored[self.user]['shared_with_others'], {'Music': ['other']})
+        self.assertEqual(stored['other']['shared_with_me'], {self.user: ['Music']})
+        self.assertIn('shared/{}/Music/Music.txt'.format(self.user), stored['other'][server.SHARED_FILES])
+        self.assertNotIn('shared_with_others', server.storage.conn.execute('SELECT data FROM users').fetchone()[0])
+
+    def test_user_deletion(self):
+        self.app.delete(urlparse.urljoin(SERVER_API, 'users/' + self.user),
+                        headers=make_basicauth_headers(self.user, self.pw))
+        self.assertEqual(server.load_userdata(), {})
+        self.assertEqual(server.storage.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0], 0)
+
+
 class TestLoggingConfiguration(unittest.TestCase):
     """
     Testing log directory creation if it doesn't exists